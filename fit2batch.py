@@ -0,0 +1,1962 @@
+#
+# fit2batch - convert many FIT files with fit2tcx: in batches, bundles and
+# work queues, and while they are still being written
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name> [https://github.com/Tigge/FIT-to-TCX/]
+# Copyright (c) 2014-2016, Ian Grant <ian@iangrant.me> [https://github.com/imgrant/fit2tcx]
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import io
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import struct
+import hashlib
+import logging
+import argparse
+import multiprocessing
+import lxml.etree
+
+from datetime import datetime, timedelta
+from pytz import timezone, utc, UnknownTimeZoneError
+
+from fitparse import FitFile, FitParseError
+from fitparse.utils import FitEOFError
+
+import fit2tcx
+
+
+# The subcommands are run as fit2tcx, and log as fit2tcx does
+logger = logging.getLogger("fit2tcx")
+
+
+# Name of the journal written by batch conversion, in the output folder
+JOURNAL_FILENAME = "fit2tcx-journal.jsonl"
+
+# Name of the folder of work queue locks and states, in the output folder
+QUEUE_FOLDERNAME = ".fit2tcx-queue"
+
+# Upper bounds of the buckets of the histograms of run metrics, in seconds
+METRICS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0, 120.0)
+
+
+class Journal(object):
+
+    """
+    Append-only journal of a batch conversion, with a JSON line for each
+    input that is started, done, failed, crashed (or timed out), interrupted
+    or quarantined, along with the fingerprint of the input file and the
+    conversion options. The state of each input is replayed from the
+    journal when it is opened, so that a batch can be resumed.
+    """
+
+    def __init__(self, filename, resume=True):
+        self.filename = filename
+        self.inputs = {}
+        if resume and os.path.exists(filename):
+            with open(filename) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue    # line cut short by a crash
+                    self._apply(entry)
+        # An input still in progress at the end crashed (or the machine did)
+        for state in self.inputs.values():
+            if state['status'] == "started":
+                state['status'] = "crashed"
+                state['crashes'] += 1
+        self.file = open(filename, 'a' if resume else 'w')
+
+    def _apply(self, entry):
+        state = self.inputs.get(entry['input'])
+        if state is None or state['fingerprint'] != entry['fingerprint']:
+            # New input, or the input or options have changed
+            state = {'fingerprint': entry['fingerprint'],
+                     'status': None,
+                     'failures': 0,
+                     'crashes': 0}
+            self.inputs[entry['input']] = state
+        if entry['status'] == "started" and state['status'] == "started":
+            state['crashes'] += 1   # the previous attempt never finished
+        elif entry['status'] == "failed":
+            state['failures'] += 1
+        elif entry['status'] == "crashed":
+            state['crashes'] += 1
+        state['status'] = entry['status']
+
+    def state(self, filename, fingerprint):
+        """The state of an input, if it has the given fingerprint"""
+        state = self.inputs.get(filename)
+        if state is not None and state['fingerprint'] == fingerprint:
+            return state
+        return None
+
+    def record(self, filename, fingerprint, status, **details):
+        """Append an entry to the journal, flushed to disk"""
+        entry = dict(details,
+                     input=filename,
+                     fingerprint=fingerprint,
+                     status=status,
+                     time=fit2tcx.iso_Z_format(datetime.now(utc)))
+        self.file.write(json.dumps(entry, sort_keys=True) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._apply(entry)
+
+    def close(self):
+        self.file.close()
+
+
+class RunMetrics(object):
+
+    """
+    Structured events, metrics and progress for a run over many activities
+    (a batch conversion, or an import). For each activity, activity():
+    * appends an event to log_file, as a JSON line: the outcome, the size
+      of the input file, the number of trackpoints, and the time taken by
+      each stage (decode, prepare, render, write, etc.)
+    * updates counters (by outcome, of input bytes and of trackpoints) and
+      histograms (of the time for each stage and activity), which are
+      written to metrics_file in the Prometheus text format, e.g. for the
+      node_exporter textfile collector (rewritten atomically each time)
+    * updates the progress and ETA shown on the progress stream (e.g.
+      sys.stderr), on a single line if overwrite is set (the default, if
+      the stream is a terminal), else a line per activity
+    Metric names are prefixed with prefix, e.g. fit2tcx_activities_total.
+    """
+
+    METRICS = {'activities_total': ("counter", "Activities processed, by outcome"),
+               'input_bytes_total': ("counter", "Size of the input files processed"),
+               'trackpoints_total': ("counter", "Trackpoints converted"),
+               'uploads_total': ("counter", "Uploads, by status"),
+               'stage_seconds': ("histogram", "Time taken by each stage of processing an activity"),
+               'activity_seconds': ("histogram", "Time taken to process each activity"),
+               'activities_expected': ("gauge", "Activities to be processed in the run"),
+               'run_start_time_seconds': ("gauge", "Start time of the run, since the epoch"),
+               'activities_per_second': ("gauge", "Activities processed per second, so far")}
+
+    def __init__(self, prefix, total=None, log_file=None, metrics_file=None,
+                 progress=None, overwrite=None):
+        self.prefix = prefix
+        self.total = total
+        self.metrics_file = metrics_file
+        self.progress = progress
+        if overwrite is None and progress is not None:
+            overwrite = progress.isatty()
+        self.overwrite = overwrite
+        self.log = open(log_file, "a") if log_file else None
+        self.started = time.time()
+        self.finished = 0
+        self.counters = {}
+        self.histograms = {}
+        self.event("run_started", total=total)
+
+    def event(self, event, **fields):
+        """Append an event to the log file"""
+        if self.log is None:
+            return
+        fields['event'] = event
+        fields['time'] = fit2tcx.iso_Z_format(datetime.now(utc))
+        self.log.write(json.dumps(fields, sort_keys=True) + "\n")
+        self.log.flush()
+
+    def count(self, name, value=1, **labels):
+        """Add to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = [0] * len(METRICS_BUCKETS) + [0.0, 0]
+        histogram = self.histograms[key]
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def activity(self, filename, outcome, seconds=None, stages=None,
+                 trackpoints=None, error=None, **fields):
+        """Record the outcome of an activity (and show the progress)"""
+        self.finished += 1
+        self.count("activities_total", outcome=outcome)
+        try:
+            input_bytes = os.path.getsize(filename)
+        except OSError:
+            input_bytes = None
+        if input_bytes is not None and outcome != "skipped":
+            self.count("input_bytes_total", input_bytes)
+        if trackpoints:
+            self.count("trackpoints_total", trackpoints)
+        for stage, stage_seconds in sorted((stages or {}).items()):
+            self.observe("stage_seconds", stage_seconds, stage=stage)
+        if seconds is not None:
+            self.observe("activity_seconds", seconds)
+        self.event("activity", file=filename, outcome=outcome,
+                   input_bytes=input_bytes, trackpoints=trackpoints,
+                   seconds=seconds, stages=stages, error=error, **fields)
+        self.write_metrics()
+        self.show_progress()
+
+    def write_metrics(self):
+        """Write the metrics file"""
+        if not self.metrics_file:
+            return
+        elapsed = time.time() - self.started
+        gauges = {'run_start_time_seconds': self.started,
+                  'activities_per_second': self.finished / elapsed if elapsed > 0 else 0.0}
+        if self.total is not None:
+            gauges['activities_expected'] = self.total
+        lines = []
+        for name in sorted(self.METRICS):
+            metric_type, description = self.METRICS[name]
+            full_name = self.prefix + "_" + name
+            if metric_type == "counter":
+                series = [(labels, value) for (n, labels), value in
+                          sorted(self.counters.items()) if n == name]
+            elif metric_type == "histogram":
+                series = [(labels, value) for (n, labels), value in
+                          sorted(self.histograms.items()) if n == name]
+            else:
+                series = [((), gauges[name])] if name in gauges else []
+            if not series:
+                continue
+            lines.append("# HELP {name} {text}".format(name=full_name, text=description))
+            lines.append("# TYPE {name} {type}".format(name=full_name, type=metric_type))
+            for labels, value in series:
+                if metric_type != "histogram":
+                    lines.append(prometheus_sample(full_name, labels, value))
+                    continue
+                for bound, bucket in zip(METRICS_BUCKETS + ("+Inf",),
+                                         value[:len(METRICS_BUCKETS)] + [value[-1]]):
+                    lines.append(prometheus_sample(full_name + "_bucket",
+                                                   labels + (("le", bound),),
+                                                   bucket))
+                lines.append(prometheus_sample(full_name + "_sum", labels, value[-2]))
+                lines.append(prometheus_sample(full_name + "_count", labels, value[-1]))
+        with fit2tcx.atomic_file(self.metrics_file) as f:
+            f.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+    def show_progress(self):
+        """Show the number of activities processed, the rate and the ETA"""
+        if self.progress is None:
+            return
+        elapsed = time.time() - self.started
+        rate = self.finished / elapsed if elapsed > 0 else 0.0
+        if self.total:
+            remaining = max(self.total - self.finished, 0)
+            eta = timedelta(seconds=int(remaining / rate)) if rate else "?"
+            line = ("[{n:d}/{total:d}] {percent:.0f}%, {rate:.2f} activities/s, "
+                    "ETA {eta!s}").format(n=self.finished, total=self.total,
+                                          percent=100.0 * self.finished / self.total,
+                                          rate=rate, eta=eta)
+        else:
+            line = "[{n:d}] {rate:.2f} activities/s".format(n=self.finished,
+                                                           rate=rate)
+        if self.overwrite:
+            self.progress.write("\r" + line + "\033[K")
+        else:
+            self.progress.write(line + "\n")
+        self.progress.flush()
+
+    def close(self, **fields):
+        """Finish the run, logging the totals"""
+        totals = {}
+        for (name, labels), value in self.counters.items():
+            if name == "activities_total":
+                totals[dict(labels)['outcome']] = value
+        self.event("run_finished", seconds=time.time() - self.started,
+                   outcomes=totals, **fields)
+        self.write_metrics()
+        if self.progress is not None and self.overwrite and self.finished:
+            self.progress.write("\n")
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+def prometheus_sample(name, labels, value):
+    """
+    A line of the Prometheus text format (with backslashes, double quotes
+    and line feeds in label values escaped)
+    """
+    if labels:
+        name += "{" + ",".join(
+            '{key}="{value}"'.format(
+                key=key,
+                value=str(label).replace("\\", "\\\\").replace(
+                    '"', '\\"').replace("\n", "\\n"))
+            for key, label in labels) + "}"
+    return "{name} {value!s}".format(
+        name=name, value=repr(value) if isinstance(value, float) else value)
+
+
+def add_metrics_arguments(parser):
+    """Add the options for structured logs, metrics and progress"""
+    parser.add_argument(
+        "--log-json",
+        action="store",
+        metavar="FILE",
+        help="Append a JSON line for each activity (outcome, input size, trackpoints and the time taken by each stage) to this file")
+    parser.add_argument(
+        "--prometheus",
+        action="store",
+        metavar="FILE",
+        help="Write counters and histograms of the run (outcomes, bytes, trackpoints, stage times) to this file, in the Prometheus text format")
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show the progress, rate and ETA on stderr")
+
+
+def run_metrics(args, prefix, total=None, overwrite=None):
+    """The RunMetrics for a run, from the arguments"""
+    return RunMetrics(prefix,
+                      total,
+                      log_file=args.log_json,
+                      metrics_file=args.prometheus,
+                      progress=sys.stderr if args.progress else None,
+                      overwrite=overwrite)
+
+
+def fingerprint(filename, options, name=None):
+    """
+    Fingerprint of an input FIT file (by name, which defaults to the
+    absolute path, size and modification time) and the conversion options,
+    for the journal
+    """
+    stat = os.stat(filename)
+    key = json.dumps([name or os.path.abspath(filename),
+                      stat.st_size,
+                      stat.st_mtime,
+                      sorted(options.items())])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def remove_temp_files(output_folder, filename):
+    """
+    Remove any temporary files left by atomic_file() when the conversion of
+    a FIT file to output_folder was killed
+    """
+    basename = os.path.splitext(os.path.basename(filename))[0] + ".tcx"
+    for name in os.listdir(output_folder):
+        if name.startswith("." + basename + ".") and name.endswith(".tmp"):
+            os.remove(os.path.join(output_folder, name))
+
+
+def output_names(filenames):
+    """
+    Names of the TCX files for FIT files, relative to the output folder:
+    the path of each FIT file relative to the folder that they are all in,
+    so that FIT files of the same name in different folders don't overwrite
+    each other's TCX files
+    """
+    paths = [os.path.abspath(filename) for filename in filenames]
+    common = os.path.dirname(os.path.commonprefix(
+        [os.path.dirname(path) + os.sep for path in paths]))
+    return [os.path.splitext(os.path.relpath(path, common))[0] + ".tcx"
+            for path in paths]
+
+
+def _batch_worker(connection):
+    """
+    Convert files in a worker process, receiving (filename, output, options)
+    tasks until None is sent, and sending back any error, and the stats of
+    the conversion (see ConversionResult.stats()), for each
+    """
+    try:
+        while True:
+            task = connection.recv()
+            if task is None:
+                break
+            filename, output, options = task
+            try:
+                result = fit2tcx.convert(filename, **options)
+                result.write(output)
+                connection.send((None, result.stats()))
+            except Exception as exception:
+                connection.send(("{name}: {err!s}".format(
+                    name=type(exception).__name__, err=exception), {}))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        connection.close()
+
+
+class BatchWorker(object):
+
+    """
+    A worker process that converts one file at a time (see _batch_worker()),
+    kept for file after file, so that the timezone data and the TCX schema
+    are loaded once per worker rather than once per file. A worker that
+    crashes, or is terminated (e.g. when a conversion times out), is
+    replaced by a new process for the next file.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.connection = None
+        self.exitcode = None
+
+    def start(self, filename, output, options):
+        """Start converting a file"""
+        if self.process is None:
+            self.connection, child = multiprocessing.Pipe()
+            self.process = multiprocessing.Process(target=_batch_worker,
+                                                   args=(child,))
+            self.process.daemon = True
+            self.process.start()
+            child.close()
+        self.connection.send((filename, output, options))
+
+    def poll(self, timeout=0):
+        """Whether the conversion has finished (or the worker has died)"""
+        return self.connection.poll(timeout)
+
+    def result(self):
+        """
+        The error (None if there wasn't one, or "crashed" if the worker
+        died, with its exit code in exitcode) and the stats of a finished
+        conversion
+        """
+        try:
+            return self.connection.recv()
+        except EOFError:
+            self.process.join()
+            self.exitcode = self.process.exitcode
+            self._reset()
+            return ("crashed", {})
+
+    def terminate(self):
+        """Kill the worker (e.g. when a conversion times out)"""
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self._reset()
+
+    def close(self):
+        """Stop the worker, once it has finished converting"""
+        if self.process is not None:
+            try:
+                self.connection.send(None)
+            except (IOError, OSError):
+                pass
+            self.process.join()
+            self._reset()
+
+    def _reset(self):
+        self.connection.close()
+        self.connection = None
+        self.process = None
+
+
+def batch_convert(filenames,
+                  output_folder,
+                  options,
+                  journal_file=None,
+                  resume=False,
+                  workers=1,
+                  max_retries=3,
+                  max_crashes=2,
+                  timeout=None,
+                  metrics=None):
+    """
+    Convert FIT files to TCX files in output_folder (see output_names()), in
+    worker processes (up to workers, see BatchWorker), keeping a journal so that
+    the batch can be resumed: completed inputs are then skipped, failed
+    inputs are retried up to max_retries times, and inputs that have crashed
+    (or timed out) a worker max_crashes times are quarantined. The outcome
+    of each input is recorded in metrics (a RunMetrics), if given. Returns a
+    dict of the number of inputs by outcome.
+    """
+    if metrics is None:
+        metrics = RunMetrics("fit2tcx")
+    if journal_file is None:
+        journal_file = os.path.join(output_folder, JOURNAL_FILENAME)
+    journal = Journal(journal_file, resume)
+    counts = dict.fromkeys(("done", "failed", "crashed", "skipped",
+                            "quarantined"), 0)
+
+    pending = []
+    for filename, name in zip(filenames, output_names(filenames)):
+        output = os.path.join(output_folder, name)
+        try:
+            fp = fingerprint(filename, options)
+        except OSError as exception:
+            logger.error("%s: %s", filename, exception)
+            counts['failed'] += 1
+            metrics.activity(filename, "failed", error=str(exception))
+            continue
+        state = journal.state(filename, fp)
+        if state is not None:
+            if state['status'] == "done" and os.path.exists(output):
+                counts['skipped'] += 1
+                metrics.activity(filename, "skipped")
+                continue
+            if state['status'] == "quarantined":
+                counts['quarantined'] += 1
+                metrics.activity(filename, "quarantined")
+                continue
+            if state['crashes'] >= max_crashes:
+                journal.record(filename, fp, "quarantined")
+                logger.warning("%s: quarantined after %d crashes",
+                               filename, state['crashes'])
+                counts['quarantined'] += 1
+                metrics.activity(filename, "quarantined")
+                continue
+            if state['failures'] >= max_retries:
+                logger.warning("%s: not retried after %d failures",
+                               filename, state['failures'])
+                counts['failed'] += 1
+                metrics.activity(filename, "failed",
+                                 error="not retried after {n:d} failures".format(
+                                     n=state['failures']))
+                continue
+        pending.append((filename, output, fp))
+
+    idle = [BatchWorker() for _ in range(max(min(workers, len(pending)), 1))]
+    running = []
+    try:
+        while pending or running:
+            # Start conversions, up to the number of workers
+            while pending and idle:
+                filename, output, fp = pending.pop(0)
+                fit2tcx.makedirs(os.path.dirname(output))
+                worker = idle.pop()
+                journal.record(filename, fp, "started")
+                worker.start(filename, output, options)
+                running.append((worker, filename, output, fp, time.time()))
+
+            # Collect finished (or timed out) conversions
+            still_running = []
+            for task in running:
+                worker, filename, output, fp, started = task
+                if worker.poll():
+                    error, stats = worker.result()
+                    idle.append(worker)
+                    seconds = time.time() - started
+                    if error == "crashed":
+                        remove_temp_files(os.path.dirname(output), filename)
+                        journal.record(filename, fp, "crashed",
+                                       exitcode=worker.exitcode)
+                        logger.error("%s: worker crashed (exit code %s)",
+                                     filename, worker.exitcode)
+                        counts['crashed'] += 1
+                        metrics.activity(filename, "crashed", seconds,
+                                         error="exit code {code!s}".format(
+                                             code=worker.exitcode))
+                    elif error is None:
+                        journal.record(filename, fp, "done", seconds=seconds)
+                        counts['done'] += 1
+                        metrics.activity(filename, "done", seconds, **stats)
+                    else:
+                        journal.record(filename, fp, "failed", error=error)
+                        logger.error("%s: %s", filename, error)
+                        counts['failed'] += 1
+                        metrics.activity(filename, "failed", seconds,
+                                         error=error)
+                elif timeout is not None and time.time() - started > timeout:
+                    worker.terminate()
+                    idle.append(worker)
+                    remove_temp_files(os.path.dirname(output), filename)
+                    journal.record(filename, fp, "crashed", error="timed out")
+                    logger.error("%s: timed out after %g s", filename, timeout)
+                    counts['crashed'] += 1
+                    metrics.activity(filename, "crashed", time.time() - started,
+                                     error="timed out")
+                else:
+                    still_running.append(task)
+            running = still_running
+            if running:
+                time.sleep(0.05)
+    except KeyboardInterrupt:
+        # Interrupted inputs don't count as crashes
+        for worker, filename, output, fp, started in running:
+            worker.terminate()
+            remove_temp_files(os.path.dirname(output), filename)
+            journal.record(filename, fp, "interrupted")
+        raise
+    finally:
+        for worker in idle:
+            worker.close()
+        for task in running:
+            task[0].terminate()
+        journal.close()
+
+    return counts
+
+
+class WorkQueue(object):
+
+    """
+    Coordinator-free work queue for converting a tree of FIT files to TCX
+    files, shared through the filesystem by worker processes on any number
+    of hosts. The queue is kept in a folder in the output folder.
+
+    A worker claims a FIT file by creating its lock file exclusively, and
+    keeps its lease by touching the lock file (a heartbeat) every lease / 4
+    seconds while the file is converted, in a child process (a BatchWorker,
+    kept for file after file). A lock file that hasn't been touched for the
+    lease time belongs to a worker that has died, and is reclaimed by the
+    next worker to come across it; this counts
+    as a crash, and files that crash workers too often are quarantined.
+    The outcome for each file is kept in a state file, written only by the
+    lease holder. Host clocks are assumed to agree to well within the lease.
+    """
+
+    def __init__(self,
+                 input_folder,
+                 output_folder,
+                 options,
+                 worker_id=None,
+                 lease=120.0,
+                 max_retries=3,
+                 max_crashes=2,
+                 timeout=None):
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.options = options
+        self.worker_id = worker_id or "{host}-{pid}".format(
+            host=socket.gethostname(), pid=os.getpid())
+        self.lease = lease
+        self.max_retries = max_retries
+        self.max_crashes = max_crashes
+        self.timeout = timeout
+        self.folder = os.path.join(output_folder, QUEUE_FOLDERNAME)
+        self.worker = BatchWorker()
+        fit2tcx.makedirs(self.folder)
+
+    def inputs(self):
+        """Names (paths relative to the input folder) of the FIT files"""
+        names = []
+        for folder, subfolders, filenames in os.walk(self.input_folder):
+            subfolders.sort()
+            for filename in filenames:
+                if filename.lower().endswith(".fit"):
+                    path = os.path.join(folder, filename)
+                    names.append(os.path.relpath(path, self.input_folder)
+                                 .replace(os.sep, "/"))
+        return sorted(names)
+
+    def _path(self, name, ext):
+        key = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        return os.path.join(self.folder, key + ext)
+
+    def output_file(self, name):
+        """The TCX file for a FIT file"""
+        return os.path.join(self.output_folder,
+                            os.path.splitext(name)[0] + ".tcx")
+
+    def state(self, name, fp):
+        """The state of a FIT file, for its current fingerprint"""
+        try:
+            with open(self._path(name, ".state")) as f:
+                state = json.load(f)
+            if state['fingerprint'] == fp:
+                return state
+        except (IOError, OSError, ValueError):
+            pass
+        return {'name': name,
+                'fingerprint': fp,
+                'status': None,
+                'failures': 0,
+                'crashes': 0}
+
+    def _write_state(self, state, status, **details):
+        state = dict(state, status=status, worker=self.worker_id,
+                     time=fit2tcx.iso_Z_format(datetime.now(utc)), **details)
+        with fit2tcx.atomic_file(self._path(state['name'], ".state"),
+                                 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        return state
+
+    def finished(self, name, state):
+        """Whether a file needs no more work (with its current state)"""
+        if state['status'] == "done":
+            return os.path.exists(self.output_file(name))
+        return (state['status'] == "quarantined" or
+                state['failures'] >= self.max_retries)
+
+    def _create_lock(self, lock):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as exception:
+            if exception.errno == errno.EEXIST:
+                return False
+            raise
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': self.worker_id, 'pid': os.getpid(),
+                       'claimed': fit2tcx.iso_Z_format(datetime.now(utc))}, f)
+        return True
+
+    def claim(self, name):
+        """
+        Try to claim a file, returning None if another worker holds its
+        lease, or whether the claim was reclaimed from an expired lease
+        """
+        lock = self._path(name, ".lock")
+        if self._create_lock(lock):
+            return False
+        try:
+            age = time.time() - os.stat(lock).st_mtime
+        except OSError:
+            return None     # just released
+        if age < self.lease:
+            return None
+
+        # Move the expired lock aside (only one worker can), then check
+        # that it wasn't renewed in the meantime before replacing it
+        stale = lock + "." + self.worker_id + ".stale"
+        try:
+            os.rename(lock, stale)
+        except OSError:
+            return None
+        if time.time() - os.stat(stale).st_mtime < self.lease:
+            if not os.path.exists(lock):
+                os.rename(stale, lock)
+            else:
+                os.remove(stale)
+            return None
+        os.remove(stale)
+        if not self._create_lock(lock):
+            return None
+        logger.warning("%s: reclaimed expired lease", name)
+        return True
+
+    def holds(self, name):
+        """Whether this worker holds the lease on a file"""
+        try:
+            with open(self._path(name, ".lock")) as f:
+                return json.load(f).get('worker') == self.worker_id
+        except (IOError, OSError, ValueError):
+            return False
+
+    def release(self, name):
+        """Release the lease on a file, unless another worker has it now"""
+        if self.holds(name):
+            try:
+                os.remove(self._path(name, ".lock"))
+            except OSError:
+                pass
+
+    def heartbeat(self, name):
+        """
+        Renew the lease on a claimed file, returning False if it has been
+        lost (i.e. it expired, and another worker has reclaimed the file)
+        """
+        if self.holds(name):
+            try:
+                os.utime(self._path(name, ".lock"), None)
+                return True
+            except OSError:
+                pass
+        logger.warning("%s: lease lost", name)
+        return False
+
+    def process(self, name):
+        """
+        Claim and convert a FIT file if it needs it, returning the outcome:
+        None if there was nothing to do, "busy" if another worker holds it
+        (or reclaimed it after this worker lost its lease), otherwise "done",
+        "failed", "crashed" or "quarantined"
+        """
+        filename = os.path.join(self.input_folder, name)
+        try:
+            fp = fingerprint(filename, self.options, name)
+        except OSError:
+            return None     # removed
+        if self.finished(name, self.state(name, fp)):
+            return None
+        reclaimed = self.claim(name)
+        if reclaimed is None:
+            return "busy"
+        try:
+            # Another worker may have finished the file before the claim
+            state = self.state(name, fp)
+            if reclaimed:
+                state = self._write_state(state, "crashed",
+                                          crashes=state['crashes'] + 1)
+            if self.finished(name, state):
+                return None
+            if state['crashes'] >= self.max_crashes:
+                self._write_state(state, "quarantined")
+                logger.warning("%s: quarantined after %d crashes",
+                               name, state['crashes'])
+                return "quarantined"
+            self._write_state(state, "started")
+            return self._convert(name, filename, state)
+        finally:
+            self.release(name)
+
+    def _convert(self, name, filename, state):
+        output = self.output_file(name)
+        fit2tcx.makedirs(os.path.dirname(output))
+        started = time.time()
+        self.worker.start(filename, output, self.options)
+        try:
+            last_heartbeat = started
+            while not self.worker.poll(min(self.lease / 4, 0.5)):
+                if time.time() - last_heartbeat >= self.lease / 4:
+                    if not self.heartbeat(name):
+                        # The file is another worker's now: stop, and leave
+                        # the state (and any temporary files) to it
+                        self.worker.terminate()
+                        return "busy"
+                    last_heartbeat = time.time()
+                if (self.timeout is not None and
+                        time.time() - started > self.timeout):
+                    self.worker.terminate()
+                    remove_temp_files(os.path.dirname(output), name)
+                    self._write_state(state, "crashed", error="timed out",
+                                      crashes=state['crashes'] + 1)
+                    logger.error("%s: timed out after %g s", name,
+                                 self.timeout)
+                    return "crashed"
+            error = self.worker.result()[0]
+        except BaseException:
+            # Interrupted: leave the file for another worker
+            self.worker.terminate()
+            if self.holds(name):
+                remove_temp_files(os.path.dirname(output), name)
+                self._write_state(state, "interrupted")
+            raise
+        if not self.holds(name):
+            logger.warning("%s: lease lost", name)
+            return "busy"
+        if error == "crashed":
+            remove_temp_files(os.path.dirname(output), name)
+            self._write_state(state, "crashed", exitcode=self.worker.exitcode,
+                              crashes=state['crashes'] + 1)
+            logger.error("%s: worker crashed (exit code %s)", name,
+                         self.worker.exitcode)
+            return "crashed"
+        elif error is None:
+            self._write_state(state, "done", seconds=time.time() - started)
+            return "done"
+        self._write_state(state, "failed", error=error,
+                          failures=state['failures'] + 1)
+        logger.error("%s: %s", name, error)
+        return "failed"
+
+    def run(self):
+        """
+        Work through the queue until every file is finished, waiting for
+        the leases of other workers (which may expire) to be released.
+        Returns a dict of the number of files processed by outcome.
+        """
+        counts = dict.fromkeys(("done", "failed", "crashed", "quarantined"),
+                               0)
+        try:
+            while True:
+                names = self.inputs()
+                # Start at a different point for each worker, to spread claims
+                if names:
+                    start = int(hashlib.sha1(self.worker_id.encode("utf-8"))
+                                .hexdigest(), 16) % len(names)
+                    names = names[start:] + names[:start]
+                busy = False
+                processed = False
+                for name in names:
+                    outcome = self.process(name)
+                    if outcome == "busy":
+                        busy = True
+                    elif outcome is not None:
+                        counts[outcome] += 1
+                        processed = True
+                if not busy and not processed:
+                    return counts
+                if not processed:
+                    time.sleep(min(self.lease / 4, 5.0))
+        finally:
+            self.worker.close()
+
+
+class BundleWriter(object):
+
+    """
+    Write TCX activities into bundles: TCX files with many activities in
+    the one Activities element, named <prefix>-001.tcx, <prefix>-002.tcx,
+    etc. Each activity is written to the current bundle as it is added, so
+    memory use doesn't grow with the number of activities, and a new bundle
+    is started when the current one would go over max_activities activities
+    or max_bytes bytes. Bundles are written atomically (see atomic_file()).
+    """
+
+    def __init__(self, prefix, max_activities=None, max_bytes=None):
+        self.prefix = prefix
+        self.max_activities = max_activities
+        self.max_bytes = max_bytes
+        self.files = []
+        self.num_activities = 0
+        self.header, self.footer = self._skeleton()
+        self._context = None
+        self._file = None
+
+    @staticmethod
+    def _skeleton():
+        """The bytes before and after the activities in a bundle"""
+        document = fit2tcx.create_document()
+        activities = fit2tcx.create_sub_element(document.getroot(),
+                                                "Activities")
+        activities.append(lxml.etree.Comment("activities"))
+        fit2tcx.add_author(document)
+        skeleton = lxml.etree.tostring(document.getroot(),
+                                       pretty_print=True,
+                                       xml_declaration=True,
+                                       encoding="UTF-8")
+        header, footer = skeleton.split(b"<!--activities-->")
+        return header.rstrip() + b"\n", b"  " + footer.lstrip()
+
+    def _open(self):
+        filename = "{prefix!s}-{num:03d}.tcx".format(prefix=self.prefix,
+                                                    num=len(self.files) + 1)
+        self._context = fit2tcx.atomic_file(filename)
+        self._file = self._context.__enter__()
+        self._file.write(self.header)
+        self.files.append(filename)
+        self.count = 0
+        self.size = len(self.header) + len(self.footer)
+
+    def _close(self, error=None):
+        if self._file is None:
+            return
+        if error is None:
+            self._file.write(self.footer)
+            self._context.__exit__(None, None, None)
+        else:
+            self._context.__exit__(type(error), error, None)
+            self.files.pop()
+        self._context = self._file = None
+
+    def add(self, activity):
+        """
+        Add an Activity element, or a serialized one (as from
+        activity_xml()), to the bundle
+        """
+        if not isinstance(activity, bytes):
+            activity = lxml.etree.tostring(activity, pretty_print=True)
+        activity = b"\n".join(b"    " + line if line else line
+                              for line in activity.rstrip().split(b"\n")) + b"\n"
+        if self._file is not None and self.count > 0 and (
+                (self.max_activities is not None and
+                 self.count >= self.max_activities) or
+                (self.max_bytes is not None and
+                 self.size + len(activity) > self.max_bytes)):
+            self._close()
+        if self._file is None:
+            self._open()
+        self._file.write(activity)
+        self.count += 1
+        self.size += len(activity)
+        self.num_activities += 1
+
+    def close(self, error=None):
+        """
+        Finish the current bundle, or if error is given, discard it (the
+        earlier bundles are complete)
+        """
+        self._close(error)
+
+
+def activity_xml(result):
+    """
+    The serialized Activity element of a ConversionResult (or elements, one
+    for each session)
+    """
+    activities = result.getroot().findall(
+        fit2tcx.TCD + "Activities/" + fit2tcx.TCD + "Activity")
+    # The namespaces are already declared by the root of the bundle
+    return b"".join(
+        fit2tcx.strip_declarations(
+            lxml.etree.tostring(activity, pretty_print=True),
+            {None: fit2tcx.TCD_NAMESPACE,
+             'xsi': fit2tcx.XML_SCHEMA_NAMESPACE})
+        for activity in activities)
+
+
+def _bundle_worker(task):
+    """
+    Convert a FIT file for a bundle in a worker process, returning the
+    filename and the serialized Activity element, or None and the error
+    """
+    filename, options = task
+    try:
+        return (filename, activity_xml(fit2tcx.convert(filename, **options)),
+                None)
+    except Exception as e:
+        return filename, None, str(e)
+
+
+def chronological(filenames, time_zone="auto"):
+    """
+    Sort FIT files by their start time (see peek()), returning the sorted
+    filenames, and a list of (filename, error) for those that couldn't be
+    read, which are left out
+    """
+    starts = []
+    failed = []
+    for filename in filenames:
+        try:
+            starts.append((fit2tcx.peek(filename, time_zone)['start_time'],
+                           filename))
+        except Exception as e:
+            failed.append((filename, str(e)))
+    return [filename for _, filename in sorted(starts)], failed
+
+
+def bundle_convert(filenames, prefix, options, workers=1,
+                   max_activities=None, max_bytes=None):
+    """
+    Convert FIT files into TCX bundles (see BundleWriter), in order of
+    their start time. Files are converted in parallel by `workers`
+    processes, and the activities are written in order as they arrive.
+    Returns the bundle filenames, the number of activities bundled and a
+    list of (filename, error) for those that failed.
+    """
+    filenames, failed = chronological(filenames, options.get('time_zone', "auto"))
+    for filename, error in failed:
+        logger.warning("%s: %s", filename, error)
+    tasks = [(filename, options) for filename in filenames]
+
+    writer = BundleWriter(prefix, max_activities, max_bytes)
+    pool = None
+    try:
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(_bundle_worker, tasks)
+        else:
+            results = (_bundle_worker(task) for task in tasks)
+        for filename, activity, error in results:
+            if activity is None:
+                logger.warning("%s: %s", filename, error)
+                failed.append((filename, error))
+            else:
+                writer.add(activity)
+    except BaseException as e:
+        writer.close(e)
+        raise
+    else:
+        writer.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return writer.files, writer.num_activities, failed
+
+
+def bundle_main(argv):
+    """Read arguments from command line to convert FIT files into bundles"""
+
+    parser = argparse.ArgumentParser(
+        prog="fit2tcx bundle",
+        description="Convert FIT files into TCX files with many activities "
+                    "each, in order of start time, for bulk import")
+
+    parser.add_argument("prefix", help="Output prefix for TCX bundles (written as <prefix>-001.tcx, etc.)")
+    parser.add_argument("FitFile", nargs="+", help="Input FIT file(s)")
+    add_conversion_arguments(parser)
+    parser.add_argument(
+        "-n",
+        "--max-activities",
+        action="store",
+        type=int,
+        help="Maximum number of activities in each bundle (default: no limit)")
+    parser.add_argument(
+        "-b",
+        "--max-size",
+        action="store",
+        type=float,
+        help="Maximum size of each bundle, in MB (default: no limit)")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(message)s")
+
+    options = batch_options(parser, args)
+    max_bytes = None
+    if args.max_size is not None:
+        max_bytes = int(args.max_size * 1024 * 1024)
+    folder = os.path.dirname(args.prefix)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    try:
+        files, num_activities, failed = bundle_convert(
+            args.FitFile,
+            args.prefix,
+            options,
+            workers=args.workers,
+            max_activities=args.max_activities,
+            max_bytes=max_bytes)
+    except KeyboardInterrupt:
+        sys.stderr.write("Interrupted\n")
+        return 130
+    for filename in files:
+        sys.stdout.write(filename + "\n")
+    sys.stdout.write("{num:d} activities in {bundles:d} bundles, "
+                     "{failed:d} failed\n".format(num=num_activities,
+                                                  bundles=len(files),
+                                                  failed=len(failed)))
+    return 0 if not failed else 1
+
+
+class TailFitFile(FitFile):
+
+    """
+    Reader for a FIT file that is still being written. Each call to read()
+    decodes only the messages appended since the last call, keeping the
+    decoder state (message definitions, accumulators) in between; a partly
+    written message at the end of the file is left for the next call. The
+    data size in the file header is only used once it is non-zero, since
+    devices fill it in when they finish the file (after writing the CRC,
+    which is left unread until then).
+    """
+
+    def __init__(self, fileish, data_processor=None):
+        FitFile.__init__(self, fileish, check_crc=False,
+                         data_processor=data_processor)
+        self._data_start = self._file.tell()
+        self.complete = False
+
+    def _data_end(self):
+        """Offset of the end of the data records, or None if not known yet"""
+        offset = self._file.tell()
+        self._file.seek(4)
+        data_size = struct.unpack("<I", self._file.read(4))[0]
+        self._file.seek(offset)
+        return self._data_start + data_size if data_size else None
+
+    def _file_size(self):
+        """The size of the file as written so far"""
+        offset = self._file.tell()
+        self._file.seek(0, os.SEEK_END)
+        size = self._file.tell()
+        self._file.seek(offset)
+        return size
+
+    def read(self):
+        """Decode the data messages written since the last call, in a list"""
+        messages = []
+        data_end = self._data_end()
+        while not self.complete:
+            offset = self._file.tell()
+            if data_end is not None and offset >= data_end:
+                self.complete = True
+                break
+            # The data size is ignored while parsing, and messages aren't
+            # kept, so memory use doesn't grow with the file
+            self._bytes_left = sys.maxsize
+            try:
+                message = self._parse_message()
+            except FitEOFError:
+                self._file.seek(offset)
+                break
+            except FitParseError:
+                # Until the data size is in the header, the last two bytes
+                # may be the CRC, written before the header is filled in
+                if data_end is None and self._file_size() - offset <= 2:
+                    self._file.seek(offset)
+                    break
+                raise
+            del self._messages[:]
+            if message.type == 'data':
+                messages.append(message)
+        return messages
+
+
+class TailConverter(object):
+
+    """
+    Convert a FIT file to TCX while it is still being written, updating the
+    TCX file with each batch of messages decoded by a TailFitFile. New
+    trackpoints are appended to the open lap, carrying on the cumulative
+    distance from the last trackpoint processed, and the open lap is
+    rewritten in full by add_lap() when its FIT lap message arrives. The
+    summary of the open lap is kept up to date in a fixed-size block, and
+    the end of the file (closing tags, notes and creator) is rewritten with
+    each update, so an update takes time in proportion to the new data.
+    GPS distance is computed point to point, without filtering.
+    """
+
+    LAP_HEADER_SIZE = 1024
+    NSMAP = {None: fit2tcx.TCD_NAMESPACE,
+             'xsi': fit2tcx.XML_SCHEMA_NAMESPACE}
+
+    def __init__(self, filename, time_zone="auto", sport="Running",
+                 dist_recalc=False, speed_recalc=False,
+                 current_cal_factor=100.0):
+        self.filename = filename
+        self.sport = sport
+        self.dist_recalc = dist_recalc
+        self.speed_recalc = speed_recalc
+        self.current_cal_factor = current_cal_factor
+        self.tz = None
+        if time_zone != "auto":
+            try:
+                self.tz = timezone(time_zone)
+            except UnknownTimeZoneError:
+                raise fit2tcx.TimezoneError("Unknown timezone: %s" % time_zone)
+        self.devices = fit2tcx.MessageLog()
+        self.session = None
+        self.num_laps = 0
+        self.num_trackpoints = 0
+        self.calculated_distance = 0.0
+        self.first = None
+        self.last = None
+        self._waiting = []      # messages held back until the timezone is known
+        self._pending = []      # records for the latest second, still open
+        self._points = []       # trackpoints since the last lap written
+        self._written = 0       # how many of those are in the file already
+        self._lap_distance = 0.0    # cumulative distance at the open lap start
+        self._lap = None        # summary of the open lap, if one is in the file
+        self._file = None
+        self._end = 0           # end of the trackpoints, where the trailer goes
+
+    def _time(self, dt):
+        """Re-normalize a date-time from the FIT file for the timezone"""
+        if dt is None:
+            return None
+        return utc.normalize(self.tz.localize(dt.replace(tzinfo=None)))
+
+    def update(self, messages, complete=False):
+        """
+        Process newly decoded messages and update the TCX file, finishing
+        it if the FIT file is complete
+        """
+        if self.tz is None:
+            for message in messages:
+                if (message.name == 'record' and
+                        message.get_value('position_lat') is not None and
+                        message.get_value('position_long') is not None):
+                    self.tz = fit2tcx.timezone_at(
+                        message.get_value('position_lat'),
+                        message.get_value('position_long'))
+                    break
+            if self.tz is None and complete:
+                self.tz = utc
+            if self.tz is None:
+                self._waiting.extend(messages)
+                return
+            messages, self._waiting = self._waiting + messages, None
+
+        for message in messages:
+            if message.name == 'record':
+                self._add_record(message)
+            elif message.name == 'lap':
+                self._end_lap(message)
+            elif message.name in ('file_id', 'device_info'):
+                self.devices.setdefault(message.name, []).append(message)
+            elif message.name == 'session':
+                self.session = message
+                sport = message.get_value("sport")
+                sport = fit2tcx.SPORT_MAP.get(sport, "Other")
+                if sport != self.sport:
+                    logger.warning("Activity sport is %s, but the TCX file "
+                                   "was written for %s", sport, self.sport)
+        if complete:
+            self._close_second()
+        self._write()
+
+    def _add_record(self, record):
+        values = fit2tcx.MessageValues.from_message(
+            record, fit2tcx.TRACKPOINT_FIELDS)
+        values['timestamp'] = self._time(record.get_value("timestamp"))
+        # Resample the records in the same second, as coalesce_trackpoints()
+        if self._pending and (
+                int((values['timestamp'] -
+                     fit2tcx.FIT_EPOCH).total_seconds()) !=
+                int((self._pending[0]['timestamp'] -
+                     fit2tcx.FIT_EPOCH).total_seconds())):
+            self._close_second()
+        self._pending.append(values)
+
+    def _close_second(self):
+        if self._pending:
+            self._add_trackpoint(fit2tcx.resample_trackpoints(
+                *fit2tcx.record_arrays(self._pending))[0])
+            self._pending = []
+
+    def _add_trackpoint(self, tp):
+        if self.last is not None:
+            self.calculated_distance += fit2tcx.gps_delta(tp, self.last)[0]
+        else:
+            self.first = tp
+        self.last = tp
+        self._points.append(tp)
+        self.num_trackpoints += 1
+
+    def _end_lap(self, message):
+        lap = fit2tcx.MessageValues.from_message(message, fit2tcx.LAP_FIELDS)
+        lap['start_time'] = self._time(lap['start_time'])
+        lap['timestamp'] = self._time(lap['timestamp'])
+        if lap['start_time'] == lap['timestamp'] or lap['timestamp'] is None:
+            return      # skipped, as by add_activity() and add_lap()
+        if self._pending and self._pending[0]['timestamp'] <= lap['timestamp']:
+            self._close_second()
+
+        element = fit2tcx.create_element("Activity")
+        lap_dist = fit2tcx.add_lap(element,
+                           None,
+                           lap,
+                           self.sport,
+                           self.dist_recalc,
+                           self.speed_recalc,
+                           False,
+                           self.current_cal_factor,
+                           False,
+                           None,
+                           1.0,
+                           self._lap_distance,
+                           self._points)
+        self._lap_distance += lap_dist
+        self.num_laps += 1
+
+        # Replace the open lap (if any) with the finished one
+        self._open(lap['start_time'])
+        if self._lap is not None:
+            self._end = self._lap['offset']
+            self._lap = None
+        self._file.seek(self._end)
+        fit2tcx.write_tcx_element(self._file, element[0], 3, self.NSMAP)
+        self._end = self._file.tell()
+
+        # Keep the trackpoints the next lap may start from, and
+        # the one before them; those after this lap aren't written yet
+        first = max(fit2tcx.find_trackpoint(self._points,
+                                            lap['timestamp']) - 1, 0)
+        last = fit2tcx.find_trackpoint(self._points, lap['timestamp'],
+                                       after=True)
+        self._points = self._points[first:]
+        self._written = last - first
+
+    def _open(self, start_time):
+        """Create the TCX file, up to the first lap, if not done yet"""
+        if self._file is not None:
+            return
+        document = fit2tcx.create_document()
+        activities = fit2tcx.create_sub_element(document.getroot(),
+                                                "Activities")
+        actelem = fit2tcx.create_sub_element(activities, "Activity")
+        actelem.set("Sport", self.sport)
+        fit2tcx.create_sub_element(actelem, "Id",
+                                   fit2tcx.iso_Z_format(start_time))
+        actelem.append(lxml.etree.Comment("laps"))
+        fit2tcx.add_author(document)
+        skeleton = lxml.etree.tostring(document.getroot(),
+                                       pretty_print=True,
+                                       xml_declaration=True,
+                                       encoding="UTF-8")
+        header, self._footer = skeleton.split(b"<!--laps-->")
+        self._file = open(self.filename, "w+b")
+        self._file.write(header.rstrip())
+        self._end = self._file.tell()
+
+    def _write(self):
+        """Write the new trackpoints, open lap summary and trailer"""
+        if self.first is None and self._file is None:
+            return
+        if self.first is not None:
+            self._open(self.first['timestamp'])
+        new = self._points[self._written:]
+        if new:
+            if self._lap is None:
+                self._lap = {'offset': self._end,
+                             'start_time': new[0]['timestamp'],
+                             'distance': 0.0,
+                             'max_speed': 0.0,
+                             'heart_rates': 0,
+                             'heart_rate_sum': 0,
+                             'max_heart_rate': None}
+                self._end += self.LAP_HEADER_SIZE
+            self._add_trackpoints(new)
+            self._written = len(self._points)
+        self._file.seek(self._end)
+        self._file.write(self._trailer())
+        self._file.truncate()
+        if self._lap is not None:
+            self._file.seek(self._lap['offset'])
+            self._file.write(self._lap_header())
+        self._file.flush()
+
+    def _add_trackpoints(self, new):
+        """Append trackpoints to the open lap, via a lap of just those"""
+        lap = fit2tcx.MessageValues(start_time=new[0]['timestamp'],
+                            timestamp=new[-1]['timestamp'],
+                            message_index=self.num_laps,
+                            total_elapsed_time=1,
+                            total_distance=0,
+                            total_calories=0,
+                            max_speed=max([tp['speed'] for tp in new
+                                           if tp['speed'] is not None] + [0.0]),
+                            avg_speed=0.0,
+                            intensity='active')
+        trackpoints = self._points[self._written - 1:] if self._written else new
+        element = fit2tcx.create_element("Activity")
+        distance = fit2tcx.add_lap(element,
+                           None,
+                           lap,
+                           self.sport,
+                           self.dist_recalc,
+                           self.speed_recalc,
+                           False,
+                           self.current_cal_factor,
+                           False,
+                           None,
+                           1.0,
+                           self._lap_distance + self._lap['distance'],
+                           trackpoints)
+        self._lap['distance'] += distance
+        self._lap['max_speed'] = max(self._lap['max_speed'], float(
+            element[0].find(fit2tcx.TCD + "MaximumSpeed").text))
+        for tp in new:
+            if tp['heart_rate'] is not None:
+                self._lap['heart_rates'] += 1
+                self._lap['heart_rate_sum'] += tp['heart_rate']
+                if (self._lap['max_heart_rate'] is None or
+                        tp['heart_rate'] > self._lap['max_heart_rate']):
+                    self._lap['max_heart_rate'] = tp['heart_rate']
+        self._file.seek(self._end)
+        for trackpoint in element[0].find(fit2tcx.TCD + "Track"):
+            fit2tcx.write_tcx_element(self._file, trackpoint, 5, self.NSMAP)
+        self._end = self._file.tell()
+
+    def _lap_header(self):
+        """The open lap's start tag and summary, padded to a fixed size"""
+        elapsed = (self.last['timestamp'] -
+                   self._lap['start_time']).total_seconds()
+        avg_heart = None
+        if self._lap['heart_rates']:
+            avg_heart = (self._lap['heart_rate_sum'] //
+                         self._lap['heart_rates'])
+        lap = fit2tcx.MessageValues(start_time=self._lap['start_time'],
+                            timestamp=self.last['timestamp'],
+                            message_index=self.num_laps,
+                            total_elapsed_time=elapsed,
+                            total_distance=self._lap['distance'],
+                            total_calories=0,
+                            max_speed=self._lap['max_speed'],
+                            avg_speed=(self._lap['distance'] / elapsed
+                                       if elapsed else 0.0),
+                            avg_heart_rate=avg_heart,
+                            max_heart_rate=self._lap['max_heart_rate'],
+                            intensity='active')
+        element = fit2tcx.create_element("Activity")
+        fit2tcx.add_lap(element, None, lap, self.sport, False, False, False,
+                self.current_cal_factor, False, None, 1.0, 0.0, [])
+        lapelem = element[0]
+        track = lapelem.find(fit2tcx.TCD + "Track")
+        while track.getnext() is not None:
+            lapelem.remove(track.getnext())
+        lapelem.remove(track)
+        lxml.etree.indent(lapelem, space="  ", level=3)
+        xml = fit2tcx.strip_declarations(lxml.etree.tostring(lapelem),
+                                         self.NSMAP)
+        xml = b"\n      " + xml[:xml.rindex(b"\n")]
+        padding = self.LAP_HEADER_SIZE - len(xml) - len(
+            b"\n        <!---->\n        <Track>")
+        if padding < 0:
+            raise fit2tcx.ConversionError(
+                "Lap summary too long for the TCX file")
+        return (xml + b"\n        <!--" + b" " * padding +
+                b"-->\n        <Track>")
+
+    def _notes(self):
+        """The activity notes, from the session once it has been written"""
+        if self.session is not None:
+            num_laps = self.session.get_value('num_laps')
+            total_time = self.session.get_value('total_timer_time')
+            total_activity_distance = self.session.get_value('total_distance')
+        elif self.last is not None:
+            num_laps = self.num_laps + (self._lap is not None)
+            total_time = (self.last['timestamp'] -
+                          self.first['timestamp']).total_seconds()
+            total_activity_distance = self.last['distance'] or 0.0
+        else:
+            return None
+        if self.dist_recalc:
+            distance_used = self.calculated_distance
+        else:
+            distance_used = total_activity_distance
+        try:
+            return fit2tcx.activity_notes(num_laps,
+                                  distance_used,
+                                  total_time,
+                                  total_activity_distance,
+                                  self.calculated_distance,
+                                  self.current_cal_factor,
+                                  (self.calculated_distance /
+                                   total_activity_distance *
+                                   self.current_cal_factor),
+                                  self.dist_recalc,
+                                  self.speed_recalc,
+                                  False,
+                                  False,
+                                  None)
+        except ZeroDivisionError:
+            return None     # no distance yet
+
+    def _trailer(self):
+        """The end of the TCX file, after the trackpoints written so far"""
+        trailer = io.BytesIO()
+        if self._lap is not None:
+            trailer.write(b"\n        </Track>\n      </Lap>")
+        element = fit2tcx.create_element("Activity")
+        notes = self._notes()
+        if notes is not None:
+            fit2tcx.add_notes(element, notes)
+        try:
+            fit2tcx.add_creator(element, *fit2tcx.device_info(self.devices))
+        except StopIteration:
+            pass    # no device messages yet
+        for child in list(element):
+            fit2tcx.write_tcx_element(trailer, child, 3, self.NSMAP)
+        trailer.write(self._footer)
+        return trailer.getvalue()
+
+    def close(self):
+        """Close the TCX file, as it stands"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def tail(fit_filename, tcx_filename, time_zone="auto", sport="Running",
+         dist_recalc=False, speed_recalc=False, current_cal_factor=100.0,
+         interval=1.0, idle_timeout=None, callback=None):
+    """
+    Convert a FIT file to TCX as it is being written, polling it for new
+    data every interval seconds until it is complete, or until it hasn't
+    grown for idle_timeout seconds. callback is called after each update
+    with the number of new messages and the time taken. Returns the
+    TailConverter.
+    """
+    converter = TailConverter(tcx_filename, time_zone, sport, dist_recalc,
+                              speed_recalc, current_cal_factor)
+    fit_file = None
+    idle_since = time.time()
+    try:
+        while True:
+            started = time.time()
+            try:
+                if fit_file is None:
+                    fit_file = TailFitFile(
+                        fit_filename, data_processor=fit2tcx.MyDataProcessor())
+                messages = fit_file.read()
+            except (FitEOFError, IOError, OSError):
+                messages = []   # not (fully) created yet
+            except FitParseError as e:
+                raise fit2tcx.FitFileError(
+                    "Error while parsing .FIT file: %s" % e)
+            complete = fit_file is not None and fit_file.complete
+            if messages or complete:
+                converter.update(messages, complete)
+                idle_since = time.time()
+                if callback is not None:
+                    callback(len(messages), idle_since - started)
+            if complete:
+                break
+            if (idle_timeout is not None and
+                    time.time() - idle_since >= idle_timeout):
+                break
+            try:
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                break
+    finally:
+        if fit_file is not None:
+            fit_file.close()
+        converter.close()
+    return converter
+
+
+def tail_main(argv):
+    """Read arguments from command line to convert a FIT file as it grows"""
+
+    parser = argparse.ArgumentParser(
+        prog="fit2tcx tail",
+        description="Convert a FIT file while it is still being written, "
+                    "updating the TCX file as new data is added")
+
+    parser.add_argument("FitFile", help="Input FIT file")
+    parser.add_argument("TcxFile", help="Output TCX file")
+    parser.add_argument(
+        "-z",
+        "--timezone",
+        action="store",
+        type=str,
+        default="auto",
+        help="Specify the timezone for FIT file timestamps (default, 'auto', uses GPS data to lookup the local timezone)")
+    parser.add_argument(
+        "-d",
+        "--recalculate-distance-from-gps",
+        action="store_true",
+        help="Recalculate distance from GPS data")
+    parser.add_argument(
+        "-s",
+        "--recalculate-speed-from-gps",
+        action="store_true",
+        help="Recalculate speed from GPS data")
+    parser.add_argument(
+        "-f",
+        "--calibration-factor",
+        action="store",
+        default=100.0,
+        type=float,
+        help="Existing calibration factor (defaults to 100.0)")
+    parser.add_argument(
+        "--sport",
+        action="store",
+        default="Running",
+        choices=sorted(set(fit2tcx.SPORT_MAP.values()) | set(["Other"])),
+        help="Sport of the activity, which is only in the FIT file once it is finished (defaults to Running)")
+    parser.add_argument(
+        "-i",
+        "--interval",
+        action="store",
+        default=1.0,
+        type=float,
+        help="Seconds between checks for new data (defaults to 1)")
+    parser.add_argument(
+        "--idle-timeout",
+        action="store",
+        type=float,
+        help="Stop if the FIT file hasn't grown for this many seconds (default: wait until it is complete)")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(message)s")
+
+    updates = []
+
+    def updated(num_messages, elapsed):
+        updates.append(elapsed)
+
+    start = time.time()
+    try:
+        converter = tail(args.FitFile,
+                         args.TcxFile,
+                         args.timezone,
+                         args.sport,
+                         args.recalculate_distance_from_gps,
+                         args.recalculate_speed_from_gps,
+                         args.calibration_factor,
+                         args.interval,
+                         args.idle_timeout,
+                         updated)
+    except KeyboardInterrupt:
+        return 1
+    except fit2tcx.ConversionError as exception:
+        sys.stderr.write(str(exception) + "\n")
+        return 1
+    sys.stdout.write("{laps:d} laps, {trackpoints:d} trackpoints in "
+                     "{updates:d} updates over {elapsed:.0f} s (longest "
+                     "update {longest:.3f} s)\n".format(
+                         laps=converter.num_laps,
+                         trackpoints=converter.num_trackpoints,
+                         updates=len(updates),
+                         elapsed=time.time() - start,
+                         longest=max(updates + [0.0])))
+    return 0
+
+
+def _queue_worker(args, results):
+    """Run a work queue worker in a local process, putting the counts"""
+    try:
+        results.put(WorkQueue(*args).run())
+    except KeyboardInterrupt:
+        pass
+
+
+def add_conversion_arguments(parser):
+    """Add the conversion options for batch conversion and bundling"""
+    parser.add_argument(
+        "-z",
+        "--timezone",
+        action="store",
+        type=str,
+        default="auto",
+        help="Specify the timezone for FIT file timestamps (default, 'auto', uses GPS data to lookup the local timezone)")
+    parser.add_argument(
+        "-d",
+        "--recalculate-distance-from-gps",
+        action="store_true",
+        help="Recalculate distance from GPS data")
+    parser.add_argument(
+        "-s",
+        "--recalculate-speed-from-gps",
+        action="store_true",
+        help="Recalculate speed from GPS data")
+    parser.add_argument(
+        "-c",
+        "--calibrate-footpod",
+        action="store_true",
+        help="Use GPS-measured distance to calibrate footpod data")
+    parser.add_argument(
+        "-p",
+        "--per-lap-calibration",
+        action="store_true",
+        help="Apply footpod calibration on a per lap basis")
+    parser.add_argument(
+        "-f",
+        "--calibration-factor",
+        action="store",
+        default=100.0,
+        type=float,
+        help="Existing calibration factor (defaults to 100.0)")
+    parser.add_argument(
+        "-r",
+        "--recompute-summary",
+        action="store_true",
+        help="Recompute lap heart rate and cadence from the trackpoints")
+    parser.add_argument(
+        "-g",
+        "--gps-filter",
+        action="append",
+        metavar="[SPORT=]MODE",
+        help="GPS filter for distance and speed from GPS: median, kalman or none, for all sports or a given sport, e.g. Biking=kalman (default: median)")
+    parser.add_argument(
+        "-e",
+        "--decimate",
+        action="store",
+        choices=fit2tcx.DECIMATION_MODES,
+        help="Only include some of the trackpoints in the TCX files, to make them smaller")
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        action="store",
+        type=float,
+        help="Tolerance for decimation, in seconds for interval and in metres for the others (defaults to 5, 10, 3 and 3)")
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the CRCs of the FIT files, so that corrupt files fail to convert")
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Validate the TCX documents against the TCX schema, so that invalid ones fail to convert")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Read the decoded records from a sidecar file next to each FIT file (FILE.streams), instead of decoding it, writing the sidecar if it is missing or stale")
+    parser.add_argument(
+        "--resample",
+        action="store",
+        type=float,
+        default=1.0,
+        metavar="INTERVAL",
+        help="Resample the records to a trackpoint every INTERVAL seconds, with the mean heart rate and cadence and the last position, altitude and distance (default: 1)")
+    parser.add_argument(
+        "--resample-speed",
+        action="store",
+        choices=fit2tcx.SPEED_REDUCTIONS,
+        default="last",
+        help="Speed of each resampled trackpoint: that of the last record, or the maximum or mean (default: last)")
+    parser.add_argument(
+        "--subsecond",
+        action="store_true",
+        help="Spread records in the same second evenly over it (e.g. for 4 Hz recording), to keep sub-second trackpoints with an INTERVAL under 1")
+    parser.add_argument(
+        "--dem",
+        action="store",
+        metavar="FOLDER",
+        help="Correct the altitude of trackpoints with positions from the DEM tiles (SRTM .hgt files) in FOLDER, offline")
+    parser.add_argument(
+        "-j",
+        "--workers",
+        action="store",
+        default=1,
+        type=int,
+        help="Number of files to convert at a time, in worker processes (defaults to 1)")
+
+
+def add_batch_arguments(parser):
+    """Add the conversion and worker options for batch conversion"""
+    add_conversion_arguments(parser)
+    parser.add_argument(
+        "--max-retries",
+        action="store",
+        default=3,
+        type=int,
+        help="Number of times a file may fail to convert before it is no longer retried (defaults to 3)")
+    parser.add_argument(
+        "--max-crashes",
+        action="store",
+        default=2,
+        type=int,
+        help="Number of times a file may crash or time out a worker before it is quarantined (defaults to 2)")
+    parser.add_argument(
+        "--timeout",
+        action="store",
+        type=float,
+        help="Time limit for converting each file, in seconds (default: no limit)")
+
+
+def batch_options(parser, args):
+    """The convert() options for batch conversion, from the arguments"""
+    if args.calibrate_footpod and not args.recalculate_distance_from_gps:
+        parser.error("-c (--calibrate-footpod) requires -d (--recalculate-distance-from-gps)")
+    fit2tcx.check_tolerance(parser, args)
+    try:
+        gps_filter = fit2tcx.parse_gps_filter(args.gps_filter)
+    except ValueError as e:
+        parser.error(str(e))
+    return {'time_zone': args.timezone,
+            'dist_recalc': args.recalculate_distance_from_gps,
+            'speed_recalc': args.recalculate_speed_from_gps,
+            'calibrate': args.calibrate_footpod,
+            'per_lap_cal': args.per_lap_calibration,
+            'current_cal_factor': args.calibration_factor,
+            'recompute_summary': args.recompute_summary,
+            'gps_filter': gps_filter,
+            'decimate': args.decimate,
+            'tolerance': args.tolerance,
+            'verify': args.verify,
+            'validate': args.validate,
+            'cache': args.cache,
+            'resample': fit2tcx.resample_options(parser, args),
+            'dem': args.dem}
+
+
+def batch_main(argv):
+    """Read arguments from command line to convert FIT files in a batch"""
+
+    parser = argparse.ArgumentParser(
+        prog="fit2tcx batch",
+        description="Convert FIT files to TCX files in a folder, with a "
+                    "journal so that an interrupted batch can be resumed")
+
+    parser.add_argument("folder", help="Output folder for TCX files")
+    parser.add_argument("FitFile", nargs="+", help="Input FIT file(s)")
+    add_batch_arguments(parser)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the journal: skip completed files, retry failed ones")
+    parser.add_argument(
+        "--journal",
+        action="store",
+        help="Journal file (defaults to {name} in the output folder)".format(
+            name=JOURNAL_FILENAME))
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(message)s")
+
+    options = batch_options(parser, args)
+
+    if not os.path.exists(args.folder):
+        os.makedirs(args.folder)
+
+    metrics = run_metrics(args, "fit2tcx", len(args.FitFile))
+    try:
+        counts = batch_convert(args.FitFile,
+                               args.folder,
+                               options,
+                               journal_file=args.journal,
+                               resume=args.resume,
+                               workers=args.workers,
+                               max_retries=args.max_retries,
+                               max_crashes=args.max_crashes,
+                               timeout=args.timeout,
+                               metrics=metrics)
+    except KeyboardInterrupt:
+        metrics.close(interrupted=True)
+        sys.stderr.write("Interrupted, use --resume to continue\n")
+        return 130
+    metrics.close()
+    sys.stdout.write("{done} converted, {skipped} already converted, "
+                     "{failed} failed, {crashed} crashed, "
+                     "{quarantined} quarantined\n".format(**counts))
+    return 0 if counts['done'] + counts['skipped'] == len(args.FitFile) else 1
+
+
+def queue_main(argv):
+    """Read arguments from command line to run work queue workers"""
+
+    parser = argparse.ArgumentParser(
+        prog="fit2tcx queue",
+        description="Convert a folder tree of FIT files to TCX files, in "
+                    "cooperation with workers on other hosts sharing the "
+                    "same folders")
+
+    parser.add_argument("input_folder", help="Folder tree of FIT files")
+    parser.add_argument("output_folder", help="Output folder for TCX files")
+    add_batch_arguments(parser)
+    parser.add_argument(
+        "--lease",
+        action="store",
+        default=120.0,
+        type=float,
+        help="Time after which the claim of a worker that has stopped renewing it (e.g. crashed) expires, in seconds (defaults to 120)")
+    parser.add_argument(
+        "--worker-id",
+        action="store",
+        help="Name of this worker (defaults to the hostname and process id)")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(message)s")
+
+    options = batch_options(parser, args)
+
+    worker_id = args.worker_id or "{host}-{pid}".format(
+        host=socket.gethostname(), pid=os.getpid())
+    tasks = [(args.input_folder,
+              args.output_folder,
+              options,
+              worker_id if args.workers <= 1 else
+              "{id}.{n}".format(id=worker_id, n=n),
+              args.lease,
+              args.max_retries,
+              args.max_crashes,
+              args.timeout) for n in range(max(args.workers, 1))]
+    try:
+        if len(tasks) > 1:
+            # Several local workers, e.g. to use all of a host's processors
+            results = multiprocessing.Queue()
+            workers = []
+            for task in tasks:
+                worker = multiprocessing.Process(target=_queue_worker,
+                                                 args=(task, results))
+                worker.start()
+                workers.append(worker)
+            counts = dict.fromkeys(("done", "failed", "crashed",
+                                    "quarantined"), 0)
+            for worker in workers:
+                for outcome, count in results.get().items():
+                    counts[outcome] += count
+            for worker in workers:
+                worker.join()
+        else:
+            counts = WorkQueue(*tasks[0]).run()
+    except KeyboardInterrupt:
+        sys.stderr.write("Interrupted\n")
+        return 130
+    sys.stdout.write("{done} converted, {failed} failed, {crashed} crashed, "
+                     "{quarantined} quarantined\n".format(**counts))
+    return 0
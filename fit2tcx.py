@@ -25,19 +25,43 @@
 
 __version__ = "1.6"
 
+import os
+import re
 import sys
 import copy
+import math
+import json
+import time
+import array
+import heapq
+import errno
+import bisect
+import struct
+import hashlib
+import logging
+import binascii
+import warnings
+import threading
 import contextlib
+import collections
 import argparse
+import multiprocessing
 import lxml.etree
+import numpy as np
 
 from datetime import datetime, timedelta
-from pytz import timezone, utc
+from pytz import timezone, utc, UnknownTimeZoneError
 
 from tzwhere import tzwhere
 from geopy.distance import GreatCircleDistance
 
+import fitparse
 from fitparse import FitFile, FitParseError
+from fitparse.records import DataMessage
+from fitparse.utils import FitCRCError, FitEOFError
+
+
+logger = logging.getLogger("fit2tcx")
 
 
 """
@@ -48,6 +72,117 @@ Limit values for error checking on speed & distance calculations
 # point is above this threshold (in m/s^2)
 MAX_ACCELERATION = 3.0
 
+# Trackpoints at speeds below this threshold (in m/s)
+# are not counted towards moving time
+MIN_MOVING_SPEED = 0.5
+
+# GPS filter applied to each sport by default (see filter_gps()):
+# 'median', 'kalman' or 'none'
+GPS_FILTERS = {'Running': "median",
+               'Biking':  "median",
+               'Other':   "median"}
+GPS_FILTER_MODES = ("none", "median", "kalman")
+
+# GPS steps faster than this (in m/s) are taken to be jumps in position
+MAX_GPS_SPEED = {'Running': 12.0,
+                 'Biking':  30.0,
+                 'Other':   70.0}
+
+# Number of points in the rolling median speed filter, and in the rolling
+# median and then rolling mean that smooth the positions before the
+# distances of the steps between them are measured
+GPS_MEDIAN_WINDOW = 5
+GPS_SMOOTH_WINDOW = 9
+
+# The positions are smoothed separately either side of a step that is
+# longer, by more than this (in m), than could be covered at MAX_GPS_SPEED
+GPS_JUMP_DISTANCE = 20.0
+
+# Standard deviations of GPS position noise (in m) and of acceleration
+# (in m/s^2) for the Kalman smoother, and the gate (in standard deviations)
+# beyond which a position is ignored as an outlier
+GPS_POSITION_NOISE = 4.0
+GPS_ACCELERATION_NOISE = 1.0
+GPS_KALMAN_GATE = 5.0
+
+# Maximum number of passes of the Kalman smoother, each ignoring the
+# outliers found by the one before
+GPS_KALMAN_PASSES = 4
+
+# Epochs of FIT and Unix timestamps
+FIT_EPOCH = datetime(1989, 12, 31, 0, 0, 0, tzinfo=utc)
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+
+# Mean radius of the Earth (in m), as used by geopy
+EARTH_RADIUS = 6371009.0
+
+# Track decimation modes (see decimate()), and the default tolerance for
+# each, in seconds for interval and in metres for the others
+DECIMATION_TOLERANCES = {'interval':        5.0,
+                         'distance':        10.0,
+                         'douglas-peucker': 3.0,
+                         'visvalingam':     3.0}
+DECIMATION_MODES = ("interval", "distance", "douglas-peucker", "visvalingam")
+
+
+# Extension of the sidecar file of decoded record streams written next to
+# a FIT file (see write_sidecar()), its magic number and format version
+SIDECAR_EXTENSION = ".streams"
+SIDECAR_MAGIC = b"FIT2TCXS"
+SIDECAR_VERSION = 3
+
+# Number of DEM tiles kept memory-mapped for elevation correction, the
+# least recently used being closed (see DemTiles)
+DEM_CACHE_TILES = 16
+
+
+"""
+Record fields coalesced into each trackpoint
+"""
+TRACKPOINT_FIELDS = ['cadence',
+                     'distance',
+                     'position_lat',
+                     'position_long',
+                     'heart_rate',
+                     'altitude',
+                     'speed']
+
+
+"""
+Lap message fields used when adding a lap
+"""
+LAP_FIELDS = ['timestamp',
+              'message_index',
+              'start_time',
+              'total_elapsed_time',
+              'total_distance',
+              'total_calories',
+              'max_speed',
+              'avg_speed',
+              'avg_heart_rate',
+              'max_heart_rate',
+              'avg_cadence',
+              'max_cadence',
+              'intensity',
+              'lap_trigger']
+
+
+"""
+Reduction of the values of each trackpoint field over the records
+resampled to a trackpoint (see resample_trackpoints()), and the
+reductions that can be chosen for speed
+"""
+RESAMPLE_REDUCTIONS = {'heart_rate':    "mean",
+                       'cadence':       "mean",
+                       'position_lat':  "last",
+                       'position_long': "last",
+                       'altitude':      "last",
+                       'distance':      "last",
+                       'speed':         "last"}
+SPEED_REDUCTIONS = ("last", "max", "mean")
+
+# Default resampling of records to trackpoints: a trackpoint per second
+RESAMPLE_DEFAULTS = {'interval': 1.0, 'subsecond': False, 'speed': "last"}
 
 """
 FIT to TCX values mapping
@@ -64,6 +199,10 @@ LAP_TRIGGER_MAP = {
     "session_end":        "Manual",
     "fitness_equipment":  "Manual"}
 
+SPORT_MAP = {
+    "running":  "Running",
+    "cycling":  "Biking"}
+
 INTENSITY_MAP = {
     "active":   "Active",
     "warmup":   "Active",
@@ -151,6 +290,8 @@ TCD = "{%s}" % TCD_NAMESPACE
 XML_SCHEMA_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
 XML_SCHEMA = "{%s}" % XML_SCHEMA_NAMESPACE
 
+XSD = "{http://www.w3.org/2001/XMLSchema}"
+
 SCHEMA_LOCATION = \
     "http://www.garmin.com/xmlschemas/ActivityExtension/v2 " + \
     "http://www.garmin.com/xmlschemas/ActivityExtensionv2.xsd " + \
@@ -163,18 +304,333 @@ NSMAP = {
     None: TCD_NAMESPACE,
     "xsi": XML_SCHEMA_NAMESPACE}
 
+# Namespace of the Speed, AvgSpeed & MaxSpeed extensions
+ACTIVITY_EXTENSION_NAMESPACE = "http://www.garmin.com/xmlschemas/ActivityExtension/v2"
+AX = "{%s}" % ACTIVITY_EXTENSION_NAMESPACE
+
+EXTENSION_NSMAP = {None: ACTIVITY_EXTENSION_NAMESPACE}
+
+# Local copies of the schemas in SCHEMA_LOCATION, for validating TCX documents
+SCHEMA_FOLDER = os.path.join(
+    getattr(sys, "_MEIPASS", os.path.dirname(os.path.abspath(__file__))),
+    "schemas")
+SCHEMA_FILES = {TCD_NAMESPACE: "TrainingCenterDatabasev2.xsd",
+                ACTIVITY_EXTENSION_NAMESPACE: "ActivityExtensionv2.xsd"}
+
+
+class ConversionError(Exception):
+    """Base class for errors converting a FIT file"""
+
+
+class FitFileError(ConversionError):
+    """The FIT file could not be read or decoded"""
+
+
+class ChecksumError(FitFileError):
+    """The FIT file is corrupt or truncated: its CRC does not match"""
+
+
+class TimezoneError(ConversionError):
+    """The timezone of the FIT file timestamps could not be determined"""
+
+
+class ActivityError(ConversionError):
+    """The FIT file does not contain an activity that can be converted"""
+
+
+class ElevationError(ConversionError):
+    """The DEM tiles for elevation correction could not be read"""
+
+
+class ValidationError(ConversionError):
 
+    """
+    The TCX document does not conform to the TCX schema; the errors are
+    listed in errors, as (activity Id, message) pairs
+    """
+
+    def __init__(self, message, errors):
+        ConversionError.__init__(self, message)
+        self.errors = errors
+
+
+# Context manager to silence print() in a module, for use with tzwhere
+# (which prints as it loads), without swapping sys.stdout for every thread
+@contextlib.contextmanager
+def quiet_module(module):
+    saved = vars(module).get('print')
+    setattr(module, 'print', lambda *args, **kwargs: None)
+    try:
+        yield
+    finally:
+        if saved is None:
+            delattr(module, 'print')
+        else:
+            setattr(module, 'print', saved)
+
+
+def replace_file(source, destination):
+    """Rename a file over another, atomically where the platform allows"""
+    try:
+        os.replace(source, destination)
+    except AttributeError:
+        # Python 2
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
 
-# Class and context manager to suppress stdout for use with tzwhere.
-class DummyFile(object):
-    def write(self, x): pass
 
 @contextlib.contextmanager
-def nostdout():
-    save_stdout = sys.stdout
-    sys.stdout = DummyFile()
-    yield
-    sys.stdout = save_stdout
+def atomic_file(filename, mode='wb'):
+    """
+    Open a temporary file, in the same folder as filename, for writing,
+    and rename it to filename once it has been written and flushed to disk.
+    The temporary file is removed if writing fails. It is created with the
+    permissions of any new file (as the umask allows), rather than private
+    as tempfile.mkstemp() would make it.
+    """
+    folder, basename = os.path.split(os.path.abspath(filename))
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        temp_filename = os.path.join(folder, ".{name!s}.{suffix!s}.tmp".format(
+            name=basename, suffix=binascii.hexlify(os.urandom(4)).decode()))
+        try:
+            fd = os.open(temp_filename, flags, 0o666)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+# The timezone lookup data is slow to load, so it is loaded once
+# per process and shared (tzwhere is not safe to load concurrently)
+_tzwhere = None
+_tzwhere_lock = threading.Lock()
+
+
+def load_timezones():
+    """
+    Load the timezone lookup data, if not already loaded.
+    Services converting files in multiple threads can call this before
+    starting them, so that the first conversions don't wait for it.
+    """
+    global _tzwhere
+    with _tzwhere_lock:
+        if _tzwhere is None:
+            with quiet_module(tzwhere):
+                _tzwhere = tzwhere.tzwhere()
+        return _tzwhere
+
+
+# The TCX schema is compiled once per process and shared (validating
+# sets the schema's error log, so it is locked)
+_tcx_schema = None
+_tcx_schema_lock = threading.Lock()
+
+
+def compile_tcx_schema():
+    """Compile the TCX schema and its extensions (see SCHEMA_FILES)"""
+    # A schema which just imports the others
+    schema = lxml.etree.Element(XSD + "schema")
+    for namespace in sorted(SCHEMA_FILES):
+        lxml.etree.SubElement(schema,
+                              XSD + "import",
+                              namespace=namespace,
+                              schemaLocation=os.path.join(
+                                  SCHEMA_FOLDER, SCHEMA_FILES[namespace]))
+    return lxml.etree.XMLSchema(schema)
+
+
+def load_tcx_schema():
+    """Compile the TCX schema, if not already compiled"""
+    global _tcx_schema
+    with _tcx_schema_lock:
+        if _tcx_schema is None:
+            _tcx_schema = compile_tcx_schema()
+        return _tcx_schema
+
+
+def schema_errors(document):
+    """
+    Validate a TCX document (an ElementTree) against the TCX schema,
+    returning a list of the errors as (activity Id, message) pairs; the
+    activity Id is None for errors outside an activity
+    """
+    schema = load_tcx_schema()
+    with _tcx_schema_lock:
+        if schema.validate(document):
+            return []
+        log = list(schema.error_log)
+    errors = []
+    for entry in log:
+        activity_id = None
+        path = getattr(entry, "path", None)
+        found = document.xpath(path) if path else []
+        for element in found[:1]:
+            for ancestor in element.iterancestors(TCD + "Activity"):
+                activity_id = ancestor.findtext(TCD + "Id")
+        message = entry.message
+        if entry.line:
+            message = "line {line:d}: {message!s}".format(line=entry.line,
+                                                          message=message)
+        errors.append((activity_id, message))
+    return errors
+
+
+def validate_document(document):
+    """
+    Validate a TCX document against the TCX schema, raising ValidationError
+    if it doesn't conform
+    """
+    errors = schema_errors(document)
+    if errors:
+        activity_id, message = errors[0]
+        raise ValidationError(
+            "TCX document does not conform to the schema ({num:d} errors), "
+            "in activity {id!s}: {message!s}".format(num=len(errors),
+                                                     id=activity_id,
+                                                     message=message),
+            errors)
+
+
+class DemTiles(object):
+
+    """
+    Elevation lookup in a folder of DEM tiles in the SRTM .hgt format:
+    1 x 1 degree tiles, named for their south-west corner (e.g. N51W001.hgt),
+    of big-endian 16-bit heights in metres, in rows from north to south,
+    at any resolution (e.g. 1201 x 1201 samples for 3 arc-seconds). Tiles
+    are memory-mapped as they are needed, and the max_tiles most recently
+    used are kept open.
+    """
+
+    VOID = -32768
+
+    def __init__(self, folder, max_tiles=DEM_CACHE_TILES):
+        self.folder = folder
+        self.max_tiles = max_tiles
+        self._tiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tile_name(lat, lon):
+        """The name of the tile with its south-west corner at (lat, lon)"""
+        return "%s%02d%s%03d.hgt" % ("N" if lat >= 0 else "S", abs(lat),
+                                     "E" if lon >= 0 else "W", abs(lon))
+
+    def tile(self, lat, lon):
+        """
+        The heights of the tile with its south-west corner at (lat, lon),
+        as a (memory-mapped) square array, or None if there is no such tile
+        """
+        key = (lat, lon)
+        with self._lock:
+            if key in self._tiles:
+                heights = self._tiles.pop(key)
+            else:
+                heights = self._open(lat, lon)
+            self._tiles[key] = heights
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return heights
+
+    def _open(self, lat, lon):
+        name = self.tile_name(lat, lon)
+        for path in (os.path.join(self.folder, name),
+                     os.path.join(self.folder, name.lower())):
+            if os.path.exists(path):
+                break
+        else:
+            return None
+        samples = os.path.getsize(path) // 2
+        side = int(round(math.sqrt(samples)))
+        if side < 2 or side * side != samples:
+            raise ElevationError("Not a DEM tile: %s" % path)
+        try:
+            return np.memmap(path, dtype='>i2', mode='r', shape=(side, side))
+        except (IOError, OSError) as e:
+            raise ElevationError("Unable to read DEM tile: %s" % e)
+
+    def elevations(self, lats, lons):
+        """
+        Look up the elevations (in metres) of arrays of positions (in
+        degrees), interpolating bilinearly between the four samples around
+        each position; NaN where there is no tile, or a sample is void.
+        The positions in each tile are looked up together.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        result = np.full(len(lats), np.nan)
+        if not len(lats):
+            return result
+        corners = np.floor(np.column_stack((lats, lons))).astype(int)
+        keys, inverse = np.unique(corners, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        # Indices of the positions in each tile, in one sort
+        order = np.argsort(inverse, kind='mergesort')
+        groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+        for (lat, lon), index in zip(keys.tolist(), groups):
+            heights = self.tile(lat, lon)
+            if heights is None:
+                continue
+            last = heights.shape[0] - 1
+            y = (lat + 1 - lats[index]) * last
+            x = (lons[index] - lon) * last
+            row = np.clip(np.floor(y).astype(int), 0, last - 1)
+            col = np.clip(np.floor(x).astype(int), 0, last - 1)
+            fy = y - row
+            fx = x - col
+            samples = [heights[row + dy, col + dx]
+                       for dy, dx in ((0, 0), (0, 1), (1, 0), (1, 1))]
+            void = np.zeros(len(index), dtype=bool)
+            for sample in samples:
+                void |= sample == self.VOID
+            h00, h01, h10, h11 = [sample.astype(float) for sample in samples]
+            top = h00 + (h01 - h00) * fx
+            bottom = h10 + (h11 - h10) * fx
+            result[index] = np.where(void, np.nan, top + (bottom - top) * fy)
+        return result
+
+
+# DEM tiles are opened once per process (and folder), and shared, so that
+# the tile cache lasts from one conversion to the next
+_dem_tiles = {}
+_dem_tiles_lock = threading.Lock()
+
+
+def load_dem(folder):
+    """
+    The DemTiles for a folder of DEM tiles, shared by conversions in this
+    process. Raises ElevationError if there is no such folder.
+    """
+    with _dem_tiles_lock:
+        tiles = _dem_tiles.get(folder)
+        if tiles is None:
+            if not os.path.isdir(folder):
+                raise ElevationError("DEM tile folder not found: %s" % folder)
+            tiles = _dem_tiles[folder] = DemTiles(folder)
+        return tiles
+
+
+def timezone_at(lat, lon):
+    """Look up the timezone at a position"""
+    w = load_timezones()
+    with _tzwhere_lock:
+        tzname = w.tzNameAt(lat, lon)
+    if tzname is None:
+        raise TimezoneError("No timezone found for position "
+                            "({lat:.6f}, {lon:.6f})".format(lat=lat, lon=lon))
+    return timezone(tzname)
 
 
 class MyDataProcessor(object):
@@ -220,11 +676,12 @@ class TZDataProcessor(MyDataProcessor):
 
     def __init__(self, lat=None, lon=None, tzname="UTC"):
         if lat is not None and lon is not None:
-            with nostdout():
-                w = tzwhere.tzwhere()
-            self.tz = timezone(w.tzNameAt(lat, lon))
+            self.tz = timezone_at(lat, lon)
         else:
-            self.tz = timezone(tzname)
+            try:
+                self.tz = timezone(tzname)
+            except UnknownTimeZoneError:
+                raise TimezoneError("Unknown timezone: %s" % tzname)
 
     def process_type_date_time(self, field_data):
         value = field_data.value
@@ -242,91 +699,873 @@ class TZDataProcessor(MyDataProcessor):
             field_data.units = None  # Units were 's', set to None
 
 
+class PeekFitFile(FitFile):
+
+    """
+    FIT file reader which only decodes the data messages of the types it is
+    asked for; the data of any other messages is skipped over, unparsed.
+    """
+
+    def __init__(self, fileish, messages, **kwargs):
+        self.peek_messages = set(messages)
+        FitFile.__init__(self, fileish, **kwargs)
+
+    def _parse_data_message(self, header):
+        def_mesg = self._local_mesgs.get(header.local_mesg_num)
+        if def_mesg is None or def_mesg.name in self.peek_messages:
+            return FitFile._parse_data_message(self, header)
+        size = sum(field_def.size for field_def in
+                   def_mesg.field_defs + def_mesg.dev_field_defs)
+        self._file.seek(size, os.SEEK_CUR)
+        self._bytes_left -= size
+        return DataMessage(header=header, def_mesg=def_mesg, fields=[])
+
+
 def iso_Z_format(dt):
     iso = dt.isoformat()
     z_iso = iso.replace("+00:00", "Z")
     return z_iso
 
 
+def record_arrays(records, fields=TRACKPOINT_FIELDS):
+    """
+    Read the values of record messages into arrays, in one pass, returning
+    (times, values, integral): the timestamps, in seconds since the FIT
+    epoch, a dict of arrays of the values of each field (NaN where missing),
+    and the fields whose values are all integers
+    """
+    times = array.array('d')
+    columns = dict((field, array.array('d')) for field in fields)
+    integral = set(fields)
+    nan = float('nan')
+    for record in records:
+        times.append((record.get_value("timestamp") -
+                      FIT_EPOCH).total_seconds())
+        for field in fields:
+            value = record.get_value(field)
+            if value is None:
+                columns[field].append(nan)
+            else:
+                if type(value) is not int:
+                    integral.discard(field)
+                columns[field].append(value)
+    return (np.frombuffer(times, dtype=float) if times else np.zeros(0),
+            dict((field, np.frombuffer(column, dtype=float) if column
+                  else np.zeros(0))
+                 for field, column in columns.items()),
+            integral)
+
+
+class Trackpoints(object):
+
+    """
+    A list of trackpoints, sorted by time, held as arrays: the times, in
+    seconds since the FIT epoch, and the values of each field (NaN where
+    missing), those of the fields in integral being integers. A trackpoint
+    is only built as a dict (of its values, None where missing, and its
+    timestamp) when it is first used, e.g. to add it to a TCX document,
+    so summaries can be computed from the arrays alone. A slice shares the
+    arrays, and values are changed for a whole field with set_stream().
+    """
+
+    def __init__(self, times, streams, integral=(), rows=None):
+        self.times = times
+        self.streams = streams
+        self.integral = frozenset(integral)
+        self._rows = [None] * len(times) if rows is None else rows
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Trackpoints(self.times[index],
+                               dict((name, values[index])
+                                    for name, values in self.streams.items()),
+                               self.integral,
+                               self._rows[index])
+        row = self._rows[index]
+        if row is None:
+            index = range(len(self))[index]
+            row = {}
+            for name, values in self.streams.items():
+                row[name] = self._value(name, float(values[index]))
+            row['timestamp'] = FIT_EPOCH + timedelta(
+                seconds=float(self.times[index]))
+            self._rows[index] = row
+        return row
+
+    def __iter__(self):
+        if None in self._rows:
+            self._build()
+        return iter(self._rows)
+
+    def __getstate__(self):
+        # Workers only need the arrays
+        return (self.times, self.streams, self.integral)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _value(self, name, value):
+        if value != value:
+            return None
+        return int(value) if name in self.integral else value
+
+    def _build(self):
+        """Build the trackpoints that haven't been built yet"""
+        columns = [(name, values.tolist())
+                   for name, values in self.streams.items()]
+        for i, t in enumerate(self.times.tolist()):
+            if self._rows[i] is None:
+                row = dict((name, self._value(name, values[i]))
+                           for name, values in columns)
+                row['timestamp'] = FIT_EPOCH + timedelta(seconds=t)
+                self._rows[i] = row
+
+    def seconds(self):
+        """
+        The times of the trackpoints in seconds since the first, as the
+        difference of their timestamps (which are to the microsecond) gives
+        """
+        if not len(self.times):
+            return np.zeros(0)
+        # As timedelta() rounds a number of seconds to microseconds
+        whole = np.floor(self.times)
+        micro = whole * 1e6 + np.round((self.times - whole) * 1e6)
+        return (micro - micro[0]) / 1e6
+
+    def stream(self, name):
+        """The values of a field, as an array (NaN where missing)"""
+        return self.streams[name]
+
+    def values(self, name):
+        """The values of a field, as a list (None where missing)"""
+        return [self._value(name, value)
+                for value in self.streams[name].tolist()]
+
+    def set_stream(self, name, values):
+        """
+        Set the values of a field (an array of floats, NaN where missing)
+        for all the trackpoints, including those already built
+        """
+        self.streams[name] = values
+        self.integral = self.integral - set([name])
+        for row, value in zip(self._rows, values.tolist()):
+            if row is not None:
+                row[name] = self._value(name, value)
+
+
+def resample_trackpoints(times, values, integral=(), interval=1.0,
+                         subsecond=False, speed="last"):
+    """
+    Build the trackpoints (see Trackpoints) from record arrays (see
+    record_arrays()), grouping the records into bins of the given interval
+    (in seconds) and reducing the values in each bin: the mean heart rate and cadence, the
+    last position, altitude and distance, and the last, max or mean speed.
+    Each trackpoint has the time of the first record in its bin.
+    Records are only timestamped to the second, so if subsecond is set,
+    several records in the same second are taken to be spread evenly over
+    it (e.g. at 0.25 s intervals for 4 Hz recording), such that intervals
+    of less than a second give sub-second trackpoints.
+    """
+    if speed not in SPEED_REDUCTIONS:
+        raise ValueError("Unknown speed reduction: %s" % speed)
+    n = len(times)
+    if n == 0:
+        return Trackpoints(times, dict(values), integral)
+    order = None
+    if np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind='mergesort')
+        times = times[order]
+
+    # Index of the first record in the same second as each record
+    seconds = np.floor(times)
+    starts = np.flatnonzero(np.r_[True, seconds[1:] != seconds[:-1]])
+    per_second = np.diff(np.r_[starts, n])
+    second_start = np.repeat(starts, per_second)
+    if subsecond:
+        # Spread the records by their rank within the second
+        rank = np.arange(n) - second_start
+        times = times + rank / np.repeat(per_second, per_second).astype(float)
+
+    # Records are grouped by bin, bins being aligned with the FIT epoch
+    # (allowing for rounding, e.g. of thirds of a second)
+    bins = np.floor(times / interval + 1e-9)
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    ends = np.r_[starts[1:], n] - 1
+    index = np.arange(n)
+    # The last value of a bin may be carried from earlier in the same
+    # second, e.g. to a sub-second bin of heart rate records only
+    first_last = np.minimum(starts, second_start[starts])
+
+    columns = {}
+    for field, column in values.items():
+        if order is not None:
+            column = column[order]
+        valid = ~np.isnan(column)
+        reduction = (speed if field == 'speed' else
+                     RESAMPLE_REDUCTIONS.get(field, "last"))
+        if reduction == "mean":
+            counts = np.add.reduceat(valid, starts)
+            sums = np.add.reduceat(np.where(valid, column, 0.0), starts)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = sums / counts
+            if field in integral:
+                result = np.floor(result + 0.5)
+        elif reduction == "max":
+            result = np.fmax.reduceat(column, starts)
+        else:
+            last = np.maximum.accumulate(np.where(valid, index, -1))[ends]
+            result = np.where(last >= first_last,
+                              column[np.maximum(last, 0)], np.nan)
+        columns[field] = result
+
+    return Trackpoints(times[starts], columns, integral)
+
+
+def coalesce_trackpoints(activity, fields=TRACKPOINT_FIELDS, interval=1.0,
+                         subsecond=False, speed="last"):
+    """
+    Build the trackpoints of an activity, sorted by time, with the
+    records in each second (or interval) resampled to a single trackpoint
+    (see resample_trackpoints())
+    """
+    times, values, integral = record_arrays(activity.get_messages('record'),
+                                            fields)
+    return resample_trackpoints(times, values, integral, interval,
+                                subsecond, speed)
+
+
+def find_trackpoint(trackpoints, dt, after=False):
+    """
+    Find the index of the first trackpoint at or after a given time
+    (or strictly after it), in a list of trackpoints sorted by time
+    """
+    lo, hi = 0, len(trackpoints)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        tts = trackpoints[mid]['timestamp']
+        if tts < dt or (after and tts == dt):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def lap_range(trackpoints, start_time, end_time):
+    """
+    Find the range of indices of trackpoints between a lap's start and end
+    times; the trackpoint before the start of the lap is at (first - 1)
+    """
+    return (find_trackpoint(trackpoints, start_time),
+            find_trackpoint(trackpoints, end_time, after=True))
+
+
+def gps_delta(tp, prev):
+    """
+    Calculate distance & speed between two trackpoints from GPS data.
+    Existing distance/speed data (e.g. from footpod) is used when there
+    is no GPS position available or it is bad. If the trackpoints have
+    been through filter_trackpoints(), its distance & speed are used.
+    """
+    if prev['distance'] is None:
+        prev_dist = 0
+    else:
+        prev_dist = prev['distance']
+    if 'gps_distance' in tp:
+        if tp['gps_distance'] is not None:
+            return (tp['gps_distance'], tp['gps_speed'])
+    elif not None in (tp['position_lat'],
+                      tp['position_long'],
+                      prev['position_lat'],
+                      prev['position_long']):
+        try:
+            tp_timedelta = (tp['timestamp'] -
+                            prev['timestamp']).total_seconds()
+            gps_dist = GreatCircleDistance(
+                (tp['position_lat'],
+                 tp['position_long']),
+                (prev['position_lat'],
+                 prev['position_long'])
+            ).meters
+            gps_speed = (gps_dist / tp_timedelta)
+            # Fallback to existing distance/speed stream data
+            # if the GPS data looks erroneous (acceleration test)
+            if (gps_speed / tp_timedelta) <= MAX_ACCELERATION:
+                return (gps_dist, gps_speed)
+        except:
+            # Fallback to existing distance/speed stream data on error
+            pass
+    return (tp['distance'] - prev_dist, tp.get('speed'))
+
+
 def sum_distance(activity,
                  start_time=datetime(1899, 1, 1, 0, 0, 1, tzinfo=utc),
-                 end_time=datetime(2189, 12, 31, 23, 59, 59, tzinfo=utc)):
+                 end_time=datetime(2189, 12, 31, 23, 59, 59, tzinfo=utc),
+                 trackpoints=None):
     """
     Calculate distance from GPS data for an activity
     """
-    # First build tps array (using timestamp as the index)
-    # in order to coalesce values at the same timepoint
-    # under a single trackpoint element
-    tps = {}
-    fit_epoch = datetime(1989, 12, 31, 0, 0, 0, tzinfo=utc)
-    for trackpoint in activity.get_messages('record'):
-        tts = trackpoint.get_value("timestamp")
-        tsi = int((tts - fit_epoch).total_seconds())
-        if tps.get(tsi) is None:
-            tps[tsi] = {
-                'timestamp':        tts,
-                'distance':         None,
-                'position_lat':     None,
-                'position_long':    None}
-        for var in ['distance',
-                    'position_lat',
-                    'position_long']:
-            if trackpoint.get_value(var) is not None:
-                tps[tsi][var] = trackpoint.get_value(var)
-
-    # For mid-activity laps, iterate through trackpoints to
-    # grab the first point before the start of the lap, also
-    # delete points that are not part of the lap
-    prev = None
-    for timestamp in sorted(tps, reverse=True):
-        tp = tps[timestamp]
-        if tp['timestamp'] < start_time and prev is None:
-            prev = copy.copy(tp)
-        if tp['timestamp'] < start_time or tp['timestamp'] > end_time:
-            del tps[timestamp]
+    if trackpoints is None:
+        trackpoints = coalesce_trackpoints(activity)
+
+    # For mid-activity laps, start from the first point
+    # before the start of the lap
+    first, last = lap_range(trackpoints, start_time, end_time)
+    prev = trackpoints[first - 1] if first > 0 else None
 
-    # Then loop over tps array to calculate cumulative point-to-point
-    # distance from GPS data. Existing distance data (e.g. from footpod)
-    # is used when there is no GPS position available or it is bad.
+    # Then loop over the lap's trackpoints to calculate cumulative
+    # point-to-point distance from GPS data
     distance = 0.0
-    for timestamp in sorted(tps):
-        tp = tps[timestamp]
+    for tp in trackpoints[first:last]:
         if prev is not None:
-            if prev['distance'] is None:
-                prev_dist = 0
-            else:
-                prev_dist = prev['distance']
-            if not None in (tp['position_lat'],
-                            tp['position_long'],
-                            prev['position_lat'],
-                            prev['position_long']):
-                try:
-                    tp_timedelta = (tp['timestamp'] -
-                                    prev['timestamp']).total_seconds()
-                    gps_dist = GreatCircleDistance(
-                        (tp['position_lat'],
-                         tp['position_long']),
-                        (prev['position_lat'],
-                         prev['position_long'])
-                    ).meters
-                    gps_speed = (gps_dist / tp_timedelta)
-                    # Fallback to existing distance/speed stream data
-                    # if the GPS data looks erroneous (acceleration test)
-                    if (gps_speed / tp_timedelta) > MAX_ACCELERATION:
-                        gps_dist = tp['distance'] - prev_dist
-                except:
-                    # Fallback to existing distance stream data on error
-                    gps_dist = tp['distance'] - prev_dist
-            else:
-                # Fallback to existing distance stream data if no GPS coords
-                gps_dist = tp['distance'] - prev_dist
-                
-            distance += gps_dist
+            distance += gps_delta(tp, prev)[0]
         prev = tp
 
     return distance
 
 
+def range_stats(times, values, first, last):
+    """
+    Compute the time-weighted average and the maximum of a stream of
+    trackpoint values (NaN where missing) over ranges [first, last) of
+    trackpoints, for all of the ranges at once. Each value is weighted by
+    the time since the previous trackpoint; ranges with no valid values
+    give NaN.
+    """
+    valid = ~np.isnan(values)
+    weights = np.where(valid, np.diff(times, prepend=times[:1]), 0.0)
+    filled = np.where(valid, values, 0.0)
+
+    # Prefix sums, such that the sum over [i, j) is cumulative[j] - cumulative[i]
+    cum_weights = np.concatenate(([0.0], np.cumsum(weights)))
+    cum_weighted = np.concatenate(([0.0], np.cumsum(filled * weights)))
+    cum_count = np.concatenate(([0], np.cumsum(valid)))
+    cum_values = np.concatenate(([0.0], np.cumsum(filled)))
+
+    total_weight = cum_weights[last] - cum_weights[first]
+    count = cum_count[last] - cum_count[first]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Fall back to the plain mean where the values carry no
+        # weight, e.g. a lap with a single trackpoint
+        average = np.where(total_weight > 0,
+                           (cum_weighted[last] - cum_weighted[first]) /
+                           total_weight,
+                           (cum_values[last] - cum_values[first]) / count)
+
+    # Maximum over each range, reducing between interleaved start & end
+    # indices (with a sentinel at the end, so that an end index is valid)
+    padded = np.append(np.where(valid, values, -np.inf), -np.inf)
+    indices = np.empty(2 * len(first), dtype=np.intp)
+    indices[0::2] = first
+    indices[1::2] = last
+    maximum = np.maximum.reduceat(padded, indices)[0::2]
+    maximum[(count == 0) | (last <= first)] = np.nan
+    average[count == 0] = np.nan
+    return average, maximum
+
+
+def great_circle(lat1, lon1, lat2, lon2):
+    """
+    Great circle distances (in m) between arrays of positions (in degrees),
+    NaN where a position is missing
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def local_xy(lat, lon):
+    """
+    Project positions (in degrees, NaN where missing) onto a plane, as x & y
+    in metres from their mean position, which is accurate enough over the
+    extent of an activity
+    """
+    if np.isnan(lat).all():
+        return lat.copy(), lon.copy()
+    lat0, lon0 = np.nanmean(lat), np.nanmean(lon)
+    x = np.radians(lon - lon0) * np.cos(np.radians(lat0)) * EARTH_RADIUS
+    y = np.radians(lat - lat0) * EARTH_RADIUS
+    return x, y
+
+
+def rolling_median(values, window, groups=None):
+    """
+    Centred rolling median of an array over a window of points, ignoring
+    NaN values (the median is NaN where the window has no valid values),
+    and if groups is given (a non-decreasing label for each point), the
+    points in other groups
+    """
+    half = window // 2
+    padded = np.concatenate((np.full(half, np.nan), values,
+                             np.full(window - half - 1, np.nan)))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window)
+    if groups is not None:
+        padded_groups = np.concatenate((np.full(half, -1), groups,
+                                        np.full(window - half - 1, -1)))
+        windows = np.where(np.lib.stride_tricks.sliding_window_view(
+            padded_groups, window) == groups[:, None], windows, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)   # all-NaN windows
+        return np.nanmedian(windows, axis=1)
+
+
+def rolling_mean(values, window, groups=None):
+    """
+    Centred rolling mean of an array over a window of points, ignoring NaN
+    values (the mean is NaN where the window has no valid values), and if
+    groups is given (a non-decreasing label for each point), the points in
+    other groups. Near the ends of the array (or of a group) the window is
+    narrowed evenly on both sides, so that it stays centred.
+    """
+    n = len(values)
+    valid = ~np.isnan(values)
+    cum_values = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    cum_count = np.concatenate(([0], np.cumsum(valid)))
+    index = np.arange(n)
+    if groups is None:
+        start, end = 0, n
+    else:
+        start = np.searchsorted(groups, groups, 'left')
+        end = np.searchsorted(groups, groups, 'right')
+    half = np.minimum(window // 2, np.minimum(index - start, end - 1 - index))
+    first, last = index - half, index + half + 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return ((cum_values[last] - cum_values[first]) /
+                (cum_count[last] - cum_count[first]))
+
+
+def despike(times, lat, lon, max_speed):
+    """
+    Replace teleports - single positions that are implausibly far from both
+    of their neighbours, which are close to each other - with a position
+    interpolated between the neighbours
+    """
+    lat, lon = lat.copy(), lon.copy()
+    if len(times) < 3:
+        return lat, lon
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = great_circle(lat[:-1], lon[:-1], lat[1:], lon[1:]) / np.diff(times)
+        skip_speed = (great_circle(lat[:-2], lon[:-2], lat[2:], lon[2:]) /
+                      (times[2:] - times[:-2]))
+    spikes = np.flatnonzero((speed[:-1] > max_speed) &
+                            (speed[1:] > max_speed) &
+                            (skip_speed <= max_speed)) + 1
+    if len(spikes):
+        lat[spikes] = np.nan
+        valid = ~np.isnan(lat) & ~np.isnan(lon)
+        lat[spikes] = np.interp(times[spikes], times[valid], lat[valid])
+        lon[spikes] = np.interp(times[spikes], times[valid], lon[valid])
+    return lat, lon
+
+
+def associative_scan(combine, elements):
+    """
+    Inclusive scan of elements, given as a tuple of arrays (indexed along
+    their first axis), with an associative combine(earlier, later) that
+    works on whole arrays of elements at once. Adjacent pairs of elements
+    are combined, the pairs are scanned, and the elements in between are
+    then filled in, so the time is linear in the number of elements, in
+    one vectorised step per halving.
+    """
+    n = len(elements[0])
+    if n < 2:
+        return elements
+    pairs = associative_scan(combine,
+                             combine(tuple(e[0:n - 1:2] for e in elements),
+                                     tuple(e[1::2] for e in elements)))
+    between = combine(tuple(p[:(n - 1) // 2] for p in pairs),
+                      tuple(e[2::2] for e in elements))
+    scanned = tuple(np.empty_like(e) for e in elements)
+    for result, e, p, b in zip(scanned, elements, pairs, between):
+        result[0] = e[0]
+        result[1::2] = p
+        result[2::2] = b
+    return scanned
+
+
+def _transpose(a):
+    return np.swapaxes(a, -1, -2)
+
+
+def _dot(*matrices):
+    """Products of arrays of matrices"""
+    product = matrices[0]
+    for matrix in matrices[1:]:
+        product = np.matmul(product, matrix)
+    return product
+
+
+def _inverse(a):
+    """Inverses of an array of 2x2 matrices"""
+    inverse = np.empty_like(a)
+    inverse[..., 0, 0] = a[..., 1, 1]
+    inverse[..., 0, 1] = -a[..., 0, 1]
+    inverse[..., 1, 0] = -a[..., 1, 0]
+    inverse[..., 1, 1] = a[..., 0, 0]
+    return inverse / (a[..., 0, 0] * a[..., 1, 1] -
+                      a[..., 0, 1] * a[..., 1, 0])[..., None, None]
+
+
+def _kalman_filter_combine(earlier, later):
+    """
+    Combine the elements of a parallel Kalman filter (Sarkka & Garcia-
+    Fernandez, Temporal Parallelization of Bayesian Smoothers, 2021), each
+    a tuple (A, b, C, eta, J) of arrays of 2x2 matrices; the columns of b
+    and eta are the x & y axes, which share the other matrices
+    """
+    a1, b1, c1, eta1, j1 = earlier
+    a2, b2, c2, eta2, j2 = later
+    identity = np.eye(2)
+    m = _dot(a2, _inverse(identity + _dot(c1, j2)))
+    n = _dot(_transpose(a1), _inverse(identity + _dot(j2, c1)))
+    return (_dot(m, a1),
+            _dot(m, b1 + _dot(c1, eta2)) + b2,
+            _dot(m, c1, _transpose(a2)) + c2,
+            _dot(n, eta2 - _dot(j2, b1)) + eta1,
+            _dot(n, j2, a1) + j1)
+
+
+def _kalman_smoother_combine(later, earlier):
+    """
+    Combine the elements (E, g) of a parallel Rauch-Tung-Striebel smoother,
+    which are scanned backwards from the last point
+    """
+    e_later, g_later = later
+    e_earlier, g_earlier = earlier
+    return _dot(e_earlier, e_later), _dot(e_earlier, g_later) + g_earlier
+
+
+def kalman_smooth(times, x, y, valid):
+    """
+    Constant velocity Kalman filter with a Rauch-Tung-Striebel smoother,
+    over positions x & y (in m) at the given times, using the positions
+    where valid is set. Returns the smoothed positions and velocities as
+    arrays (x, y, vx, vy), NaN before the first valid position.
+
+    The filter and the smoother are each run over the whole track at once,
+    as associative scans (see associative_scan()), so the time is linear in
+    the number of points. A position that is too far (more than
+    GPS_KALMAN_GATE standard deviations) from where the filter predicted it
+    is ignored as an outlier, and the track is filtered again without the
+    outliers, for up to GPS_KALMAN_PASSES passes.
+    """
+    n = len(times)
+    result = tuple(np.full(n, np.nan) for _ in range(4))
+    if not valid.any():
+        return result
+    start = int(np.argmax(valid))
+    positions = np.stack((x[start:], y[start:]), axis=-1)
+    valid = valid[start:]
+    r = GPS_POSITION_NOISE ** 2
+    q = GPS_ACCELERATION_NOISE ** 2
+
+    # Transition and process noise for each step, with both axes sharing
+    # the same 2x2 matrices over (position, velocity)
+    dt = np.diff(times[start:])
+    steps = len(dt)
+    transition = np.zeros((steps, 2, 2))
+    transition[:, 0, 0] = transition[:, 1, 1] = 1.0
+    transition[:, 0, 1] = dt
+    noise = np.empty((steps, 2, 2))
+    noise[:, 0, 0] = q * dt ** 4 / 4
+    noise[:, 0, 1] = noise[:, 1, 0] = q * dt ** 3 / 2
+    noise[:, 1, 1] = q * dt ** 2
+
+    # The filter starts at the first position, at rest
+    first = (np.zeros((1, 2, 2)),
+             np.array([[positions[0], [0.0, 0.0]]]),
+             np.array([[[r, 0.0], [0.0, 100.0]]]),
+             np.zeros((1, 2, 2)),
+             np.zeros((1, 2, 2)))
+
+    used = valid.copy()
+    for _ in range(GPS_KALMAN_PASSES):
+        # Filter elements for each step, which update the state with the
+        # position where it's used (and otherwise just predict it)
+        inv_s = np.where(used[1:], 1.0 / (noise[:, 0, 0] + r), 0.0)
+        measured = np.where(used[1:, None], positions[1:], 0.0)
+        gain = noise[:, :, 0] * inv_s[:, None]
+        update = np.eye(2) - gain[:, :, None] * np.array([1.0, 0.0])
+        observed = transition[:, 0, :]
+        elements = (_dot(update, transition),
+                    gain[:, :, None] * measured[:, None, :],
+                    _dot(update, noise),
+                    observed[:, :, None] * measured[:, None, :] * inv_s[:, None, None],
+                    observed[:, :, None] * observed[:, None, :] * inv_s[:, None, None])
+        _, means, covariances, _, _ = associative_scan(
+            _kalman_filter_combine,
+            tuple(np.concatenate((f, e)) for f, e in zip(first, elements)))
+
+        # Predicted states & covariances, and the positions that are
+        # outliers from their predictions
+        predicted = _dot(transition, means[:-1])
+        predicted_cov = (_dot(transition, covariances[:-1], _transpose(transition)) +
+                         noise)
+        innovation = positions[1:] - predicted[:, 0, :]
+        with np.errstate(invalid='ignore'):
+            outliers = (valid[1:] &
+                        ((innovation ** 2).sum(axis=1) /
+                         (predicted_cov[:, 0, 0] + r) > GPS_KALMAN_GATE ** 2))
+        previous, used = used, valid & ~np.concatenate(([False], outliers))
+        if (used == previous).all():
+            break
+
+    # Smoother elements for each point, scanned backwards from the last
+    smoother_gain = _dot(covariances[:-1], _transpose(transition),
+                         _inverse(predicted_cov))
+    offsets = means[:-1] - _dot(smoother_gain, transition, means[:-1])
+    elements = (np.concatenate((smoother_gain, np.zeros((1, 2, 2))))[::-1],
+                np.concatenate((offsets, means[-1:]))[::-1])
+    _, smoothed = associative_scan(_kalman_smoother_combine, elements)
+    smoothed = smoothed[::-1]
+    for stream, values in zip(result, (smoothed[:, 0, 0], smoothed[:, 0, 1],
+                                       smoothed[:, 1, 0], smoothed[:, 1, 1])):
+        stream[start:] = values
+    return result
+
+
+def filter_gps(times, lat, lon, mode="median", max_speed=MAX_GPS_SPEED['Other']):
+    """
+    Filter the GPS track of an activity, given as arrays of times (in
+    seconds) and positions (in degrees, NaN where missing), returning
+    arrays of the distance (in m) and speed (in m/s) from the previous
+    point to each point, NaN where there is no usable GPS data (the first
+    point, and steps to or from a missing position), for which the footpod
+    values are used instead.
+
+    The 'median' filter replaces teleports (see despike()), and smooths
+    the positions with a rolling median (which drops any remaining spikes)
+    and then a rolling mean over GPS_SMOOTH_WINDOW points, so that the
+    noise in the positions doesn't add to the distance. The speed of each
+    step is compared with the rolling median of the speeds around it: the
+    median is used as the speed, and also for the distance of steps that
+    are implausibly fast or would need more than MAX_ACCELERATION to reach
+    from the median (i.e. GPS jumps). The 'kalman' filter instead smooths
+    the positions with a constant velocity Kalman smoother, which ignores
+    outlying positions, and uses the smoothed positions and velocities.
+    Both run over whole arrays, in time linear in the number of points.
+    """
+    n = len(times)
+    distance = np.full(n, np.nan)
+    speed = np.full(n, np.nan)
+    if n < 2 or mode == "none":
+        return distance, speed
+    dt = np.diff(times)
+    missing = np.isnan(lat) | np.isnan(lon)
+    steps = ~missing[:-1] & ~missing[1:] & (dt > 0)
+
+    if mode == "kalman":
+        x, y = local_xy(lat, lon)
+        x, y, vx, vy = kalman_smooth(times, x, y, ~missing)
+        distance[1:] = np.where(steps, np.hypot(np.diff(x), np.diff(y)), np.nan)
+        speed[1:] = np.where(steps, np.hypot(vx[1:], vy[1:]), np.nan)
+        return distance, speed
+
+    lat, lon = despike(times, lat, lon, max_speed)
+    with np.errstate(invalid='ignore'):
+        jumps = (great_circle(lat[:-1], lon[:-1], lat[1:], lon[1:]) >
+                 max_speed * dt + GPS_JUMP_DISTANCE)
+
+    # Smooth the positions between the jumps
+    groups = np.concatenate(([0], np.cumsum(jumps)))
+    x, y = local_xy(lat, lon)
+    x = rolling_mean(rolling_median(x, GPS_MEDIAN_WINDOW, groups),
+                     GPS_SMOOTH_WINDOW, groups)
+    y = rolling_mean(rolling_median(y, GPS_MEDIAN_WINDOW, groups),
+                     GPS_SMOOTH_WINDOW, groups)
+    step_distance = np.hypot(np.diff(x), np.diff(y))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        step_speed = np.where(steps, step_distance / dt, np.nan)
+    jumps |= step_speed > max_speed
+    median = rolling_median(np.where(jumps, np.nan, step_speed),
+                            GPS_MEDIAN_WINDOW)
+    with np.errstate(invalid='ignore'):
+        outliers = jumps | (np.abs(step_speed - median) / dt > MAX_ACCELERATION)
+    distance[1:] = np.where(outliers, median * dt, step_distance)
+    speed[1:] = median
+    distance[1:][~steps] = np.nan
+    speed[1:][~steps] = np.nan
+    return distance, speed
+
+
+def gps_filter_mode(sport, gps_filter=None):
+    """
+    The GPS filter mode for a sport, from a dict of sports and modes
+    (default: GPS_FILTERS)
+    """
+    if gps_filter is None:
+        gps_filter = GPS_FILTERS
+    return gps_filter.get(sport, GPS_FILTERS.get(sport, "median"))
+
+
+def parse_gps_filter(values):
+    """
+    Parse GPS filter settings of the form MODE (for all sports) or
+    SPORT=MODE into a dict of sports and modes
+    """
+    gps_filter = dict(GPS_FILTERS)
+    for value in values or []:
+        if "=" in value:
+            sport, mode = value.split("=", 1)
+            sports = [s for s in GPS_FILTERS if s.lower() == sport.lower()]
+            if not sports:
+                raise ValueError("unknown sport for GPS filter: {sport!s} "
+                                 "(choose from {sports!s})".format(
+                                     sport=sport, sports=", ".join(sorted(GPS_FILTERS))))
+        else:
+            sports, mode = list(GPS_FILTERS), value
+        if mode not in GPS_FILTER_MODES:
+            raise ValueError("unknown GPS filter: {mode!s} (choose from {modes!s})".format(
+                mode=mode, modes=", ".join(GPS_FILTER_MODES)))
+        for sport in sports:
+            gps_filter[sport] = mode
+    return gps_filter
+
+
+def filter_trackpoints(trackpoints, sport, gps_filter=None):
+    """
+    Filter the GPS data of trackpoints (see Trackpoints and filter_gps()),
+    storing the distance & speed from the previous trackpoint of each
+    trackpoint as its gps_distance & gps_speed (None where the footpod
+    values should be used), for gps_delta()
+    """
+    mode = gps_filter_mode(sport, gps_filter)
+    if mode == "none" or not trackpoints:
+        return
+    distance, speed = filter_gps(trackpoints.seconds(),
+                                 trackpoints.stream('position_lat'),
+                                 trackpoints.stream('position_long'),
+                                 mode,
+                                 MAX_GPS_SPEED.get(sport, MAX_GPS_SPEED['Other']))
+    trackpoints.set_stream('gps_distance', distance)
+    trackpoints.set_stream('gps_speed', speed)
+
+
+def douglas_peucker(x, y, tolerance, fixed):
+    """
+    Douglas-Peucker simplification of a line of points x & y (in m),
+    keeping the fixed points (sorted indices, including the first and last
+    points) and any point further than tolerance from the simplified line.
+    Each split is vectorised; the time is O(n log n) for GPS tracks (the
+    worst case is O(n^2), for a line that spirals in on itself).
+    """
+    keep = np.zeros(len(x), dtype=bool)
+    keep[fixed] = True
+    stack = list(zip(fixed[:-1], fixed[1:]))
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        px, py = x[a + 1:b] - x[a], y[a + 1:b] - y[a]
+        length = np.hypot(dx, dy)
+        if length > 0:
+            offsets = np.abs(px * dy - py * dx) / length
+        else:
+            offsets = np.hypot(px, py)
+        i = int(np.argmax(offsets))
+        if offsets[i] > tolerance:
+            m = a + 1 + i
+            keep[m] = True
+            stack.append((a, m))
+            stack.append((m, b))
+    return keep
+
+
+def visvalingam(x, y, tolerance, fixed):
+    """
+    Visvalingam-Whyatt simplification of a line of points x & y (in m),
+    repeatedly dropping the point that makes the smallest triangle with
+    its neighbours, until every triangle has an area of at least
+    tolerance^2, and keeping the fixed points (sorted indices, including
+    the first and last points). Uses a heap, so the time is O(n log n).
+    """
+    n = len(x)
+    xs, ys = x.tolist(), y.tolist()
+    prev = list(range(-1, n - 1))
+    nxt = list(range(1, n + 1))
+    removable = [True] * n
+    for i in fixed:
+        removable[i] = False
+    threshold = tolerance * tolerance
+
+    def area(i):
+        p, q = prev[i], nxt[i]
+        return abs((xs[p] - xs[i]) * (ys[q] - ys[i]) -
+                   (xs[q] - xs[i]) * (ys[p] - ys[i])) / 2
+
+    areas = [None] * n
+    heap = []
+    for i in range(n):
+        if removable[i]:
+            areas[i] = area(i)
+            heap.append((areas[i], i))
+    heapq.heapify(heap)
+    keep = [True] * n
+    while heap:
+        a, i = heapq.heappop(heap)
+        if not keep[i] or a != areas[i]:
+            continue    # stale entry
+        if a >= threshold:
+            break
+        keep[i] = False
+        p, q = prev[i], nxt[i]
+        nxt[p], prev[q] = q, p
+        # The neighbours' areas can't drop below the area just removed,
+        # so that points are removed in order of significance
+        for j in (p, q):
+            if removable[j] and keep[j]:
+                areas[j] = max(area(j), a)
+                heapq.heappush(heap, (areas[j], j))
+    return np.array(keep, dtype=bool)
+
+
+def decimate(times, distances, lat, lon, boundaries, mode, tolerance):
+    """
+    Choose the trackpoints to keep when decimating a track, as a boolean
+    array. times (in s), distances (cumulative, in m) and positions (in
+    degrees, NaN where missing) are arrays over the trackpoints, and the
+    boundaries (e.g. the first and last trackpoint of each lap) are always
+    kept. The modes are:
+      interval:         the first trackpoint in each tolerance seconds
+      distance:         the first trackpoint in each tolerance metres
+      douglas-peucker:  see douglas_peucker(), tolerance in metres
+      visvalingam:      see visvalingam(), tolerance in metres
+    With the two line simplification modes, trackpoints without a position
+    are kept.
+    """
+    n = len(times)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[[0, n - 1]] = True
+    keep[boundaries] = True
+    if mode in ("interval", "distance"):
+        values = times if mode == "interval" else distances
+        buckets = np.floor(values / tolerance)
+        keep[1:] |= np.diff(buckets) != 0
+        return keep
+
+    missing = np.isnan(lat) | np.isnan(lon)
+    keep |= missing
+    positioned = np.flatnonzero(~missing)
+    if len(positioned) == 0:
+        return keep
+    x, y = local_xy(lat[positioned], lon[positioned])
+    # Indices (within the positioned points) that must be kept
+    fixed = np.flatnonzero(keep[positioned])
+    fixed = np.union1d(fixed, [0, len(positioned) - 1])
+    if mode == "douglas-peucker":
+        kept = douglas_peucker(x, y, tolerance, fixed)
+    else:
+        kept = visvalingam(x, y, tolerance, fixed)
+    keep[positioned[kept]] = True
+    return keep
+
+
 def create_element(tag, text=None, namespace=None):
     """Create a free element"""
     namespace = NSMAP[namespace]
@@ -344,6 +1583,14 @@ def create_sub_element(parent, tag, text=None, namespace=None):
     return element
 
 
+def create_extension_element(parent, tag, text=None):
+    """Create an activity extension element as a child of an existing given element"""
+    element = lxml.etree.SubElement(parent, AX + tag, nsmap=EXTENSION_NSMAP)
+    if text is not None:
+        element.text = text
+    return element
+
+
 def create_document():
     """Create a TCX XML document"""
     document = create_element("TrainingCenterDatabase")
@@ -426,19 +1673,150 @@ def add_trackpoint(element, trackpoint, sport):
             # not an extension, unlike running cadence (below)
             create_sub_element(element, "Cadence", str(cadence))
         exelem = create_sub_element(element, "Extensions")
-        tpx = create_sub_element(exelem, "TPX")
-        tpx.set("xmlns",
-                "http://www.garmin.com/xmlschemas/ActivityExtension/v2")
+        tpx = create_extension_element(exelem, "TPX")
         if speed is not None:
-            create_sub_element(tpx, "Speed", str(speed))
+            create_extension_element(tpx, "Speed", str(speed))
         if cadence is not None:
             if sport == "Running":
                 tpx.set("CadenceSensor", "Footpod")
-                create_sub_element(tpx, "RunCadence", str(cadence))
+                create_extension_element(tpx, "RunCadence", str(cadence))
             elif sport == "Biking":
                 tpx.set("CadenceSensor", "Bike")
 
 
+def cal_factor_text(current_cal_factor, recorded_cal_factor=None):
+    """
+    The calibration factor setting for the notes, followed by the setting
+    when the activity was recorded if that is given and different (as for
+    an activity that has been recalibrated to a new factor)
+    """
+    text = "{cf:.1f}%".format(cf=current_cal_factor)
+    if (recorded_cal_factor is not None and
+            "{cf:.1f}%".format(cf=recorded_cal_factor) != text):
+        text += " ({cf:.1f}% when recorded)".format(cf=recorded_cal_factor)
+    return text
+
+
+def lap_notes(lap_num,
+              distance_used,
+              totaltime,
+              stored_distance,
+              calculated_distance,
+              fixed_distance,
+              current_cal_factor,
+              new_cal_factor=None,
+              recorded_cal_factor=None):
+    """
+    Format the notes text summarising a lap; the new calibration factor is
+    worked out from the distances unless given (see also cal_factor_text())
+    """
+    if fixed_distance is not None:
+        reference_distance = fixed_distance
+        precision_str = ("; known distance: {ref_dist:.3f} km "
+                         "(FIT precision: {fit_precision:.1f}%; "
+                         "GPS/footpod precision: {gps_precision:.1f}%)")
+        reference = "known distance"
+    else:
+        reference_distance = calculated_distance
+        precision_str = " (precision: {precision:.1f}%)"
+        reference = "GPS/footpod"
+    try:
+        lap_scaling_factor = reference_distance / stored_distance
+    except ZeroDivisionError:
+        lap_scaling_factor = 1.00
+    try:
+        fit_precision_calc = (1 - (abs(reference_distance -
+                                              stored_distance) /
+                                          reference_distance)) * 100
+        gps_precision_calc = (1 - (abs(reference_distance -
+                                              calculated_distance) /
+                                          reference_distance)) * 100
+        precision_calc = (1 - (abs(calculated_distance -
+                                              stored_distance) /
+                                          calculated_distance)) * 100
+    except ZeroDivisionError:
+        fit_precision_calc = 100
+        gps_precision_calc = 100
+        precision_calc = 100
+    return ("Lap {lap_number:d}: {distance_used:.3f} km in {total_time!s}\n"
+            "Distance in FIT file: {fit_dist:.3f} km; "
+            "calculated via GPS/footpod: {gps_dist:.3f} km"
+            + precision_str + "\n"
+            "Footpod calibration factor setting: {old_cf!s}; "
+            "new factor based on {reference} for this lap: {new_cf:.1f}%"
+            ).format(lap_number=lap_num,
+                     distance_used=distance_used / 1000,
+                     total_time=timedelta(seconds=int(totaltime)),
+                     fit_dist=stored_distance / 1000,
+                     gps_dist=calculated_distance / 1000,
+                     ref_dist=reference_distance / 1000,
+                     fit_precision=fit_precision_calc,
+                     gps_precision=gps_precision_calc,
+                     precision=precision_calc,
+                     old_cf=cal_factor_text(current_cal_factor,
+                                            recorded_cal_factor),
+                     reference=reference,
+                     new_cf=(lap_scaling_factor * current_cal_factor
+                             if new_cal_factor is None else new_cal_factor))
+
+
+def lap_scaling_factors(calculated_distance,
+                        stored_distance,
+                        fixed_distance,
+                        calibrate,
+                        per_lap_cal,
+                        activity_scaling_factor):
+    """
+    The scaling factor of a lap's stored distance to its calculated (or
+    fixed) distance, and the scaling factor used for its trackpoints
+    """
+    if fixed_distance is not None:
+        reference_distance = fixed_distance
+    else:
+        reference_distance = calculated_distance
+    try:
+        lap_scaling_factor = reference_distance / stored_distance
+    except ZeroDivisionError:
+        lap_scaling_factor = 1.00
+    if calibrate and per_lap_cal:
+        return (lap_scaling_factor, lap_scaling_factor)
+    return (lap_scaling_factor, activity_scaling_factor)
+
+
+def lap_step(gps_dist,
+             gps_speed,
+             footpod_dist,
+             speed,
+             dist_recalc,
+             speed_recalc,
+             calibrate,
+             scaling_factor):
+    """
+    The distance and speed of a trackpoint from the previous one, as added
+    to the lap totals: recalculated from GPS, calibrated or as recorded.
+    The distance is None if the step doesn't count towards the totals
+    (when calibrating a speed that wasn't recorded), and the speed is None
+    if there isn't one.
+    """
+    if dist_recalc:
+        tp_dist = gps_dist
+    elif calibrate:
+        tp_dist = footpod_dist * scaling_factor
+    else:
+        tp_dist = footpod_dist
+    if speed_recalc:
+        tp_speed = gps_speed
+    elif calibrate:
+        if speed is None:
+            return (None, None)
+        tp_speed = speed * scaling_factor
+    else:
+        tp_speed = speed
+    if tp_dist is None:
+        return (None, None)
+    return (tp_dist, tp_speed)
+
+
 def add_lap(element,
             activity,
             lap,
@@ -450,8 +1828,18 @@ def add_lap(element,
             per_lap_cal,
             fixed_distance,
             activity_scaling_factor,
-            total_cumulative_distance):
-    """Add a lap element to a TCX document"""
+            total_cumulative_distance,
+            trackpoints=None,
+            lap_stats=None,
+            keep=None):
+    """
+    Add a lap element to a TCX document. Heart rate and cadence are taken
+    from lap_stats instead of the FIT lap message, if given (calories are
+    always taken from the lap message, see PreparedActivity.stats()).
+    If keep is given (an array of flags, one per trackpoint), only the
+    trackpoints that are flagged are added, though the lap totals are
+    still computed from all of them.
+    """
 
     # Only process laps with timestamps - this serves as a workaround for
     # extra fake/empty laps in FIT files from the Timex Run Trainer 2.0
@@ -463,22 +1851,22 @@ def add_lap(element,
         end_time = lap.get_value("timestamp")
         totaltime = lap.get_value("total_elapsed_time")
 
-        stored_distance = lap.get_value("total_distance")
-        calculated_distance = sum_distance(activity, start_time, end_time)
-
-        if fixed_distance is not None:
-            reference_distance = fixed_distance
-        else:
-            reference_distance = calculated_distance
+        if trackpoints is None:
+            trackpoints = coalesce_trackpoints(activity)
 
-        try:
-            lap_scaling_factor = reference_distance / stored_distance
-        except ZeroDivisionError:
-            lap_scaling_factor = 1.00
-        if calibrate and per_lap_cal:
-            scaling_factor = lap_scaling_factor
-        else:
-            scaling_factor = activity_scaling_factor
+        stored_distance = lap.get_value("total_distance")
+        calculated_distance = sum_distance(activity,
+                                           start_time,
+                                           end_time,
+                                           trackpoints)
+
+        lap_scaling_factor, scaling_factor = lap_scaling_factors(
+            calculated_distance,
+            stored_distance,
+            fixed_distance,
+            calibrate,
+            per_lap_cal,
+            activity_scaling_factor)
 
         max_speed = lap.get_value("max_speed")
         avg_speed = lap.get_value("avg_speed")
@@ -493,6 +1881,13 @@ def add_lap(element,
         avg_cadence = lap.get_value("avg_cadence")
         max_cadence = lap.get_value("max_cadence")
 
+        # Use summary values recomputed from the trackpoints, if given
+        if lap_stats is not None:
+            avg_heart = lap_stats['avg_heart_rate']
+            max_heart = lap_stats['max_heart_rate']
+            avg_cadence = lap_stats['avg_cadence']
+            max_cadence = lap_stats['max_cadence']
+
         if lap.get_value("lap_trigger"):
             triggermet = LAP_TRIGGER_MAP[lap.get_value("lap_trigger")]
         else:
@@ -587,43 +1982,10 @@ def add_lap(element,
         # Track
         #
         trackelem = create_sub_element(lapelem, "Track")
-        # First build tps array (using timestamp as the index)
-        # in order to coalesce values at the same timepoint
-        # under a single trackpoint element
-        tps = {}
-        fit_epoch = datetime(1989, 12, 31).replace(tzinfo=utc)
-        for trackpoint in activity.get_messages('record'):
-            tts = trackpoint.get_value("timestamp")
-            tsi = int((tts - fit_epoch).total_seconds())
-            if tps.get(tsi) is None:
-                tps[tsi] = {
-                    'timestamp':        tts,
-                    'cadence':          None,
-                    'distance':         None,
-                    'position_lat':     None,
-                    'position_long':    None,
-                    'heart_rate':       None,
-                    'altitude':         None,
-                    'speed':            None}
-            for var in ['cadence',
-                        'distance',
-                        'position_lat',
-                        'position_long',
-                        'heart_rate',
-                        'altitude',
-                        'speed']:
-                if trackpoint.get_value(var) is not None:
-                    tps[tsi][var] = trackpoint.get_value(var)
-
-        # Iterate through all trackpoints to grab the first point before the
-        # start of the lap, then delete points that are not part of the lap
-        prev = None
-        for timestamp in sorted(tps, reverse=True):
-            tp = tps[timestamp]
-            if tp['timestamp'] < start_time and prev is None:
-                prev = copy.copy(tp)
-            if tp['timestamp'] < start_time or tp['timestamp'] > end_time:
-                del tps[timestamp]
+        # Grab the first point before the start of the lap,
+        # and the points that are part of the lap
+        first, last = lap_range(trackpoints, start_time, end_time)
+        prev = copy.copy(trackpoints[first - 1]) if first > 0 else None
 
         # Then process all trackpoints for this lap, recalculating speed &
         # distance from GPS and adjusting if requested, before adding element
@@ -632,55 +1994,27 @@ def add_lap(element,
         distance = 0.0
         max_speed = 0.0
         tp_speed = None
-        for timestamp in sorted(tps):
-            tp = tps[timestamp]
-            trackpointelem = create_sub_element(trackelem, "Trackpoint")
+        for i, tp in enumerate(trackpoints[first:last], first):
+            # Copy the trackpoint, since its values are adjusted below
+            tp = copy.copy(tp)
             if prev is not None:
                 if prev['distance'] is None:
                     prev['distance'] = 0
-                try:
-                    tp_timedelta = (tp['timestamp'] -
-                                    prev['timestamp']).total_seconds()
-                    gps_dist = GreatCircleDistance(
-                        (tp['position_lat'],
-                         tp['position_long']),
-                        (prev['position_lat'],
-                         prev['position_long'])
-                    ).meters
-                    gps_speed = (gps_dist / tp_timedelta)
-                    # Fallback to existing distance/speed stream data
-                    # if the GPS data looks erroneous (acceleration test)
-                    if (gps_speed / tp_timedelta) > MAX_ACCELERATION:
-                        gps_speed = tp['speed']
-                        gps_dist = tp['distance'] - prev['distance']
-                except:
-                    gps_speed = tp['speed']
-                    gps_dist = tp['distance'] - prev['distance']
-
-                if dist_recalc:
-                    tp_dist = gps_dist
-                elif calibrate:
-                    tp_dist = (
-                        tp['distance'] - prev['distance']) * scaling_factor
-                else:
-                    tp_dist = tp['distance'] - prev['distance']
-
-                try:
-                    if speed_recalc:
-                        tp_speed = gps_speed
-                    elif calibrate:
-                        tp_speed = tp['speed'] * scaling_factor
-                    else:
-                        tp_speed = tp['speed']
-
+                gps_dist, gps_speed = gps_delta(tp, prev)
+                tp_dist, tp_speed = lap_step(gps_dist,
+                                             gps_speed,
+                                             tp['distance'] - prev['distance'],
+                                             tp['speed'],
+                                             dist_recalc,
+                                             speed_recalc,
+                                             calibrate,
+                                             scaling_factor)
+                if tp_dist is not None:
                     total_cumulative_distance += tp_dist
                     distance += tp_dist
-                    if tp_speed > max_speed:
+                    if tp_speed is not None and tp_speed > max_speed:
                         max_speed = tp_speed
 
-                except TypeError:
-                    tp_speed = None
-
             # Store previous trackpoint before changing the current one
             prev = copy.copy(tp)
 
@@ -694,53 +2028,22 @@ def add_lap(element,
                     and tp_speed is not None):
                 tp['speed'] = "{:.3f}".format(tp_speed)
 
-            # Add trackpoint element
-            add_trackpoint(trackpointelem, tp, sport)
+            # Add trackpoint element, unless decimated
+            if keep is None or keep[i]:
+                trackpointelem = create_sub_element(trackelem, "Trackpoint")
+                add_trackpoint(trackpointelem, tp, sport)
 
 
         #
         # Notes
         #
-        if fixed_distance is not None:
-            precision_str = ("; known distance: {ref_dist:.3f} km "
-                             "(FIT precision: {fit_precision:.1f}%; "
-                             "GPS/footpod precision: {gps_precision:.1f}%)")
-            reference = "known distance"
-        else:
-            precision_str = " (precision: {precision:.1f}%)"
-            reference = "GPS/footpod"
-        try:
-            fit_precision_calc = (1 - (abs(reference_distance -
-                                                  stored_distance) /
-                                              reference_distance)) * 100
-            gps_precision_calc = (1 - (abs(reference_distance -
-                                                  calculated_distance) /
-                                              reference_distance)) * 100
-            precision_calc = (1 - (abs(calculated_distance -
-                                                  stored_distance) /
-                                              calculated_distance)) * 100
-        except ZeroDivisionError:
-            fit_precision_calc = 100
-            gps_precision_calc = 100
-            precision_calc = 100
-        notes = ("Lap {lap_number:d}: {distance_used:.3f} km in {total_time!s}\n"
-                 "Distance in FIT file: {fit_dist:.3f} km; "
-                 "calculated via GPS/footpod: {gps_dist:.3f} km"
-                 + precision_str + "\n"
-                 "Footpod calibration factor setting: {old_cf:.1f}%; "
-                 "new factor based on {reference} for this lap: {new_cf:.1f}%"
-                 ).format(lap_number=lap_num,
-                          distance_used=distance_used / 1000,
-                          total_time=timedelta(seconds=int(totaltime)),
-                          fit_dist=stored_distance / 1000,
-                          gps_dist=calculated_distance / 1000,
-                          ref_dist=reference_distance / 1000,
-                          fit_precision=fit_precision_calc,
-                          gps_precision=gps_precision_calc,
-                          precision=precision_calc,
-                          old_cf=current_cal_factor,
-                          reference=reference,
-                          new_cf=lap_scaling_factor * current_cal_factor)
+        notes = lap_notes(lap_num,
+                          distance_used,
+                          totaltime,
+                          stored_distance,
+                          calculated_distance,
+                          fixed_distance,
+                          current_cal_factor)
         add_notes(lapelem, notes)
 
 
@@ -749,26 +2052,23 @@ def add_lap(element,
         #
         if not all(var is None for var in (avg_speed, avg_cadence, max_cadence)):
             exelem = create_sub_element(lapelem, "Extensions")
-            lx = create_sub_element(exelem, "LX")
-            lx.set("xmlns",
-                   "http://www.garmin.com/xmlschemas/ActivityExtension/v2")
+            lx = create_extension_element(exelem, "LX")
             if avg_speed is not None:
-                lap_avg_spd_elem = create_sub_element(lx,
-                                                      "AvgSpeed",
-                                                      str("%.3f" % avg_speed))
+                lap_avg_spd_elem = create_extension_element(
+                    lx, "AvgSpeed", str("%.3f" % avg_speed))
             if avg_cadence is not None and sport == "Running":
-                create_sub_element(lx,
-                                   "AvgRunCadence",
-                                   str("%d" % avg_cadence))
+                create_extension_element(lx,
+                                         "AvgRunCadence",
+                                         str("%d" % avg_cadence))
             if max_cadence is not None:
                 if sport == "Running":
-                    create_sub_element(lx,
-                                       "MaxRunCadence",
-                                       str("%d" % max_cadence))
+                    create_extension_element(lx,
+                                             "MaxRunCadence",
+                                             str("%d" % max_cadence))
                 elif sport == "Biking":
-                    create_sub_element(lx,
-                                       "MaxBikeCadence",
-                                       str("%d" % max_cadence))
+                    create_extension_element(lx,
+                                             "MaxBikeCadence",
+                                             str("%d" % max_cadence))
 
         # Adjust overall lap distance & speed values if required
         if calibrate:
@@ -806,13 +2106,23 @@ def add_activity(element,
                  current_cal_factor,
                  per_lap_cal,
                  manual_lap_distance,
-                 activity_scaling_factor):
-    """Add an activity to a TCX document"""
+                 activity_scaling_factor,
+                 trackpoints=None,
+                 lap_offsets=None,
+                 lap_workers=1,
+                 lap_stats=None,
+                 keep=None):
+    """
+    Add an activity to a TCX document. Laps are built in parallel worker
+    processes if lap_workers > 1 and the cumulative distance at the start
+    of each lap is given in lap_offsets. Lap summary values recomputed from
+    the trackpoints can be given in lap_stats (a list, with one item per lap),
+    and the trackpoints to keep when decimating in keep (see add_lap()).
+    """
 
     # Sport type
     sport = session.get_value("sport")
-    sport_mapping = {"running": "Running", "cycling": "Biking"}
-    sport = sport_mapping[sport] if sport in sport_mapping else "Other"
+    sport = SPORT_MAP[sport] if sport in SPORT_MAP else "Other"
 
     actelem = create_sub_element(element, "Activity")
     actelem.set("Sport", sport)
@@ -820,8 +2130,13 @@ def add_activity(element,
                        "Id",
                        iso_Z_format(session.get_value("start_time")))
 
+    # Build the trackpoints once, rather than for every lap
+    if trackpoints is None:
+        trackpoints = coalesce_trackpoints(activity)
+
     total_cumulative_distance = 0.0
     lap_num = 0
+    lap_tasks = []
     for lap in activity.get_messages('lap'):
         if lap.get_value("start_time") == lap.get_value("timestamp"):
             continue    # skip very short laps that won't have any data
@@ -832,6 +2147,36 @@ def add_activity(element,
                 fixed_dist = None
         else:
             fixed_dist = None
+        if lap_stats is not None:
+            stats = lap_stats[lap_num]
+        else:
+            stats = None
+        if lap_workers > 1 and lap_offsets is not None:
+            # Each worker gets the lap's trackpoints (and the one before)
+            if lap.get_value('timestamp') is not None:
+                first, last = lap_range(trackpoints,
+                                        lap.get_value("start_time"),
+                                        lap.get_value("timestamp"))
+                lap_trackpoints = trackpoints[max(first - 1, 0):last]
+                lap_keep = None if keep is None else keep[max(first - 1, 0):last]
+            else:
+                lap_trackpoints = []
+                lap_keep = None
+            lap_tasks.append((MessageValues.from_message(lap, LAP_FIELDS),
+                              lap_trackpoints,
+                              sport,
+                              dist_recalc,
+                              speed_recalc,
+                              calibrate,
+                              current_cal_factor,
+                              per_lap_cal,
+                              fixed_dist,
+                              activity_scaling_factor,
+                              lap_offsets[lap_num],
+                              stats,
+                              lap_keep))
+            lap_num += 1
+            continue
         lap_dist = add_lap(actelem,
                            activity,
                            lap,
@@ -843,26 +2188,93 @@ def add_activity(element,
                            per_lap_cal,
                            fixed_dist,
                            activity_scaling_factor,
-                           total_cumulative_distance)
+                           total_cumulative_distance,
+                           trackpoints,
+                           stats,
+                           keep)
         total_cumulative_distance += lap_dist
         lap_num += 1
 
+    if lap_tasks:
+        pool = multiprocessing.Pool(lap_workers)
+        try:
+            laps = pool.map(build_lap, lap_tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+        # Assemble laps in order
+        for lapxml, lap_dist in laps:
+            if lapxml is not None:
+                actelem.append(lxml.etree.fromstring(lapxml))
+            total_cumulative_distance += lap_dist
+
     return (actelem, total_cumulative_distance)
 
 
-def convert(filename,
-            time_zone="auto",
-            dist_recalc=False,
-            speed_recalc=False,
-            calibrate=False,
-            per_lap_cal=False,
-            manual_lap_distance=None,
-            current_cal_factor=100.0):
-    """Convert a FIT file to TCX format"""
+class MessageValues(dict):
+
+    """
+    Field values of a FIT message, which can be passed to worker processes
+    in place of the message
+    """
+
+    @classmethod
+    def from_message(cls, message, fields):
+        return cls((field, message.get_value(field)) for field in fields)
+
+    def get_value(self, name):
+        return self.get(name)
+
 
+class MessageLog(dict):
+
+    """
+    Messages kept by type, in place of a FitFile (e.g. for device_info())
+    """
+
+    def get_messages(self, name):
+        return iter(self.get(name, []))
+
+
+def build_lap(task):
+    """
+    Build a lap element in a worker process, returning the serialized
+    element (or None if the lap is skipped) and the lap distance
+    """
+    (lap, trackpoints, sport, dist_recalc, speed_recalc, calibrate,
+     current_cal_factor, per_lap_cal, fixed_distance, activity_scaling_factor,
+     total_cumulative_distance, lap_stats, keep) = task
+    element = create_element("Activity")
+    lap_dist = add_lap(element,
+                       None,
+                       lap,
+                       sport,
+                       dist_recalc,
+                       speed_recalc,
+                       calibrate,
+                       current_cal_factor,
+                       per_lap_cal,
+                       fixed_distance,
+                       activity_scaling_factor,
+                       total_cumulative_distance,
+                       trackpoints,
+                       lap_stats,
+                       keep)
+    if len(element) == 0:
+        return (None, lap_dist)
+    return (lxml.etree.tostring(element[0]), lap_dist)
+
+
+def calibration_options(dist_recalc,
+                        calibrate,
+                        per_lap_cal,
+                        manual_lap_distance):
+    """
+    Resolve the options implied by calibration, returning
+    (dist_recalc, per_lap_cal)
+    """
     # Calibration requires either GPS recalculation or manual lap distance(s):
     if calibrate and not dist_recalc and manual_lap_distance is None:
-        sys.stderr.write("Calibration requested, enabling distance recalculation from GPS/footpod.\n")
         dist_recalc = True
 
     # Calibration with manual lap distances implies
@@ -870,64 +2282,37 @@ def convert(filename,
     if calibrate and manual_lap_distance is not None:
         per_lap_cal = True
 
-    document = create_document()
-    element = create_sub_element(document.getroot(), "Activities")
+    return (dist_recalc, per_lap_cal)
 
-    try:
-        
-        if time_zone == "auto":
-            # We need activity object to be able to get trackpoints,
-            # before re-creating activity again with timezone info
-            activity = FitFile(filename,
-                            check_crc=False,
-                            data_processor=MyDataProcessor())
-            activity.parse()
-            lat = None
-            lon = None
-            for trackpoint in activity.get_messages('record'):
-                if lat is not None and lon is not None:
-                    break
-                lat = trackpoint.get_value("position_lat")
-                lon = trackpoint.get_value("position_long")
-            if lat is not None and lon is not None:
-                activity = FitFile(filename,
-                                   check_crc=False,
-                                   data_processor=TZDataProcessor(lat=lat,
-                                                                  lon=lon))
-        else:
-            activity = FitFile(filename,
-                               check_crc=False,
-                               data_processor=TZDataProcessor(tzname=time_zone))
-        activity.parse()
-
-        session = next(activity.get_messages('session'))
-        total_activity_distance = session.get_value('total_distance')
-        total_calculated_distance = sum_distance(activity)
-        activity_scaling_factor = (total_calculated_distance /
-                                   total_activity_distance)
-        new_cal_factor = activity_scaling_factor * current_cal_factor
-
-        actelem, total_distance = add_activity(element,
-                                               session,
-                                               activity,
-                                               dist_recalc,
-                                               speed_recalc,
-                                               calibrate,
-                                               current_cal_factor,
-                                               per_lap_cal,
-                                               manual_lap_distance,
-                                               activity_scaling_factor)
-    except FitParseError as e:
-        sys.stderr.write(str("Error while parsing .FIT file: %s" % e) + "\n")
-        sys.exit(1)
-
-    if dist_recalc:
-        distance_used = total_calculated_distance
-    elif calibrate:
-        distance_used = total_distance
-    else:
-        distance_used = total_activity_distance
 
+def distance_precision(calculated_distance, stored_distance):
+    """
+    Precision of the distance in the FIT file, relative to the distance
+    calculated from GPS/footpod, in % (100% if neither has any distance)
+    """
+    if not calculated_distance:
+        return 100.0 if not stored_distance else 0.0
+    return (1 - (abs(calculated_distance - stored_distance) /
+                 calculated_distance)) * 100
+
+
+def activity_notes(num_laps,
+                   distance_used,
+                   total_time,
+                   total_activity_distance,
+                   total_calculated_distance,
+                   current_cal_factor,
+                   new_cal_factor,
+                   dist_recalc,
+                   speed_recalc,
+                   calibrate,
+                   per_lap_cal,
+                   manual_lap_distance,
+                   recorded_cal_factor=None):
+    """
+    Format the notes text summarising an activity (see also
+    cal_factor_text())
+    """
     method = ""
     if dist_recalc or speed_recalc or calibrate:
         parts = []
@@ -951,25 +2336,30 @@ def convert(filename,
 
         method = "(" + ", ".join(parts) + reference + ")"
 
-    notes = ("{total_laps:d} laps: {distance_used:.3f} km in {total_time!s} {dist_method:s}\n"
-             "Distance in FIT file: {fit_dist:.3f} km; "
-             "calculated via GPS/footpod: {gps_dist:.3f} km "
-             "(precision: {precision:.1f}%)\n"
-             "Footpod calibration factor setting: {old_cf:.1f}%; "
-             "new factor based on recomputed distance: {new_cf:.1f}%"
-             ).format(total_laps=session.get_value('num_laps'),
-                      distance_used=distance_used / 1000,
-                      total_time=timedelta(seconds=int(session.get_value(
-                          'total_timer_time'))),
-                      fit_dist=total_activity_distance / 1000,
-                      gps_dist=total_calculated_distance / 1000,
-                      precision=(1 - (abs(total_calculated_distance -
-                                          total_activity_distance) /
-                                      total_calculated_distance)) * 100,
-                      old_cf=current_cal_factor,
-                      new_cf=new_cal_factor,
-                      dist_method=method)
-    add_notes(actelem, notes)
+    return ("{total_laps:d} laps: {distance_used:.3f} km in {total_time!s} {dist_method:s}\n"
+            "Distance in FIT file: {fit_dist:.3f} km; "
+            "calculated via GPS/footpod: {gps_dist:.3f} km "
+            "(precision: {precision:.1f}%)\n"
+            "Footpod calibration factor setting: {old_cf!s}; "
+            "new factor based on recomputed distance: {new_cf:.1f}%"
+            ).format(total_laps=num_laps,
+                     distance_used=distance_used / 1000,
+                     total_time=timedelta(seconds=int(total_time)),
+                     fit_dist=total_activity_distance / 1000,
+                     gps_dist=total_calculated_distance / 1000,
+                     precision=distance_precision(total_calculated_distance,
+                                                  total_activity_distance),
+                     old_cf=cal_factor_text(current_cal_factor,
+                                            recorded_cal_factor),
+                     new_cf=new_cal_factor,
+                     dist_method=method)
+
+
+def device_info(activity):
+    """
+    Get the recording device for an activity, returning
+    (manufacturer, product_name, product_id, serial_number)
+    """
     try:
         dinfo = next(activity.get_messages('device_info'))
         manufacturer = dinfo.get_value('manufacturer').title().replace('_', ' ')
@@ -982,23 +2372,2221 @@ def convert(filename,
         product_id = fid.get_value('product')
         product_name = PRODUCT_MAP[product_id] if product_id in PRODUCT_MAP else product_id
         serial_number = fid.get_value('serial_number')
-    add_creator(actelem,
-                manufacturer,
-                product_name,
-                product_id,
-                serial_number
-                )
+    return (manufacturer, product_name, product_id, serial_number)
+
+
+class FitCrc(object):
+
+    """
+    CRC-16 of a FIT file (the CRC-16/ARC of the FIT SDK), computed with a
+    table of the CRC of every 16-bit word, i.e. one lookup per two bytes
+    rather than fitparse's four per byte. Data is buffered by update() and
+    the CRC computed a block at a time, as the (many, small) reads of the
+    decoder come in.
+    """
+
+    BYTE_TABLE = None
+    WORD_TABLE = None
+    BLOCK_SIZE = 65536
+
+    def __init__(self):
+        if FitCrc.WORD_TABLE is None:
+            FitCrc.BYTE_TABLE, FitCrc.WORD_TABLE = self.tables()
+        self.crc = 0
+        self.pending = bytearray()
+
+    @staticmethod
+    def tables():
+        """The CRC of each byte and of each (little-endian) 16-bit word"""
+        crcs = np.arange(65536, dtype=np.uint32)
+        byte_table = None
+        for bit in range(16):
+            crcs = np.where(crcs & 1, (crcs >> 1) ^ 0xA001, crcs >> 1)
+            if bit == 7:
+                byte_table = crcs[:256].tolist()
+        return byte_table, crcs.tolist()
+
+    def update(self, data):
+        """Add data (as read from the file)"""
+        self.pending += data
+        if len(self.pending) >= self.BLOCK_SIZE:
+            self._compute(self.BLOCK_SIZE)
+
+    def _compute(self, size):
+        """Compute the CRC over the first size bytes pending (size even)"""
+        words = array.array('H', bytes(self.pending[:size]))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        crc = self.crc
+        table = self.WORD_TABLE
+        for word in words:
+            crc = table[crc ^ word]
+        self.crc = crc
+        del self.pending[:size]
+
+    @property
+    def value(self):
+        """The CRC of all the data so far"""
+        self._compute(len(self.pending) & ~1)
+        if self.pending:
+            self.crc = (self.crc >> 8) ^ self.BYTE_TABLE[(self.crc ^ self.pending[0]) & 0xFF]
+            del self.pending[:]
+        return self.crc
+
+
+class VerifyingFitFile(FitFile):
+
+    """
+    FIT file reader which checks the CRCs of the file header and data
+    (with FitCrc, over the data as the decoder reads it), raising
+    FitCRCError if they do not match.
+    """
+
+    def __init__(self, fileish, **kwargs):
+        kwargs['check_crc'] = False     # instead of fitparse's (slow) CRC
+        FitFile.__init__(self, fileish, **kwargs)
+
+    def _parse_file_header(self):
+        self._fit_crc = FitCrc()
+        FitFile._parse_file_header(self)
+
+    def _read(self, size):
+        # As FitFile._read(), buffering the data for the CRC (inline, as
+        # this is called for every field of every message)
+        if size <= 0:
+            return None
+        data = self._file.read(size)
+        if size != len(data):
+            raise FitEOFError("Tried to read %d bytes from .FIT file but got %d" % (size, len(data)))
+        crc = self._fit_crc
+        crc.pending += data
+        if len(crc.pending) >= crc.BLOCK_SIZE:
+            crc._compute(crc.BLOCK_SIZE)
+        self._bytes_left -= len(data)
+        return data
+
+    def _read_and_assert_crc(self, allow_zero=False):
+        crc_computed = self._fit_crc.value
+        crc_read = self._read_struct('H')
+        if crc_computed == crc_read or (allow_zero and crc_read == 0):
+            return
+        raise FitCRCError("CRC Mismatch [computed: 0x%04X, read: 0x%04X]" % (
+            crc_computed, crc_read))
+
+
+def check_fit_file(filename):
+    """
+    Check the CRCs of a FIT file, without decoding it.
+    Raises ChecksumError if the file is corrupt or truncated, or
+    FitFileError if it cannot be read.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError) as e:
+        raise FitFileError("Unable to read .FIT file: %s" % e)
+    offset = 0
+    while offset < len(data):   # FIT files may be chained
+        header = data[offset:offset + 14]
+        if len(header) < 12 or header[8:12] != b'.FIT':
+            raise ChecksumError("Invalid .FIT file header at byte %d" % offset)
+        header_size = bytearray(header)[0]
+        data_size = struct.unpack('<I', header[4:8])[0]
+        end = offset + header_size + data_size
+        if end + 2 > len(data):
+            raise ChecksumError("Truncated .FIT file: %d bytes expected, %d read" % (
+                end + 2, len(data)))
+        crc = FitCrc()
+        if header_size >= 14:
+            crc.update(data[offset:offset + 12])
+            header_crc = struct.unpack('<H', data[offset + 12:offset + 14])[0]
+            if header_crc not in (0, crc.value):
+                raise ChecksumError("Error while parsing .FIT file: CRC Mismatch "
+                                    "[computed: 0x%04X, read: 0x%04X]" % (crc.value, header_crc))
+            crc.update(data[offset + 12:end])
+        else:
+            crc.update(data[offset:end])
+        file_crc = struct.unpack('<H', data[end:end + 2])[0]
+        if file_crc != crc.value:
+            raise ChecksumError("Error while parsing .FIT file: CRC Mismatch "
+                                "[computed: 0x%04X, read: 0x%04X]" % (crc.value, file_crc))
+        offset = end + 2
+
+
+def load_activity(filename, time_zone="auto", verify=False):
+    """
+    Decode a FIT file, correcting timestamps for the given timezone.
+    Raises FitFileError if the file cannot be read or decoded, or
+    ChecksumError if it is truncated or (with verify) its CRCs do not match.
+    """
+    try:
+        return _load_activity(filename, time_zone,
+                              VerifyingFitFile if verify else FitFile)
+    except (FitCRCError, FitEOFError) as e:
+        raise ChecksumError("Error while parsing .FIT file: %s" % e)
+    except FitParseError as e:
+        raise FitFileError("Error while parsing .FIT file: %s" % e)
+    except (IOError, OSError) as e:
+        raise FitFileError("Unable to read .FIT file: %s" % e)
+
+
+def _load_activity(filename, time_zone, fit_file_class):
+    if time_zone == "auto":
+        # We need activity object to be able to get trackpoints,
+        # before re-creating activity again with timezone info
+        # (messages are decoded lazily, only up to the first position)
+        activity = fit_file_class(filename,
+                                  check_crc=False,
+                                  data_processor=MyDataProcessor())
+        lat = None
+        lon = None
+        for trackpoint in activity.get_messages('record'):
+            if lat is not None and lon is not None:
+                break
+            lat = trackpoint.get_value("position_lat")
+            lon = trackpoint.get_value("position_long")
+        if lat is not None and lon is not None:
+            activity = fit_file_class(filename,
+                                      check_crc=False,
+                                      data_processor=TZDataProcessor(lat=lat,
+                                                                     lon=lon))
+    else:
+        activity = fit_file_class(filename,
+                                  check_crc=False,
+                                  data_processor=TZDataProcessor(tzname=time_zone))
+    activity.parse()
+    return activity
+
+
+def peek(filename, time_zone="auto"):
+    """
+    Read the metadata of a FIT activity from its file_id, session and
+    device_info messages only, skipping over the record data. Timestamps are
+    corrected for the timezone as they are for a full conversion (for which
+    only the records up to the first position are decoded).
+    """
+    peek_messages = ['file_id', 'session', 'device_info']
+    if time_zone == "auto":
+        peek_messages.append('record')
+    try:
+        activity = PeekFitFile(filename,
+                               peek_messages,
+                               check_crc=False,
+                               data_processor=MyDataProcessor())
+        messages = {}
+        lat = None
+        lon = None
+        try:
+            for message in activity.get_messages():
+                if message.name == 'record':
+                    if lat is not None and lon is not None:
+                        continue
+                    lat = message.get_value("position_lat")
+                    lon = message.get_value("position_long")
+                    if lat is not None and lon is not None:
+                        activity.peek_messages.discard('record')
+                elif (message.name in peek_messages and
+                      message.name not in messages):
+                    messages[message.name] = message
+                if (len(messages) == 3 and
+                        'record' not in activity.peek_messages):
+                    break   # all found, no need to read further
+            if 'file_id' not in messages:
+                raise ActivityError("No file_id found in .FIT file")
+            if 'session' not in messages:
+                raise ActivityError("No session found in .FIT file")
+            manufacturer, product_name, product_id, serial_number = \
+                device_info(activity)
+        finally:
+            activity.close()
+    except FitParseError as e:
+        raise FitFileError("Error while parsing .FIT file: %s" % e)
+    except (IOError, OSError) as e:
+        raise FitFileError("Unable to read .FIT file: %s" % e)
+
+    if time_zone != "auto":
+        tz = TZDataProcessor(tzname=time_zone).tz
+    elif lat is not None and lon is not None:
+        tz = timezone_at(lat, lon)
+    else:
+        tz = utc
+
+    def localize(dt):
+        # Re-normalize to UTC, as for TZDataProcessor
+        if not isinstance(dt, datetime):
+            return dt
+        return utc.normalize(tz.localize(dt.replace(tzinfo=None)))
+
+    session = messages['session']
+    sport = session.get_value("sport")
+    return {
+        'time_created': localize(messages['file_id'].get_value('time_created')),
+        'start_time': localize(session.get_value('start_time')),
+        'timezone': tz.zone,
+        'sport': SPORT_MAP[sport] if sport in SPORT_MAP else "Other",
+        'num_laps': session.get_value('num_laps'),
+        'total_time': session.get_value('total_timer_time'),
+        'total_distance': session.get_value('total_distance'),
+        'manufacturer': manufacturer,
+        'product_name': product_name,
+        'product_id': product_id,
+        'serial_number': serial_number}
+
+
+# Type of the trackpoint arrays stored in a sidecar file (see Trackpoints):
+# the times, and the values of each field, NaN where missing
+SIDECAR_DTYPE = '<f8'
+
+# Messages used to convert an activity, and their fields, as stored in a
+# sidecar file or split into sessions (see split_sessions())
+ACTIVITY_MESSAGES = {'session':     ['sport', 'start_time', 'timestamp',
+                                     'num_laps', 'total_timer_time',
+                                     'total_elapsed_time', 'total_distance',
+                                     'total_calories'],
+                     'lap':         LAP_FIELDS,
+                     'device_info': ['manufacturer', 'descriptor', 'product',
+                                     'serial_number'],
+                     'file_id':     ['manufacturer', 'product',
+                                     'serial_number']}
+
+
+def sidecar_filename(filename):
+    """The name of the sidecar file of a FIT file"""
+    return filename + SIDECAR_EXTENSION
+
+
+def _decoder_version():
+    return "fit2tcx %s, fitparse %s, sidecar %d" % (
+        __version__, getattr(fitparse, '__version__', "unknown"),
+        SIDECAR_VERSION)
+
+
+def _file_sha1(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _microseconds(dt):
+    """The number of microseconds since the Unix epoch of a UTC datetime"""
+    if dt.tzinfo is not utc:
+        raise TypeError("Cannot store %r" % dt)
+    delta = dt - UNIX_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _encode_sidecar_value(value):
+    if isinstance(value, datetime):
+        return {'utc': _microseconds(value)}
+    raise TypeError("Cannot store %r" % value)
+
+
+def _decode_sidecar_value(value):
+    if list(value) == ['utc']:
+        return UNIX_EPOCH + timedelta(microseconds=value['utc'])
+    return value
+
+
+def write_sidecar(filename, time_zone, verified, activity, trackpoints,
+                  resample=None):
+    """
+    Write the trackpoints of a decoded activity, and the messages needed
+    to convert it, to a sidecar file next to the FIT file, so that later
+    conversions can read them with read_sidecar() instead of decoding the
+    FIT file. The trackpoint arrays (see Trackpoints) are written as they
+    are. Returns True if the sidecar was written; nothing is written if a
+    message value can't be stored, and errors writing it are only logged.
+    """
+    arrays = []
+    offset = 0
+    streams = [('times', trackpoints.times)] + sorted(
+        trackpoints.streams.items())
+    for name, values in streams:
+        data = np.asarray(values, dtype=SIDECAR_DTYPE).tobytes()
+        arrays.append((name, offset, data))
+        offset += len(data) + (-len(data) % 8)
+    messages = dict((name, [MessageValues.from_message(message, fields)
+                            for message in activity.get_messages(name)])
+                    for name, fields in ACTIVITY_MESSAGES.items())
+    try:
+        stat = os.stat(filename)
+        header = json.dumps({
+            'version': SIDECAR_VERSION,
+            'decoder': _decoder_version(),
+            'sha1': _file_sha1(filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'time_zone': time_zone,
+            'resample': resample or RESAMPLE_DEFAULTS,
+            'verified': verified,
+            'count': len(trackpoints),
+            'integral': sorted(trackpoints.integral),
+            'arrays': dict((name, [SIDECAR_DTYPE, offset, len(trackpoints)])
+                           for name, offset, data in arrays),
+            'messages': messages}, default=_encode_sidecar_value,
+            sort_keys=True).encode('utf-8')
+    except TypeError as e:
+        logger.info("Not caching %s: %s", filename, e)
+        return False
+    except OSError as e:
+        logger.warning("Unable to write sidecar for %s: %s", filename, e)
+        return False
+    header += b' ' * (-(len(SIDECAR_MAGIC) + 4 + len(header)) % 8)
+    try:
+        with atomic_file(sidecar_filename(filename)) as f:
+            f.write(SIDECAR_MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for name, offset, data in arrays:
+                f.write(data)
+                f.write(b'\0' * (-len(data) % 8))
+    except (IOError, OSError) as e:
+        logger.warning("Unable to write sidecar for %s: %s", filename, e)
+        return False
+    return True
+
+
+def read_sidecar(filename, time_zone="auto", verify=False, resample=None):
+    """
+    Read the sidecar file of a FIT file, written by write_sidecar(),
+    returning (activity, trackpoints), where activity stands in for the
+    decoded FIT file, or None if there is no sidecar, or it is stale (the
+    FIT file, the decoder, or the timezone or resampling options have
+    changed since it was written). The FIT file is taken to be unchanged
+    if its size and modification time are, and is only hashed to check
+    it if its modification time differs (e.g. it has been copied). The
+    file is read in one go, and the trackpoints (see Trackpoints) use its
+    arrays as they are.
+    """
+    path = sidecar_filename(filename)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:len(SIDECAR_MAGIC)] != SIDECAR_MAGIC:
+            raise ValueError("bad magic number")
+        start = len(SIDECAR_MAGIC) + 4
+        length = struct.unpack('<I', data[len(SIDECAR_MAGIC):start])[0]
+        header = json.loads(data[start:start + length].decode('utf-8'),
+                            object_hook=_decode_sidecar_value)
+        start += length
+        stat = os.stat(filename)
+        if (header['version'] != SIDECAR_VERSION or
+                header['decoder'] != _decoder_version() or
+                header['time_zone'] != time_zone or
+                header['resample'] != (resample or RESAMPLE_DEFAULTS) or
+                header['size'] != stat.st_size or
+                (header['mtime'] != stat.st_mtime and
+                 header['sha1'] != _file_sha1(filename))):
+            logger.info("Sidecar for %s is stale", filename)
+            return None
+        streams = {}
+        for name, (dtype, offset, count) in header['arrays'].items():
+            streams[name] = np.frombuffer(data, dtype=dtype, count=count,
+                                          offset=start + offset)
+        times = streams.pop('times')
+    except (IOError, OSError, ValueError, KeyError, TypeError,
+            struct.error) as e:
+        logger.info("Unable to read sidecar for %s: %s", filename, e)
+        return None
+    if verify and not header['verified']:
+        check_fit_file(filename)
+    activity = MessageLog((name, [MessageValues(m) for m in messages])
+                           for name, messages in header['messages'].items())
+    return (activity, Trackpoints(times, streams, header['integral']))
+
+
+def decode_activity(filename, time_zone="auto", verify=False, cache=False,
+                    resample=None):
+    """
+    Decode a FIT file and resample its records to trackpoints (see
+    coalesce_trackpoints()), or read them from its sidecar if cache is set
+    and it is up to date (see read_sidecar()), returning (activity,
+    trackpoints, timings)
+    """
+    started = time.time()
+    resample = resample or RESAMPLE_DEFAULTS
+    cached = (read_sidecar(filename, time_zone, verify, resample)
+              if cache else None)
+    if cached is not None:
+        return cached + ({'load': time.time() - started},)
+    activity = load_activity(filename, time_zone, verify)
+    decoded = time.time()
+    trackpoints = coalesce_trackpoints(activity, **resample)
+    if cache:
+        write_sidecar(filename, time_zone, verify, activity, trackpoints,
+                      resample)
+    return (activity, trackpoints, {'decode': decoded - started,
+                                    'prepare': time.time() - decoded})
+
+
+def split_sessions(activity, trackpoints):
+    """
+    Split a decoded activity with several sessions (e.g. a triathlon or a
+    brick session) by time: each session gets the laps and trackpoints from
+    its start time up to the start of the next session (and the first, any
+    before its start). Returns a list of (activity, trackpoints), in order
+    of start time, where each activity stands in for a FIT file of just
+    that session; an activity with one session is returned as it is.
+    """
+    sessions = [MessageValues.from_message(session,
+                                           ACTIVITY_MESSAGES['session'])
+                for session in activity.get_messages('session')]
+    if len(sessions) < 2:
+        return [(activity, trackpoints)]
+    sessions.sort(key=lambda session: session['start_time'])
+    starts = [session['start_time'] for session in sessions[1:]]
+
+    # Trackpoints are sorted by time, so each session's are a slice
+    bounds = ([0] + [find_trackpoint(trackpoints, start) for start in starts] +
+              [len(trackpoints)])
+
+    # Laps are in order, so they're assigned in one pass
+    laps = [[] for session in sessions]
+    index = 0
+    for lap in activity.get_messages('lap'):
+        lap_start = lap.get_value('start_time') or lap.get_value('timestamp')
+        if lap_start is not None:
+            index = bisect.bisect_right(starts, lap_start)
+        laps[index].append(MessageValues.from_message(lap, LAP_FIELDS))
+
+    devices = dict((name, [MessageValues.from_message(message,
+                                                      ACTIVITY_MESSAGES[name])
+                           for message in activity.get_messages(name)])
+                   for name in ('device_info', 'file_id'))
+    parts = []
+    for i, session in enumerate(sessions):
+        messages = MessageLog(devices, session=[session], lap=laps[i])
+        parts.append((messages, trackpoints[bounds[i]:bounds[i + 1]]))
+    return parts
+
+
+class PreparedActivity(object):
+
+    """
+    A FIT activity that has been decoded, with the GPS and footpod distance
+    streams computed, once. Scaling factors, lap distances, speeds and notes
+    for any calibration settings are then computed from those streams,
+    totalled as add_lap() totals them but without building any XML, and the
+    TCX document can still be rendered on demand. An activity that has
+    already been decoded (e.g. a session split from a FIT file by
+    prepare_sessions()) can be given in decoded, as (activity, trackpoints,
+    timings), in place of decoding filename.
+    """
+
+    def __init__(self, filename, time_zone="auto", gps_filter=None,
+                 verify=False, cache=False, resample=None, decoded=None):
+        if decoded is None:
+            decoded = decode_activity(filename, time_zone, verify, cache,
+                                      resample)
+        self.activity, self.trackpoints, timings = decoded
+        started = time.time()
+        try:
+            self.session = next(self.activity.get_messages('session'))
+        except StopIteration:
+            raise ActivityError("No session found in .FIT file")
+        sport = self.session.get_value("sport")
+        filter_trackpoints(self.trackpoints,
+                           SPORT_MAP[sport] if sport in SPORT_MAP else "Other",
+                           gps_filter)
+
+        # Distance & speed from the previous trackpoint, for each trackpoint
+        self.speeds = self.trackpoints.values('speed')
+        distance = self.trackpoints.stream('distance')
+        if ('gps_distance' in self.trackpoints.streams and
+                not np.isnan(distance[1:]).any()):
+            # As gps_delta() gives them, for all the trackpoints at once
+            gps_distance = self.trackpoints.stream('gps_distance')[1:]
+            footpod = distance[1:] - np.nan_to_num(distance[:-1])
+            filtered = ~np.isnan(gps_distance)
+            self.footpod_distances = [0.0] + footpod.tolist()
+            self.gps_distances = [0.0] + np.where(filtered, gps_distance,
+                                                  footpod).tolist()
+            self.gps_speeds = [None] + [
+                None if v != v else v
+                for v in np.where(filtered,
+                                  self.trackpoints.stream('gps_speed')[1:],
+                                  self.trackpoints.stream('speed')[1:]
+                                  ).tolist()]
+        else:
+            self.gps_distances = []
+            self.gps_speeds = []
+            self.footpod_distances = []
+            prev = None
+            for tp in self.trackpoints:
+                if prev is not None:
+                    gps_dist, gps_speed = gps_delta(tp, prev)
+                    footpod_dist = tp['distance'] - (prev['distance'] or 0)
+                else:
+                    gps_dist, gps_speed, footpod_dist = (0.0, None, 0.0)
+                self.gps_distances.append(gps_dist)
+                self.gps_speeds.append(gps_speed)
+                self.footpod_distances.append(footpod_dist)
+                prev = tp
+
+        # Cumulative distances, such that the distance over
+        # trackpoints [i, j) is cumulative[j] - cumulative[i]
+        self.gps_cumulative = [0.0]
+        for gps_dist in self.gps_distances:
+            self.gps_cumulative.append(self.gps_cumulative[-1] + gps_dist)
+
+        # Time taken by each stage of the conversion, in seconds
+        self.timings = dict(timings)
+        self.timings['prepare'] = (self.timings.get('prepare', 0.0) +
+                                   time.time() - started)
+
+        self.total_activity_distance = self.session.get_value('total_distance')
+        self.total_calculated_distance = sum(self.gps_distances, 0.0)
+
+        # Laps, as processed by add_activity()
+        self.laps = []
+        for lap in self.activity.get_messages('lap'):
+            if lap.get_value("start_time") == lap.get_value("timestamp"):
+                continue    # skip very short laps that won't have any data
+            if lap.get_value('timestamp') is None:
+                self.laps.append(None)
+                continue
+            first, last = lap_range(self.trackpoints,
+                                    lap.get_value("start_time"),
+                                    lap.get_value("timestamp"))
+            # The calculated distance, summed as sum_distance() does
+            calculated_distance = 0.0
+            for gps_dist in self.gps_distances[max(first, 1):last]:
+                calculated_distance += gps_dist
+            self.laps.append({
+                'lap': lap,
+                'first': first,
+                'last': last,
+                'calculated_distance': calculated_distance})
+        self._stats = None
+
+    def scaling_factor(self):
+        """
+        The scaling factor of the distances in the FIT file to the distance
+        calculated from GPS/footpod (1.0 if there is no distance in the FIT
+        file, e.g. for a transition)
+        """
+        try:
+            return self.total_calculated_distance / self.total_activity_distance
+        except (ZeroDivisionError, TypeError):
+            return 1.00
+
+    def positions(self):
+        """
+        The positions of the trackpoints that have them, as an array of
+        (latitude, longitude) rows, in degrees
+        """
+        lat = self.trackpoints.stream('position_lat')
+        lon = self.trackpoints.stream('position_long')
+        located = ~np.isnan(lat) & ~np.isnan(lon)
+        return np.column_stack((lat[located], lon[located]))
+
+    def correct_elevation(self, tiles):
+        """
+        Replace the recorded altitude of the trackpoints that have positions
+        with the elevation looked up in DEM tiles (see DemTiles), rounded
+        to 0.1 m, where there is any, returning the number of trackpoints
+        corrected
+        """
+        lat = self.trackpoints.stream('position_lat')
+        lon = self.trackpoints.stream('position_long')
+        located = np.flatnonzero(~np.isnan(lat) & ~np.isnan(lon))
+        elevations = np.round(tiles.elevations(lat[located], lon[located]), 1)
+        found = ~np.isnan(elevations)
+        altitude = np.array(self.trackpoints.stream('altitude'), dtype=float)
+        altitude[located[found]] = elevations[found]
+        self.trackpoints.set_stream('altitude', altitude)
+        return int(np.count_nonzero(found))
+
+    def decimation(self, mode, tolerance=None):
+        """
+        The trackpoints to keep when decimating the track with the given
+        mode and tolerance (default: DECIMATION_TOLERANCES), as an array
+        of flags, always keeping the first and last trackpoint of each lap
+        """
+        if tolerance is None:
+            tolerance = DECIMATION_TOLERANCES[mode]
+        boundaries = [i for lap in self.laps if lap is not None
+                      for i in (lap['first'], lap['last'] - 1)
+                      if lap['last'] > lap['first']]
+        return decimate(self.trackpoints.seconds(),
+                        np.array(self.gps_cumulative[1:], dtype=float),
+                        self.trackpoints.stream('position_lat'),
+                        self.trackpoints.stream('position_long'),
+                        np.array(boundaries, dtype=np.intp),
+                        mode,
+                        tolerance)
+
+    def written_trackpoints(self, keep=None):
+        """
+        The number of trackpoints written to the laps of the TCX document,
+        counting a trackpoint at the boundary between two laps (which is in
+        both of them) twice, and only those flagged in keep if it is given
+        """
+        ranges = [(lap['first'], lap['last'])
+                  for lap in self.laps if lap is not None]
+        if keep is None:
+            return sum(last - first for first, last in ranges)
+        return sum(int(np.count_nonzero(keep[first:last]))
+                   for first, last in ranges)
+
+    def stats(self):
+        """
+        Recompute the heart rate, cadence and moving time summary values
+        from the trackpoint streams, for the whole activity and for each lap
+        (None for laps with no timestamp), as (session, laps). Calories
+        aren't recomputed, since that needs the athlete's weight, age, etc.
+        as well as their heart rate, which the FIT files don't hold
+        """
+        if self._stats is not None:
+            return self._stats
+
+        num_points = len(self.trackpoints)
+        times = self.trackpoints.seconds()
+        speeds = self.trackpoints.stream('speed')
+        speeds = np.where(np.isnan(speeds),
+                          np.array([np.nan if v is None else v
+                                    for v in self.gps_speeds], dtype=float),
+                          speeds)
+
+        # Ranges of trackpoints, for the session and then each lap
+        ranges = [(0, num_points)] + [(lap['first'], lap['last'])
+                                      for lap in self.laps if lap is not None]
+        first = np.array([r[0] for r in ranges], dtype=np.intp)
+        last = np.array([r[1] for r in ranges], dtype=np.intp)
+
+        avg_heart, max_heart = range_stats(
+            times, self.trackpoints.stream('heart_rate'),
+            first, last)
+        avg_cadence, max_cadence = range_stats(
+            times, self.trackpoints.stream('cadence'),
+            first, last)
+
+        # Moving time: time since the previous trackpoint, if moving
+        moving = np.where(speeds >= MIN_MOVING_SPEED,
+                          np.diff(times, prepend=times[:1]), 0.0)
+        cum_moving = np.concatenate(([0.0], np.cumsum(moving)))
+        moving_time = cum_moving[last] - cum_moving[first]
+
+        def as_int(value):
+            return None if np.isnan(value) else int(round(value))
+
+        results = []
+        for i in range(len(ranges)):
+            results.append({
+                'avg_heart_rate': as_int(avg_heart[i]),
+                'max_heart_rate': as_int(max_heart[i]),
+                'avg_cadence': as_int(avg_cadence[i]),
+                'max_cadence': as_int(max_cadence[i]),
+                'moving_time': float(moving_time[i])})
+        lap_results = iter(results[1:])
+        lap_stats = [None if lap is None else next(lap_results)
+                     for lap in self.laps]
+        self._stats = (results[0], lap_stats)
+        return self._stats
+
+    def summary(self,
+                dist_recalc=False,
+                speed_recalc=False,
+                calibrate=False,
+                per_lap_cal=False,
+                manual_lap_distance=None,
+                current_cal_factor=100.0,
+                recompute_summary=False):
+        """
+        Compute the values that convert() would produce for the given
+        settings, without building any XML
+        """
+        dist_recalc, per_lap_cal = calibration_options(dist_recalc,
+                                                       calibrate,
+                                                       per_lap_cal,
+                                                       manual_lap_distance)
+
+        activity_scaling_factor = self.scaling_factor()
+        new_cal_factor = activity_scaling_factor * current_cal_factor
+
+        if recompute_summary:
+            session_stats, lap_stats = self.stats()
+        else:
+            session_stats, lap_stats = None, None
+
+        laps = []
+        total_distance = 0.0
+        for lap_idx, prepared_lap in enumerate(self.laps):
+            if prepared_lap is None:
+                continue
+            if manual_lap_distance is not None:
+                try:
+                    fixed_distance = manual_lap_distance[lap_idx]
+                except IndexError:
+                    fixed_distance = None
+            else:
+                fixed_distance = None
+            lap = self._lap_summary(prepared_lap,
+                                    dist_recalc,
+                                    speed_recalc,
+                                    calibrate,
+                                    per_lap_cal,
+                                    fixed_distance,
+                                    current_cal_factor,
+                                    activity_scaling_factor)
+            if lap_stats is not None:
+                lap.update(lap_stats[lap_idx])
+            total_distance += lap['distance']
+            laps.append(lap)
+
+        if dist_recalc:
+            distance_used = self.total_calculated_distance
+        elif calibrate:
+            distance_used = total_distance
+        else:
+            distance_used = self.total_activity_distance
+
+        notes = activity_notes(self.session.get_value('num_laps'),
+                               distance_used,
+                               self.session.get_value('total_timer_time'),
+                               self.total_activity_distance,
+                               self.total_calculated_distance,
+                               current_cal_factor,
+                               new_cal_factor,
+                               dist_recalc,
+                               speed_recalc,
+                               calibrate,
+                               per_lap_cal,
+                               manual_lap_distance)
+
+        sport = self.session.get_value("sport")
+        return {
+            'start_time': self.session.get_value("start_time"),
+            'sport': SPORT_MAP[sport] if sport in SPORT_MAP else "Other",
+            'num_laps': self.session.get_value('num_laps'),
+            'total_time': self.session.get_value('total_timer_time'),
+            'stored_distance': self.total_activity_distance,
+            'calculated_distance': self.total_calculated_distance,
+            'distance_used': distance_used,
+            'precision': distance_precision(self.total_calculated_distance,
+                                            self.total_activity_distance),
+            'scaling_factor': activity_scaling_factor,
+            'new_cal_factor': new_cal_factor,
+            'notes': notes,
+            'recomputed': session_stats,
+            'laps': laps}
+
+    def _lap_summary(self,
+                     prepared_lap,
+                     dist_recalc,
+                     speed_recalc,
+                     calibrate,
+                     per_lap_cal,
+                     fixed_distance,
+                     current_cal_factor,
+                     activity_scaling_factor):
+        """Compute the values that add_lap() would produce for a lap"""
+        lap = prepared_lap['lap']
+        lap_num = lap.get_value("message_index") + 1
+        totaltime = lap.get_value("total_elapsed_time")
+        stored_distance = lap.get_value("total_distance")
+        calculated_distance = prepared_lap['calculated_distance']
+
+        lap_scaling_factor, scaling_factor = lap_scaling_factors(
+            calculated_distance,
+            stored_distance,
+            fixed_distance,
+            calibrate,
+            per_lap_cal,
+            activity_scaling_factor)
+
+        if dist_recalc:
+            distance_used = calculated_distance
+        elif calibrate:
+            if fixed_distance is not None:
+                distance_used = fixed_distance
+            else:
+                distance_used = stored_distance * scaling_factor
+        else:
+            distance_used = stored_distance
+        distance, gps_max_speed = self.lap_distance(prepared_lap,
+                                                    dist_recalc,
+                                                    speed_recalc,
+                                                    calibrate,
+                                                    scaling_factor)
+
+        lap_distance = stored_distance
+        avg_speed = lap.get_value("avg_speed")
+        max_speed = lap.get_value("max_speed")
+        if calibrate:
+            if fixed_distance is not None:
+                lap_distance = fixed_distance
+                avg_speed = fixed_distance / totaltime
+            else:
+                lap_distance = stored_distance * scaling_factor
+                avg_speed = avg_speed * scaling_factor
+            max_speed = max_speed * scaling_factor
+        if dist_recalc:
+            lap_distance = distance
+        if speed_recalc:
+            avg_speed = distance / totaltime
+            max_speed = gps_max_speed
+
+        return {
+            'lap_number': lap_num,
+            'stored_distance': stored_distance,
+            'calculated_distance': calculated_distance,
+            'distance_used': distance_used,
+            'distance': distance,
+            'lap_distance': lap_distance,
+            'avg_speed': avg_speed,
+            'max_speed': max_speed,
+            'scaling_factor': scaling_factor,
+            'new_cal_factor': lap_scaling_factor * current_cal_factor,
+            'notes': lap_notes(lap_num,
+                               distance_used,
+                               totaltime,
+                               stored_distance,
+                               calculated_distance,
+                               fixed_distance,
+                               current_cal_factor)}
+
+    def lap_offsets(self,
+                    dist_recalc,
+                    speed_recalc,
+                    calibrate,
+                    per_lap_cal,
+                    manual_lap_distance,
+                    activity_scaling_factor):
+        """
+        Compute the cumulative distance at the start of each lap, as
+        add_activity() accumulates it: the lap distances are summed over
+        each lap's trackpoints in the same order, and with the same steps
+        (see lap_step()), as add_lap(), so that laps built independently
+        match those built one after another
+        """
+        offsets = []
+        total_cumulative_distance = 0.0
+        for lap_idx, prepared_lap in enumerate(self.laps):
+            offsets.append(total_cumulative_distance)
+            if prepared_lap is None:
+                continue
+            if manual_lap_distance is not None:
+                try:
+                    fixed_distance = manual_lap_distance[lap_idx]
+                except IndexError:
+                    fixed_distance = None
+            else:
+                fixed_distance = None
+            scaling_factor = lap_scaling_factors(
+                prepared_lap['calculated_distance'],
+                prepared_lap['lap'].get_value("total_distance"),
+                fixed_distance,
+                calibrate,
+                per_lap_cal,
+                activity_scaling_factor)[1]
+            total_cumulative_distance += self.lap_distance(prepared_lap,
+                                                           dist_recalc,
+                                                           speed_recalc,
+                                                           calibrate,
+                                                           scaling_factor)[0]
+        return offsets
+
+    def lap_distance(self,
+                     prepared_lap,
+                     dist_recalc,
+                     speed_recalc,
+                     calibrate,
+                     scaling_factor):
+        """
+        The distance and maximum speed of a lap as add_lap() totals them:
+        summed over the lap's trackpoints in the same order, and with the
+        same steps (see lap_step()), so that steps without a speed are left
+        out when calibrating
+        """
+        distance = 0.0
+        max_speed = 0.0
+        for i in range(max(prepared_lap['first'], 1), prepared_lap['last']):
+            tp_dist, tp_speed = lap_step(self.gps_distances[i],
+                                         self.gps_speeds[i],
+                                         self.footpod_distances[i],
+                                         self.speeds[i],
+                                         dist_recalc,
+                                         speed_recalc,
+                                         calibrate,
+                                         scaling_factor)
+            if tp_dist is not None:
+                distance += tp_dist
+                if tp_speed is not None and tp_speed > max_speed:
+                    max_speed = tp_speed
+        return (distance, max_speed)
+
+    def render(self,
+               dist_recalc=False,
+               speed_recalc=False,
+               calibrate=False,
+               per_lap_cal=False,
+               manual_lap_distance=None,
+               current_cal_factor=100.0,
+               lap_workers=1,
+               recompute_summary=False,
+               keep=None):
+        """
+        Build the TCX document for the given settings, optionally building
+        the laps in parallel using lap_workers processes, optionally
+        with the lap summary values recomputed from the trackpoints, and
+        optionally with only the trackpoints flagged in keep (see decimate())
+        """
+        document = create_document()
+        element = create_sub_element(document.getroot(), "Activities")
+        self.add_to(element,
+                    dist_recalc,
+                    speed_recalc,
+                    calibrate,
+                    per_lap_cal,
+                    manual_lap_distance,
+                    current_cal_factor,
+                    lap_workers,
+                    recompute_summary,
+                    keep)
+        add_author(document)
+        return document
+
+    def add_to(self,
+               element,
+               dist_recalc=False,
+               speed_recalc=False,
+               calibrate=False,
+               per_lap_cal=False,
+               manual_lap_distance=None,
+               current_cal_factor=100.0,
+               lap_workers=1,
+               recompute_summary=False,
+               keep=None):
+        """
+        Add the Activity element for the given settings to an Activities
+        element (see render()), returning it
+        """
+        dist_recalc, per_lap_cal = calibration_options(dist_recalc,
+                                                       calibrate,
+                                                       per_lap_cal,
+                                                       manual_lap_distance)
+
+        activity_scaling_factor = self.scaling_factor()
+        new_cal_factor = activity_scaling_factor * current_cal_factor
+
+        lap_offsets = None
+        if lap_workers > 1:
+            lap_offsets = self.lap_offsets(dist_recalc,
+                                           speed_recalc,
+                                           calibrate,
+                                           per_lap_cal,
+                                           manual_lap_distance,
+                                           activity_scaling_factor)
+
+        lap_stats = None
+        if recompute_summary:
+            lap_stats = self.stats()[1]
+
+        actelem, total_distance = add_activity(element,
+                                               self.session,
+                                               self.activity,
+                                               dist_recalc,
+                                               speed_recalc,
+                                               calibrate,
+                                               current_cal_factor,
+                                               per_lap_cal,
+                                               manual_lap_distance,
+                                               activity_scaling_factor,
+                                               self.trackpoints,
+                                               lap_offsets,
+                                               lap_workers,
+                                               lap_stats,
+                                               keep)
+
+        if dist_recalc:
+            distance_used = self.total_calculated_distance
+        elif calibrate:
+            distance_used = total_distance
+        else:
+            distance_used = self.total_activity_distance
+
+        notes = activity_notes(self.session.get_value('num_laps'),
+                               distance_used,
+                               self.session.get_value('total_timer_time'),
+                               self.total_activity_distance,
+                               self.total_calculated_distance,
+                               current_cal_factor,
+                               new_cal_factor,
+                               dist_recalc,
+                               speed_recalc,
+                               calibrate,
+                               per_lap_cal,
+                               manual_lap_distance)
+        add_notes(actelem, notes)
+        manufacturer, product_name, product_id, serial_number = \
+            device_info(self.activity)
+        add_creator(actelem,
+                    manufacturer,
+                    product_name,
+                    product_id,
+                    serial_number
+                    )
+        return actelem
+
+
+def prepare_sessions(filename, time_zone="auto", gps_filter=None,
+                     verify=False, cache=False, resample=None):
+    """
+    Decode a FIT file (see decode_activity()) and prepare each of its
+    sessions as an activity (see split_sessions()), returning a list of
+    PreparedActivity, in order, and the time taken by each stage
+    """
+    activity, trackpoints, timings = decode_activity(filename, time_zone,
+                                                     verify, cache, resample)
+    started = time.time()
+    prepared = [PreparedActivity(filename, gps_filter=gps_filter,
+                                 decoded=(session, session_trackpoints, {}))
+                for session, session_trackpoints
+                in split_sessions(activity, trackpoints)]
+    timings['prepare'] = timings.get('prepare', 0.0) + time.time() - started
+    return (prepared, timings)
+
+
+def build_session(task):
+    """
+    Build the Activity element of a session in a worker process, returning
+    the serialized element
+    """
+    prepared, options, recompute_summary, keep = task
+    element = create_element("Activities")
+    actelem = prepared.add_to(element, *options,
+                              recompute_summary=recompute_summary,
+                              keep=keep)
+    return lxml.etree.tostring(actelem)
+
+
+def session_options(prepared, options):
+    """
+    The settings (as for PreparedActivity.render()) for each of the
+    sessions of a FIT file (see prepare_sessions()). The manual lap
+    distances are in the order of the laps in the whole file, so each
+    session is given those from its own first lap on.
+    """
+    manual_lap_distance = options[4]
+    if manual_lap_distance is None:
+        return [options] * len(prepared)
+    sessions = []
+    first_lap = 0
+    for session in prepared:
+        sessions.append(options[:4] + (manual_lap_distance[first_lap:],) +
+                        options[5:])
+        first_lap += len(session.laps)
+    return sessions
+
+
+def render_sessions(prepared, options, lap_workers=1, recompute_summary=False,
+                    keeps=None):
+    """
+    Build the TCX document for the sessions of a FIT file (see
+    prepare_sessions()), with an Activity for each session, for the given
+    settings (as for PreparedActivity.render(), see session_options()).
+    With several sessions and lap_workers > 1, the sessions are built in
+    parallel worker processes (each building its laps in turn), and
+    assembled in order; otherwise the laps of each session are built in
+    parallel.
+    """
+    if keeps is None:
+        keeps = [None] * len(prepared)
+    if len(prepared) == 1:
+        return prepared[0].render(*options,
+                                  lap_workers=lap_workers,
+                                  recompute_summary=recompute_summary,
+                                  keep=keeps[0])
+    document = create_document()
+    element = create_sub_element(document.getroot(), "Activities")
+    options = session_options(prepared, options)
+    if lap_workers > 1:
+        tasks = [(session, settings, recompute_summary, keep)
+                 for session, settings, keep in zip(prepared, options, keeps)]
+        pool = multiprocessing.Pool(min(lap_workers, len(tasks)))
+        try:
+            sessions = pool.map(build_session, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+        # Assemble sessions in order
+        for actxml in sessions:
+            element.append(lxml.etree.fromstring(actxml))
+    else:
+        for session, settings, keep in zip(prepared, options, keeps):
+            session.add_to(element, *settings,
+                           recompute_summary=recompute_summary,
+                           keep=keep)
     add_author(document)
     return document
 
 
-def main():
+def combine_summaries(summaries, current_cal_factor=100.0):
+    """
+    The summary of a FIT file with several sessions, from those of its
+    sessions (see PreparedActivity.summary()): the start time is the first
+    session's, the sport is the sessions' if they all have the same one (or
+    else "Multisport"), the laps are those of all the sessions, and the
+    distances, times and lap count are the totals over the sessions, with
+    the precision and scaling factor computed from them. The notes are each
+    session's activity notes in turn, and the recomputed summary values are
+    only given per session.
+    """
+    if len(summaries) == 1:
+        return summaries[0]
+    sports = set(summary['sport'] for summary in summaries)
+    totals = dict((name, sum(summary[name] or 0 for summary in summaries))
+                  for name in ('num_laps', 'total_time', 'stored_distance',
+                               'calculated_distance', 'distance_used'))
+    try:
+        scaling_factor = (totals['calculated_distance'] /
+                          totals['stored_distance'])
+    except ZeroDivisionError:
+        scaling_factor = 1.00
+    return dict(totals,
+                start_time=summaries[0]['start_time'],
+                sport=sports.pop() if len(sports) == 1 else "Multisport",
+                precision=distance_precision(totals['calculated_distance'],
+                                             totals['stored_distance']),
+                scaling_factor=scaling_factor,
+                new_cal_factor=scaling_factor * current_cal_factor,
+                notes="\n\n".join(summary['notes'] for summary in summaries),
+                recomputed=None,
+                laps=[lap for summary in summaries for lap in summary['laps']])
+
+
+class ConversionResult(object):
+
+    """
+    The result of converting a FIT file: the TCX document (None if only the
+    summary was requested), together with the computed totals behind the
+    activity notes, the recording device info and the track positions.
+    For a FIT file with several sessions, the totals are over all of them
+    (see combine_summaries()), and the summary of each session is in
+    sessions.
+    """
+
+    def __init__(self, document, summary, device, positions=None,
+                 decimated=None, num_trackpoints=None, timings=None,
+                 sessions=None):
+        self.document = document
+        self.sessions = sessions if sessions is not None else [summary]
+        self.positions = positions
+        # (trackpoints written, trackpoints that would be written without
+        # decimation) if the track was decimated
+        self.decimated = decimated
+        self.num_trackpoints = num_trackpoints
+        # Time taken by each stage of the conversion (and writing), in seconds
+        self.timings = timings if timings is not None else {}
+        self.start_time = summary['start_time']
+        self.sport = summary['sport']
+        self.num_laps = summary['num_laps']
+        self.total_time = summary['total_time']
+        self.stored_distance = summary['stored_distance']
+        self.calculated_distance = summary['calculated_distance']
+        self.distance_used = summary['distance_used']
+        self.precision = summary['precision']
+        self.scaling_factor = summary['scaling_factor']
+        self.new_cal_factor = summary['new_cal_factor']
+        self.notes = summary['notes']
+        self.recomputed = summary['recomputed']
+        self.laps = summary['laps']
+        (self.manufacturer,
+         self.product_name,
+         self.product_id,
+         self.serial_number) = device
+
+    @property
+    def reduction_ratio(self):
+        """Ratio of all trackpoints to those kept, if decimated"""
+        if self.decimated is None or not self.decimated[0]:
+            return None
+        return self.decimated[1] / self.decimated[0]
+
+    @property
+    def lap_scaling_factors(self):
+        return [lap['scaling_factor'] for lap in self.laps]
+
+    def as_dict(self):
+        """The summary values, as a JSON-serializable dict"""
+        values = {
+            'start_time': iso_Z_format(self.start_time),
+            'sport': self.sport,
+            'num_laps': self.num_laps,
+            'total_time': self.total_time,
+            'stored_distance': self.stored_distance,
+            'calculated_distance': self.calculated_distance,
+            'distance_used': self.distance_used,
+            'precision': self.precision,
+            'scaling_factor': self.scaling_factor,
+            'new_cal_factor': self.new_cal_factor,
+            'notes': self.notes,
+            'recomputed': self.recomputed,
+            'laps': self.laps,
+            'device': {
+                'manufacturer': self.manufacturer,
+                'product_name': self.product_name,
+                'product_id': self.product_id,
+                'serial_number': self.serial_number}}
+        if len(self.sessions) > 1:
+            values['sessions'] = [
+                dict(session, start_time=iso_Z_format(session['start_time']))
+                for session in self.sessions]
+        return values
+
+    def summary_text(self):
+        """The activity and lap notes (of each session), as text"""
+        return "\n\n".join(notes for session in self.sessions
+                           for notes in [session['notes']] +
+                           [lap['notes'] for lap in session['laps']])
+
+    def getroot(self):
+        """Root element of the TCX document"""
+        return self.document.getroot()
+
+    def tostring(self):
+        """Serialize the TCX document"""
+        return lxml.etree.tostring(self.document.getroot(),
+                                   pretty_print=True,
+                                   xml_declaration=True,
+                                   encoding="UTF-8")
+
+    def write(self, filename):
+        """
+        Write the TCX document to a file, atomically (so that a partly
+        written file never appears under the filename)
+        """
+        started = time.time()
+        with atomic_file(filename) as tcx:
+            tcx.write(self.tostring())
+        self.timings['write'] = time.time() - started
+
+    def stats(self):
+        """The number of trackpoints and stage timings, for fit2batch"""
+        return {'trackpoints': self.num_trackpoints,
+                'stages': dict(self.timings)}
+
+
+def decimation_text(result):
+    """A line reporting how much a decimated track was reduced"""
+    kept, total = result.decimated
+    return ("Trackpoints: {kept:d} of {total:d} kept "
+            "(reduction ratio {ratio:.1f}:1)".format(
+                kept=kept, total=total, ratio=result.reduction_ratio or 1.0))
+
+
+def convert(filename,
+            time_zone="auto",
+            dist_recalc=False,
+            speed_recalc=False,
+            calibrate=False,
+            per_lap_cal=False,
+            manual_lap_distance=None,
+            current_cal_factor=100.0,
+            lap_workers=1,
+            summary_only=False,
+            recompute_summary=False,
+            gps_filter=None,
+            decimate=None,
+            tolerance=None,
+            verify=False,
+            validate=False,
+            cache=False,
+            resample=None,
+            dem=None):
+    """
+    Convert a FIT file to TCX format, returning a ConversionResult.
+    If summary_only is set, only the values for the notes and lap summaries
+    are computed (from the trackpoints), without building the TCX document.
+    If recompute_summary is set, the lap heart rate and cadence
+    are recomputed from the trackpoints rather than taken from the FIT file.
+    The GPS filter for each sport can be given in gps_filter, as a dict of
+    sports and modes (see parse_gps_filter(); default: GPS_FILTERS).
+    If decimate is given (one of DECIMATION_MODES), only some of the
+    trackpoints are included in the TCX document (see decimate()), and
+    the lap totals are still computed from all of them.
+    If verify is set, the CRCs of the FIT file are checked as it is decoded,
+    and ChecksumError raised if it is corrupt.
+    If validate is set, the TCX document is validated against the TCX
+    schema, and ValidationError raised if it doesn't conform.
+    If cache is set, the decoded records are read from the FIT file's
+    sidecar if it is up to date, or written to it after decoding
+    (see write_sidecar()).
+    The records are resampled to trackpoints as given in resample, a dict
+    of the arguments of resample_trackpoints() (default: RESAMPLE_DEFAULTS).
+    A FIT file with several sessions (e.g. a triathlon) is converted to an
+    Activity for each session (see split_sessions()), which are built in
+    parallel if lap_workers > 1.
+    If dem is given, a folder of DEM tiles (see DemTiles), the altitude of
+    each trackpoint with a position is replaced by the elevation there.
+
+    Conversions do not share any state, so they can be run concurrently in
+    threads. Errors are raised as ConversionError (and subclasses), and
+    warnings are reported to the "fit2tcx" logger.
+    """
+
+    if calibrate and not dist_recalc and manual_lap_distance is None:
+        logger.warning("Calibration requested, enabling distance recalculation from GPS/footpod.")
+
+    prepared, timings = prepare_sessions(filename, time_zone, gps_filter,
+                                         verify, cache, resample)
+    if dem is not None:
+        started = time.time()
+        tiles = load_dem(dem)
+        corrected = sum(session.correct_elevation(tiles)
+                        for session in prepared)
+        if not corrected and any(len(session.positions())
+                                 for session in prepared):
+            logger.warning("No elevation data found in %s for the positions "
+                           "in %s", dem, filename)
+        timings['elevation'] = time.time() - started
+    options = (dist_recalc,
+               speed_recalc,
+               calibrate,
+               per_lap_cal,
+               manual_lap_distance,
+               current_cal_factor)
+    keeps = [None] * len(prepared)
+    decimated = None
+    if summary_only:
+        document = None
+    else:
+        if decimate is not None:
+            started = time.time()
+            keeps = [session.decimation(decimate, tolerance)
+                     for session in prepared]
+            decimated = (sum(session.written_trackpoints(keep)
+                             for session, keep in zip(prepared, keeps)),
+                         sum(session.written_trackpoints()
+                             for session in prepared))
+            timings['decimate'] = time.time() - started
+        started = time.time()
+        document = render_sessions(prepared,
+                                   options,
+                                   lap_workers,
+                                   recompute_summary,
+                                   keeps)
+        timings['render'] = time.time() - started
+        if validate:
+            started = time.time()
+            validate_document(document)
+            timings['validate'] = time.time() - started
+    started = time.time()
+    summaries = [session.summary(*settings,
+                                 recompute_summary=recompute_summary)
+                 for session, settings in zip(prepared,
+                                              session_options(prepared,
+                                                              options))]
+    timings['summary'] = time.time() - started
+
+    return ConversionResult(document,
+                            combine_summaries(summaries, current_cal_factor),
+                            device_info(prepared[0].activity),
+                            np.concatenate([session.positions()
+                                            for session in prepared]),
+                            decimated,
+                            sum(len(session.trackpoints)
+                                for session in prepared),
+                            timings,
+                            summaries)
+
+
+def strip_declarations(xml, nsmap):
+    """
+    Remove the namespace declarations in nsmap (e.g. those already made by
+    the root of a document) from the start tag of a serialized element
+    """
+    start_tag, rest = xml.split(b">", 1)
+    for prefix, uri in nsmap.items():
+        if prefix is None:
+            declaration = ' xmlns="' + uri + '"'
+        else:
+            declaration = ' xmlns:' + prefix + '="' + uri + '"'
+        start_tag = start_tag.replace(declaration.encode("utf-8"), b"")
+    return start_tag + b">" + rest
+
+
+# Elements of a TCX document that are written out piece by piece when
+# recalibrating; their other children are written out whole
+TCX_CONTAINERS = frozenset(TCD + tag for tag in ("TrainingCenterDatabase",
+                                                  "Activities",
+                                                  "Activity",
+                                                  "Lap",
+                                                  "Track"))
+
+
+def _float_text(element, path):
+    """The value of a child element as a float, or None"""
+    text = element.findtext(path)
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+class _TrackpointSteps(object):
+
+    """
+    Distance from GPS positions (and from the distance stream) between the
+    trackpoints of a TCX activity, as they are read in order. Steps without
+    positions at both ends, or implausibly fast for the sport, fall back on
+    the distance stream, as gps_delta() does.
+    """
+
+    def __init__(self, sport):
+        self.max_speed = MAX_GPS_SPEED.get(sport, MAX_GPS_SPEED['Other'])
+        self.prev = None
+
+    def step(self, trackpoint):
+        """Return (GPS distance, stream distance) from the previous trackpoint"""
+        try:
+            time = iso_Z_parse(trackpoint.findtext(TCD + "Time"))
+        except ValueError:
+            time = None
+        lat = _float_text(trackpoint, TCD + "Position/" + TCD + "LatitudeDegrees")
+        lon = _float_text(trackpoint, TCD + "Position/" + TCD + "LongitudeDegrees")
+        distance = _float_text(trackpoint, TCD + "DistanceMeters")
+        prev, self.prev = self.prev, (time, lat, lon, distance)
+        if prev is None:
+            return 0.0, 0.0
+        if distance is not None and prev[3] is not None:
+            stream = distance - prev[3]
+        else:
+            stream = 0.0
+        if None in (lat, lon, prev[1], prev[2]):
+            return stream, stream
+        lat1, lon1, lat2, lon2 = map(math.radians, (prev[1], prev[2], lat, lon))
+        a = (math.sin((lat2 - lat1) / 2) ** 2 +
+             math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+        gps = 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+        if time is not None and prev[0] is not None:
+            seconds = (time - prev[0]).total_seconds()
+        else:
+            seconds = None
+        if seconds and gps / seconds > self.max_speed:
+            return stream, stream
+        return gps, stream
+
+
+ISO_TIME = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?")
+
+
+def iso_Z_parse(text):
+    """
+    Parse an ISO 8601 UTC time (as written by iso_Z_format()) to a naive
+    datetime, quicker than strptime() for the many times in a TCX file
+    """
+    match = ISO_TIME.match(text or "")
+    if match is None:
+        raise ValueError("Unrecognised time: {!r}".format(text))
+    fields = [int(group) for group in match.groups()[:6]]
+    microseconds = int(round(float(match.group(7) or 0) * 1e6))
+    return datetime(*fields) + timedelta(microseconds=microseconds)
+
+
+def _iter_clear(source, events, tags=None):
+    """
+    iterparse() a document, clearing each element of interest (and its
+    finished siblings) once it has been dealt with, so that memory use
+    stays constant however long the document is
+    """
+    for event, element in lxml.etree.iterparse(source, events=events, tag=tags,
+                                               remove_blank_text=True):
+        yield event, element
+        if event == "end":
+            parent = element.getparent()
+            if parent is not None and parent.tag not in TCX_CONTAINERS:
+                continue    # still to be dealt with as part of its parent
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+
+
+def _survey_tcx(source):
+    """
+    First pass of recalibration: the stored & GPS distance of each lap, and
+    from the notes, the calibration factor setting of each activity and the
+    distance in the FIT file of each lap and activity, and the setting when
+    it was recorded (which the stored distance & the setting no longer are
+    once the file has been recalibrated)
+    """
+    activities = []
+    laps = steps = None
+    for event, element in _iter_clear(source, ("start", "end"),
+                                      (TCD + "Activity", TCD + "Lap",
+                                       TCD + "Trackpoint", TCD + "Notes",
+                                       TCD + "DistanceMeters")):
+        if event == "start":
+            if element.tag == TCD + "Activity":
+                laps = []
+                steps = _TrackpointSteps(element.get("Sport"))
+                activities.append({'laps': laps, 'cal_factor': None,
+                                   'recorded_cal_factor': None, 'fit': None})
+            elif element.tag == TCD + "Lap":
+                laps.append({'gps': 0.0, 'stream': 0.0, 'stored': None,
+                             'fit': None})
+            continue
+        if element.tag == TCD + "Trackpoint":
+            gps, stream = steps.step(element)
+            laps[-1]['gps'] += gps
+            laps[-1]['stream'] += stream
+        elif (element.tag == TCD + "DistanceMeters" and
+              element.getparent().tag == TCD + "Lap"):
+            laps[-1]['stored'] = _float_text(element, ".")
+        elif element.tag == TCD + "Notes":
+            if element.getparent().tag == TCD + "Activity":
+                summary = activities[-1]
+                match = re.search(r"calibration factor setting: ([0-9.]+)%",
+                                  element.text or "")
+                if match:
+                    summary['cal_factor'] = float(match.group(1))
+                match = re.search(r"\(([0-9.]+)% when recorded\)",
+                                  element.text or "")
+                if match:
+                    summary['recorded_cal_factor'] = float(match.group(1))
+            elif element.getparent().tag == TCD + "Lap":
+                summary = laps[-1]
+            else:
+                continue
+            match = re.search(r"Distance in FIT file: ([0-9.]+) km",
+                              element.text or "")
+            if match:
+                summary['fit'] = float(match.group(1)) * 1000
+    return activities
+
+
+def write_tcx_element(out, element, depth, nsmap):
+    """Write a whole element, indented, without the root's namespace declarations"""
+    element.tail = None
+    lxml.etree.indent(element, space="  ", level=depth)
+    out.write(b"\n" + b"  " * depth)
+    out.write(strip_declarations(lxml.etree.tostring(element), nsmap))
+
+
+def _container_tags(element, nsmap):
+    """The start & end tags of a container element, for writing piece by piece"""
+    shallow = lxml.etree.Element(element.tag, dict(element.attrib),
+                                 nsmap=element.nsmap)
+    xml = lxml.etree.tostring(shallow)
+    if element.getparent() is not None:
+        xml = strip_declarations(xml, nsmap)
+    name = xml[1:].split(b" ", 1)[0].split(b"/", 1)[0]
+    return xml[:-2] + b">", b"</" + name + b">"
+
+
+def recalibrate_tcx(source,
+                    destination,
+                    dist_recalc=False,
+                    calibrate=False,
+                    per_lap_cal=False,
+                    current_cal_factor=None,
+                    new_cal_factor=None):
+    """
+    Recalibrate a TCX file (written by fit2tcx, or anything else), as
+    convert() would have with the same options, streaming the document so
+    that memory use stays constant. The distance & speed in the file are
+    taken as those stored by the watch.
+
+    Either the distances & speeds are scaled by new_cal_factor /
+    current_cal_factor (the calibration factor setting when the activity
+    was recorded, read from the notes by default, or 100%; or for a file
+    that has been recalibrated to a new factor, that factor), or with
+    calibrate, by the ratio of the distance from the GPS positions in the
+    file to the stored distance, for the whole activity or per lap. With
+    dist_recalc (implied by calibrate), the trackpoint and lap distances
+    are recalculated from the GPS positions. The notes are updated to
+    match, with the calibration factor setting that the distances are now
+    for, and the distance in the FIT file as it was, so that recalibrating
+    again with the same options changes nothing. The document is read
+    twice: once to work out the lap distances and scaling factors, then
+    again to write the recalibrated copy (atomically, so the destination
+    can be the source).
+
+    Returns a dict with the numbers of activities, laps and trackpoints.
+    """
+    if calibrate and new_cal_factor is not None:
+        raise ValueError("Calibrate from either GPS or a new factor, not both")
+    if calibrate:
+        dist_recalc = True
+    scale = calibrate or new_cal_factor is not None
+
+    activities = _survey_tcx(source)
+    for activity in activities:
+        recorded = (current_cal_factor or activity['recorded_cal_factor'] or
+                    activity['cal_factor'] or 100.0)
+        if activity['recorded_cal_factor'] is not None:
+            # Recalibrated before, so the distances are for the setting
+            # in the notes rather than the one when it was recorded
+            factor = activity['cal_factor']
+        else:
+            factor = recorded
+        activity['cal_factor'] = factor
+        activity['recorded_cal_factor'] = recorded
+        laps = activity['laps']
+        for lap in laps:
+            if lap['fit'] is None:
+                lap['fit'] = lap['stored'] or 0.0
+        if activity['fit'] is None:
+            activity['fit'] = sum(lap['fit'] for lap in laps)
+        total_stored = sum(lap['stored'] or 0.0 for lap in laps)
+        total_gps = sum(lap['gps'] for lap in laps)
+        activity['stored'] = total_stored
+        activity['gps'] = total_gps
+        try:
+            activity_scaling_factor = total_gps / total_stored
+        except ZeroDivisionError:
+            activity_scaling_factor = 1.0
+        # Distances that are already calibrated (to within the metre that
+        # each lap's distance is stored to) aren't scaled again
+        if abs(total_gps - total_stored) < max(len(laps), 1):
+            activity_scaling_factor = 1.0
+        # New factors based on the distance in the FIT file, and the
+        # calibration factor setting that the distances are for once
+        # recalibrated (so that recalibrating again changes nothing)
+        try:
+            activity['new_cal_factor'] = total_gps / activity['fit'] * recorded
+        except ZeroDivisionError:
+            activity['new_cal_factor'] = recorded
+        if new_cal_factor is not None:
+            activity['setting'] = new_cal_factor
+        elif calibrate:
+            activity['setting'] = activity_scaling_factor * factor
+        else:
+            activity['setting'] = factor
+        for lap in laps:
+            if new_cal_factor is not None:
+                lap['scaling_factor'] = new_cal_factor / factor
+            elif calibrate and per_lap_cal:
+                try:
+                    lap['scaling_factor'] = lap['gps'] / lap['stored']
+                except (TypeError, ZeroDivisionError):
+                    lap['scaling_factor'] = 1.0
+                if abs(lap['gps'] - (lap['stored'] or 0.0)) < 1.0:
+                    lap['scaling_factor'] = 1.0
+            else:
+                lap['scaling_factor'] = activity_scaling_factor
+            lap['setting'] = factor * lap['scaling_factor'] if scale else factor
+            try:
+                lap['new_cal_factor'] = lap['gps'] / lap['fit'] * recorded
+            except ZeroDivisionError:
+                lap['new_cal_factor'] = recorded
+
+    counts = {'activities': len(activities), 'laps': 0, 'trackpoints': 0}
+    nsmap = {}
+    closing = []
+    activity = lap = steps = None
+    activity_index = -1
+    with atomic_file(destination) as out:
+        out.write(b"<?xml version='1.0' encoding='UTF-8'?>")
+        for event, element in _iter_clear(source, ("start", "end")):
+            tag = element.tag
+            parent = element.getparent()
+            if event == "start":
+                if tag in TCX_CONTAINERS:
+                    if parent is None:
+                        nsmap = dict(element.nsmap)
+                    start_tag, end_tag = _container_tags(element, nsmap)
+                    out.write(b"\n" + b"  " * len(closing) + start_tag)
+                    closing.append(end_tag)
+                    if tag == TCD + "Activity":
+                        activity_index += 1
+                        activity = activities[activity_index]
+                        activity['lap_index'] = -1
+                        activity['distance'] = 0.0
+                        activity['total_time'] = 0.0
+                        steps = _TrackpointSteps(element.get("Sport"))
+                    elif tag == TCD + "Lap":
+                        activity['lap_index'] += 1
+                        lap = activity['laps'][activity['lap_index']]
+                        counts['laps'] += 1
+                continue
+
+            if tag in TCX_CONTAINERS:
+                depth = len(closing) - 1
+                out.write(b"\n" + b"  " * depth + closing.pop())
+                continue
+            if parent is None or parent.tag not in TCX_CONTAINERS:
+                continue    # written out with its parent
+
+            if tag == TCD + "Trackpoint":
+                counts['trackpoints'] += 1
+                gps, stream = steps.step(element)
+                distance = element.find(TCD + "DistanceMeters")
+                if distance is not None and (dist_recalc or scale):
+                    if dist_recalc:
+                        activity['distance'] += gps
+                    else:
+                        activity['distance'] += stream * lap['scaling_factor']
+                    distance.text = "{:.1f}".format(activity['distance'])
+                if scale:
+                    for speed in element.iter(AX + "Speed"):
+                        speed.text = "{:.3f}".format(
+                            float(speed.text) * lap['scaling_factor'])
+
+            elif parent.tag == TCD + "Lap":
+                lap_distance = lap['stored'] or 0.0
+                if dist_recalc:
+                    lap_distance = lap['gps']
+                elif scale:
+                    # (in whole metres, as it's written)
+                    lap_distance = float(int(lap_distance *
+                                             lap['scaling_factor']))
+                if tag == TCD + "TotalTimeSeconds":
+                    lap['total_time'] = float(element.text)
+                    activity['total_time'] += lap['total_time']
+                elif tag == TCD + "DistanceMeters" and (dist_recalc or scale):
+                    element.text = "{:d}".format(int(lap_distance))
+                elif tag == TCD + "MaximumSpeed" and scale:
+                    element.text = "{:.3f}".format(
+                        float(element.text) * lap['scaling_factor'])
+                elif tag == TCD + "Extensions" and scale:
+                    for speed in element.iter(AX + "AvgSpeed"):
+                        speed.text = "{:.3f}".format(
+                            float(speed.text) * lap['scaling_factor'])
+                elif tag == TCD + "Notes":
+                    match = re.match(r"Lap (\d+):", element.text or "")
+                    element.text = lap_notes(
+                        int(match.group(1)) if match else activity['lap_index'] + 1,
+                        lap_distance,
+                        lap.get('total_time', 0.0),
+                        lap['fit'],
+                        lap['gps'],
+                        None,
+                        lap['setting'],
+                        lap['new_cal_factor'],
+                        activity['recorded_cal_factor'])
+
+            elif parent.tag == TCD + "Activity" and tag == TCD + "Notes":
+                if dist_recalc:
+                    distance_used = activity['gps']
+                elif scale:
+                    # (the lap distances as written, in whole metres)
+                    distance_used = sum(int((l['stored'] or 0.0) * l['scaling_factor'])
+                                        for l in activity['laps'])
+                else:
+                    distance_used = activity['stored']
+                try:
+                    element.text = activity_notes(
+                        len(activity['laps']),
+                        distance_used,
+                        activity['total_time'],
+                        activity['fit'],
+                        activity['gps'],
+                        activity['setting'],
+                        activity['new_cal_factor'],
+                        dist_recalc,
+                        False,
+                        calibrate,
+                        per_lap_cal and calibrate,
+                        None,
+                        activity['recorded_cal_factor'])
+                except ZeroDivisionError:
+                    pass    # no distance: leave the notes as they were
+
+            write_tcx_element(out, element, len(closing), nsmap)
+        out.write(b"\n")
+    return counts
+
+
+def recalibrate_main(argv):
+    """Read arguments from command line to recalibrate TCX files"""
+
+    parser = argparse.ArgumentParser(
+        prog="fit2tcx recalibrate",
+        description="Recalibrate the distance and speed in an existing TCX "
+                    "file, e.g. when the original FIT file is gone")
+
+    parser.add_argument("TcxFile", help="Input TCX file")
+    parser.add_argument("OutputFile", nargs="?", help="Output TCX file (default: overwrite the input file)")
+    parser.add_argument(
+        "-d",
+        "--recalculate-distance-from-gps",
+        action="store_true",
+        help="Recalculate distance from the GPS positions in the file")
+    parser.add_argument(
+        "-c",
+        "--calibrate-footpod",
+        action="store_true",
+        help="Use the GPS-measured distance to calibrate the footpod distance and speed")
+    parser.add_argument(
+        "-p",
+        "--per-lap-calibration",
+        action="store_true",
+        help="Apply footpod calibration on a per lap basis")
+    parser.add_argument(
+        "-f",
+        "--calibration-factor",
+        action="store",
+        type=float,
+        help="Calibration factor when the activity was recorded (default: read from the notes, or 100.0)")
+    parser.add_argument(
+        "-n",
+        "--new-calibration-factor",
+        action="store",
+        type=float,
+        help="Scale the distance and speed for this (corrected) calibration factor")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(message)s")
+
+    if args.calibrate_footpod and args.new_calibration_factor is not None:
+        parser.error("-c (--calibrate-footpod) and -n (--new-calibration-factor) can't be used together")
+    if not (args.recalculate_distance_from_gps or args.calibrate_footpod or
+            args.new_calibration_factor is not None):
+        parser.error("nothing to do: give -d, -c or -n")
+
+    start = time.time()
+    try:
+        counts = recalibrate_tcx(args.TcxFile,
+                                 args.OutputFile or args.TcxFile,
+                                 dist_recalc=args.recalculate_distance_from_gps,
+                                 calibrate=args.calibrate_footpod,
+                                 per_lap_cal=args.per_lap_calibration,
+                                 current_cal_factor=args.calibration_factor,
+                                 new_cal_factor=args.new_calibration_factor)
+    except (IOError, OSError, lxml.etree.XMLSyntaxError) as e:
+        sys.stderr.write(str(e) + "\n")
+        return 1
+    elapsed = time.time() - start
+    sys.stdout.write("{activities:d} activities, {laps:d} laps, "
+                     "{trackpoints:d} trackpoints recalibrated in {elapsed:.2f} s "
+                     "({rate:.0f} trackpoints per second)\n".format(
+                         elapsed=elapsed,
+                         rate=counts['trackpoints'] / elapsed if elapsed else 0,
+                         **counts))
+    return 0
+
+
+def makedirs(folder):
+    """Create a folder (and its parents), if it doesn't already exist"""
+    try:
+        os.makedirs(folder)
+    except OSError:
+        if not os.path.isdir(folder):
+            raise
+
+
+def benchmark_verification(filename, repeat=3):
+    """
+    Time decoding a FIT file without checking the CRCs, with
+    VerifyingFitFile, and with fitparse's own CRC check, and time
+    check_fit_file() on its own. The runs are interleaved, repeat times,
+    and the best time for each kept. Returns a dict of times in seconds.
+    """
+    runs = (('decode', lambda: FitFile(filename, check_crc=False).parse()),
+            ('verify', lambda: VerifyingFitFile(filename).parse()),
+            ('fitparse', lambda: FitFile(filename, check_crc=True).parse()),
+            ('check', lambda: check_fit_file(filename)))
+    times = {}
+    for _ in range(repeat):
+        for name, run in runs:
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            times[name] = min(times.get(name, elapsed), elapsed)
+    return times
+
+
+def verify_main(argv):
+    """Read arguments from command line to check FIT files"""
+
+    parser = argparse.ArgumentParser(
+        prog="fit2tcx verify",
+        description="Check the CRCs of FIT files, to find corrupt or "
+                    "truncated files, without converting them")
+
+    parser.add_argument("FitFile", nargs="+", help="Input FIT file(s)")
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action="store_true",
+        help="Also time decoding each file with and without checking the CRCs")
+    parser.add_argument(
+        "--repeat",
+        action="store",
+        default=3,
+        type=int,
+        help="Number of times to decode each file for the benchmark, taking the best time (defaults to 3)")
+
+    args = parser.parse_args(argv)
+
+    returncode = 0
+    totals = {}
+    for filename in args.FitFile:
+        try:
+            check_fit_file(filename)
+        except ConversionError as exception:
+            sys.stderr.write("{file!s}: {err!s}\n".format(file=filename,
+                                                         err=exception))
+            returncode = 1
+            continue
+        if not args.benchmark:
+            sys.stdout.write("{file!s}: OK\n".format(file=filename))
+            continue
+        times = benchmark_verification(filename, args.repeat)
+        for key, value in times.items():
+            totals[key] = totals.get(key, 0.0) + value
+        sys.stdout.write("{file!s}: OK; {text!s}\n".format(
+            file=filename, text=benchmark_text(times)))
+    if len(args.FitFile) > 1 and totals:
+        sys.stdout.write("Total: {text!s}\n".format(text=benchmark_text(totals)))
+    return returncode
+
+
+def benchmark_text(times):
+    """Format the times from benchmark_verification()"""
+    return ("decode {decode:.3f} s, with --verify {verify:.3f} s ({verify_cost:+.1f}%), "
+            "with fitparse's CRC check {fitparse:.3f} s ({fitparse_cost:+.1f}%), "
+            "CRC check alone {check:.4f} s").format(
+                verify_cost=(times['verify'] / times['decode'] - 1) * 100,
+                fitparse_cost=(times['fitparse'] / times['decode'] - 1) * 100,
+                **times)
+
+
+def benchmark_validation(filename, repeat=3):
+    """
+    Time validating a TCX file as a separate tool would, compiling the
+    schema and parsing the file each time, and as convert() does, with the
+    schema compiled once and the document already in memory. The runs are
+    interleaved, repeat times, and the best time for each kept. Returns a
+    dict of times in seconds.
+    """
+    document = lxml.etree.parse(filename)
+    schema = load_tcx_schema()
+    runs = (('separate', lambda: compile_tcx_schema().validate(
+                lxml.etree.parse(filename))),
+            ('validate', lambda: schema.validate(document)))
+    times = {}
+    for _ in range(repeat):
+        for name, run in runs:
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            times[name] = min(times.get(name, elapsed), elapsed)
+    return times
+
+
+def validation_benchmark_text(times):
+    """Format the times from benchmark_validation()"""
+    return ("compiling the schema & parsing each time {separate:.3f} s, "
+            "with --validate {validate:.3f} s ({saving:.0f}% less)").format(
+                saving=(1 - times['validate'] / times['separate']) * 100,
+                **times)
+
+
+def validate_main(argv):
+    """Read arguments from command line to validate TCX files"""
+
+    parser = argparse.ArgumentParser(
+        prog="fit2tcx validate",
+        description="Validate TCX files against the TCX schema, e.g. "
+                    "before uploading them")
+
+    parser.add_argument("TcxFile", nargs="+", help="Input TCX file(s)")
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action="store_true",
+        help="Also time validating each file with the schema compiled once and the file parsed once, and without")
+    parser.add_argument(
+        "--repeat",
+        action="store",
+        default=3,
+        type=int,
+        help="Number of times to validate each file for the benchmark, taking the best time (defaults to 3)")
+
+    args = parser.parse_args(argv)
+
+    returncode = 0
+    totals = {}
+    for filename in args.TcxFile:
+        try:
+            errors = schema_errors(lxml.etree.parse(filename))
+        except (IOError, OSError, lxml.etree.XMLSyntaxError) as e:
+            sys.stderr.write("{file!s}: {err!s}\n".format(file=filename,
+                                                         err=e))
+            returncode = 1
+            continue
+        for activity_id, message in errors:
+            sys.stderr.write("{file!s}: activity {id!s}: {err!s}\n".format(
+                file=filename, id=activity_id, err=message))
+        if errors:
+            returncode = 1
+            continue
+        if not args.benchmark:
+            sys.stdout.write("{file!s}: OK\n".format(file=filename))
+            continue
+        times = benchmark_validation(filename, args.repeat)
+        for key, value in times.items():
+            totals[key] = totals.get(key, 0.0) + value
+        sys.stdout.write("{file!s}: OK; {text!s}\n".format(
+            file=filename, text=validation_benchmark_text(times)))
+    if len(args.TcxFile) > 1 and totals:
+        sys.stdout.write("Total: {text!s}\n".format(
+            text=validation_benchmark_text(totals)))
+    return returncode
+
+
+def benchmark_summary(filename, repeat=3, **options):
+    """
+    Time converting a FIT file in full, and only computing the summary (as
+    with -m), with the given convert() options. The runs are interleaved,
+    repeat times, and the best time for each kept. Returns a dict of times
+    in seconds.
+    """
+    runs = (('convert', lambda: convert(filename, **options).tostring()),
+            ('summary', lambda: convert(filename, summary_only=True,
+                                        **options).as_dict()))
+    times = {}
+    for _ in range(repeat):
+        for name, run in runs:
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            times[name] = min(times.get(name, elapsed), elapsed)
+    return times
+
+
+def summary_benchmark_text(times):
+    """Format the times from benchmark_summary()"""
+    return ("full conversion {convert:.3f} s, summary only {summary:.3f} s "
+            "({speedup:.1f} times faster)").format(
+                speedup=times['convert'] / times['summary'], **times)
+
+
+def resample_options(parser, args):
+    """The resampling options (see resample_trackpoints()), from the arguments"""
+    if args.resample <= 0:
+        parser.error("--resample must be a positive number of seconds")
+    return {'interval': args.resample,
+            'subsecond': args.subsecond,
+            'speed': args.resample_speed}
+
+
+def check_tolerance(parser, args):
+    """Check that a decimation tolerance given in the arguments is positive"""
+    if args.tolerance is not None and not args.tolerance > 0:
+        parser.error("-t (--tolerance) must be a positive number")
+
+
+def peek_main(argv):
+    """Read arguments from command line to print FIT file metadata"""
+
+    parser = argparse.ArgumentParser(
+        prog="fit2tcx peek",
+        description="Print the start time, sport, distance and device of "
+                    "FIT activities, without converting them")
+
+    parser.add_argument("FitFile", nargs="+", help="Input FIT file(s)")
+    parser.add_argument(
+        "-z",
+        "--timezone",
+        action="store",
+        type=str,
+        default="auto",
+        help="Specify the timezone for FIT file timestamps (default, 'auto', uses GPS data to lookup the local timezone)")
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Output JSON")
+
+    args = parser.parse_args(argv)
+
+    returncode = 0
+    activities = []
+    for filename in args.FitFile:
+        try:
+            info = peek(filename, args.timezone)
+        except ConversionError as exception:
+            sys.stderr.write("{file!s}: {err!s}\n".format(file=filename,
+                                                         err=exception))
+            returncode = 1
+            continue
+        if args.json:
+            info['file'] = filename
+            for key in ('time_created', 'start_time'):
+                if isinstance(info[key], datetime):
+                    info[key] = iso_Z_format(info[key])
+            activities.append(info)
+        else:
+            sys.stdout.write(
+                "{file!s}: {start!s} {sport!s} {distance:.3f} km in {time!s} "
+                "({laps:d} laps), {manufacturer!s} {product!s} "
+                "(serial {serial!s})\n".format(
+                    file=filename,
+                    start=iso_Z_format(info['start_time']),
+                    sport=info['sport'],
+                    distance=info['total_distance'] / 1000,
+                    time=timedelta(seconds=int(info['total_time'])),
+                    laps=info['num_laps'],
+                    manufacturer=info['manufacturer'],
+                    product=info['product_name'],
+                    serial=info['serial_number']))
+    if args.json:
+        sys.stdout.write(json.dumps(activities, indent=2) + "\n")
+    return returncode
+
+
+# Subcommands of fit2tcx, in the order listed in the help
+SUBCOMMANDS = [
+    ("peek", "print the metadata of FIT files without converting them"),
+    ("verify", "check the CRCs of FIT files"),
+    ("validate", "validate TCX files against the TCX schema"),
+    ("batch", "convert many FIT files to a folder, resumably"),
+    ("bundle", "convert many FIT files into TCX files of many activities"),
+    ("queue", "convert a folder tree of FIT files, with other workers"),
+    ("recalibrate", "recalibrate the distance and speed in a TCX file"),
+    ("tail", "convert a FIT file while it is still being written")]
+
+# Subcommands that convert many files (or tail one), from fit2batch
+BATCH_SUBCOMMANDS = ("batch", "bundle", "queue", "tail")
+
+
+def subcommand(argv):
+    """The main function of the subcommand given in argv, or None
+
+    The first argument is taken as the FIT file to convert if there is a
+    file of that name, so that e.g. a FIT file named batch still converts
+    (as does any FIT file given after --).
+    """
+    if (not argv or argv[0] not in dict(SUBCOMMANDS) or
+            os.path.isfile(argv[0])):
+        return None
+    if argv[0] in BATCH_SUBCOMMANDS:
+        import fit2batch
+        return getattr(fit2batch, argv[0] + "_main")
+    return globals()[argv[0] + "_main"]
+
+
+def main(argv=None):
     """Read arguments from command line to convert FIT file to TCX"""
 
-    parser = argparse.ArgumentParser(prog="fit2tcx")
+    if argv is None:
+        argv = sys.argv[1:]
+    command = subcommand(argv)
+    if command is not None:
+        return command(argv[1:])
+
+    parser = argparse.ArgumentParser(
+        prog="fit2tcx",
+        usage="%(prog)s [options] FitFile [TcxFile]\n"
+              "       %(prog)s {" +
+              ",".join(name for name, text in SUBCOMMANDS) + "} ...",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="subcommands (see 'fit2tcx SUBCOMMAND -h'):\n" +
+               "".join("  {name:<13s} {text!s}\n".format(name=name, text=text)
+                       for name, text in SUBCOMMANDS) +
+               "\nA FIT file named for a subcommand is converted if it "
+               "exists,\nor if given after --.")
 
     parser.add_argument("FitFile", help="Input FIT file")
-    parser.add_argument("TcxFile", help="Output TCX file")
+    parser.add_argument("TcxFile", nargs="?", help="Output TCX file")
     parser.add_argument(
         "-v",
         "--version",
@@ -1045,8 +4633,100 @@ def main():
         default=100.0,
         type=float,
         help="Existing calibration factor (defaults to 100.0)")
+    parser.add_argument(
+        "-j",
+        "--lap-workers",
+        action="store",
+        default=1,
+        type=int,
+        help="Number of worker processes for building laps (or sessions, for a multisport activity) in parallel (defaults to 1, i.e. no parallel processing)")
+    parser.add_argument(
+        "-r",
+        "--recompute-summary",
+        action="store_true",
+        help="Recompute lap heart rate and cadence from the trackpoints")
+    parser.add_argument(
+        "-g",
+        "--gps-filter",
+        action="append",
+        metavar="[SPORT=]MODE",
+        help="GPS filter for distance and speed from GPS: median, kalman or none, for all sports or a given sport, e.g. Biking=kalman (default: median)")
+    parser.add_argument(
+        "-e",
+        "--decimate",
+        action="store",
+        choices=DECIMATION_MODES,
+        help="Only include some of the trackpoints in the TCX file, to make it smaller")
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        action="store",
+        type=float,
+        help="Tolerance for decimation, in seconds for interval and in metres for the others (defaults to 5, 10, 3 and 3)")
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the CRCs of the FIT file, so that a corrupt file fails to convert")
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Validate the TCX document against the TCX schema, so that an invalid one fails to convert")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Read the decoded records from a sidecar file next to the FIT file (FitFile.streams), instead of decoding it, writing the sidecar if it is missing or stale")
+    parser.add_argument(
+        "--resample",
+        action="store",
+        type=float,
+        default=1.0,
+        metavar="INTERVAL",
+        help="Resample the records to a trackpoint every INTERVAL seconds, with the mean heart rate and cadence and the last position, altitude and distance (default: 1)")
+    parser.add_argument(
+        "--resample-speed",
+        action="store",
+        choices=SPEED_REDUCTIONS,
+        default="last",
+        help="Speed of each resampled trackpoint: that of the last record, or the maximum or mean (default: last)")
+    parser.add_argument(
+        "--subsecond",
+        action="store_true",
+        help="Spread records in the same second evenly over it (e.g. for 4 Hz recording), to keep sub-second trackpoints with an INTERVAL under 1")
+    parser.add_argument(
+        "--dem",
+        action="store",
+        metavar="FOLDER",
+        help="Correct the altitude of trackpoints with positions from the DEM tiles (SRTM .hgt files) in FOLDER, offline")
+    parser.add_argument(
+        "-m",
+        "--summary",
+        nargs="?",
+        const="text",
+        choices=["text", "json"],
+        help="Only output a summary of the activity and laps, as text (default) or JSON, without converting to TCX")
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action="store_true",
+        help="With -m, also time a full conversion of the file with the same options, and the summary")
+    parser.add_argument(
+        "--repeat",
+        action="store",
+        default=3,
+        type=int,
+        help="Number of times to convert the file for the benchmark, taking the best time (defaults to 3)")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(message)s")
+
+    if args.TcxFile is None and args.summary is None:
+        parser.error("an output TCX file is required unless -m (--summary) is given")
+        return 1
 
-    args = parser.parse_args()
+    if args.benchmark and args.summary is None:
+        parser.error("-b (--benchmark) requires -m (--summary)")
+        return 1
 
     if (args.calibrate_footpod and
         not args.recalculate_distance_from_gps and
@@ -1054,25 +4734,53 @@ def main():
         parser.error("-c (--calibrate-footpod) requires either -d (--recalculate-distance-from-gps) or -l (--manual-lap-distance)")
         return 1
 
+    check_tolerance(parser, args)
+
+    try:
+        gps_filter = parse_gps_filter(args.gps_filter)
+    except ValueError as e:
+        parser.error(str(e))
+        return 1
+
+    options = dict(time_zone=args.timezone,
+                   dist_recalc=args.recalculate_distance_from_gps,
+                   speed_recalc=args.recalculate_speed_from_gps,
+                   calibrate=args.calibrate_footpod,
+                   per_lap_cal=args.per_lap_calibration,
+                   manual_lap_distance=args.manual_lap_distance,
+                   current_cal_factor=args.calibration_factor,
+                   lap_workers=args.lap_workers,
+                   recompute_summary=args.recompute_summary,
+                   gps_filter=gps_filter,
+                   decimate=args.decimate,
+                   tolerance=args.tolerance,
+                   verify=args.verify,
+                   validate=args.validate,
+                   cache=args.cache,
+                   resample=resample_options(parser, args),
+                   dem=args.dem)
     try:
-        document = convert(args.FitFile,
-                           args.timezone,
-                           args.recalculate_distance_from_gps,
-                           args.recalculate_speed_from_gps,
-                           args.calibrate_footpod,
-                           args.per_lap_calibration,
-                           args.manual_lap_distance,
-                           args.calibration_factor)
-        activity_notes = document.getroot().findtext(".//{*}Activity/{*}Notes")
-        if activity_notes is not None:
-            sys.stdout.write(str(activity_notes) + "\n")
-        tcx = open(args.TcxFile, 'wb')
-        tcx.write(lxml.etree.tostring(document.getroot(),
-                                      pretty_print=True,
-                                      xml_declaration=True,
-                                      encoding="UTF-8"))
+        result = convert(args.FitFile,
+                         summary_only=args.summary is not None,
+                         **options)
+        if args.summary == "json":
+            sys.stdout.write(json.dumps(result.as_dict(), indent=2) + "\n")
+        elif args.summary == "text":
+            sys.stdout.write(result.summary_text() + "\n")
+        if args.summary is not None:
+            if args.benchmark:
+                times = benchmark_summary(args.FitFile, args.repeat,
+                                          **options)
+                sys.stderr.write("{file!s}: {text!s}\n".format(
+                    file=args.FitFile, text=summary_benchmark_text(times)))
+            return 0
+        for session in result.sessions:
+            sys.stdout.write(str(session['notes']) + "\n")
+        if result.decimated is not None:
+            sys.stdout.write(decimation_text(result) + "\n")
+        result.write(args.TcxFile)
         return 0
-    except FitParseError as exception:
+    except ConversionError as exception:
         sys.stderr.write(str(exception) + "\n")
         return 1
 
@@ -6,8 +6,9 @@ block_cipher = None
 a = Analysis(['fit2tcx.py'],
              pathex=['.'],
              binaries=None,
-             datas=[(r'C:\Anaconda3\Lib\site-packages\tzwhere\tz_world_compact.json', 'tzwhere')],
-             hiddenimports=[],
+             datas=[(r'C:\Anaconda3\Lib\site-packages\tzwhere\tz_world_compact.json', 'tzwhere'),
+                    (r'schemas\*.xsd', 'schemas')],
+             hiddenimports=['fit2batch'],
              hookspath=None,
              runtime_hooks=None,
              excludes=None,
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fitfiles import make_fit
+
+
+@pytest.fixture
+def fit_file(tmpdir):
+    """A 30 minute run with 5 laps"""
+    return make_fit(str(tmpdir.join('run.fit')))
+
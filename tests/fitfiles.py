@@ -0,0 +1,198 @@
+#
+# Synthetic FIT activity files for the tests
+#
+
+import math
+import random
+import struct
+
+# Seconds between the UTC and FIT epochs (1989-12-31 00:00:00 UTC)
+START_TIME = 820000000
+
+# FIT base types, as (base type number, size, struct format, invalid value)
+BASE_TYPES = {'enum':   (0x00, 1, 'B', 0xFF),
+              'uint8':  (0x02, 1, 'B', 0xFF),
+              'sint32': (0x85, 4, 'i', 0x7FFFFFFF),
+              'uint16': (0x84, 2, 'H', 0xFFFF),
+              'uint32': (0x86, 4, 'I', 0xFFFFFFFF),
+              'uint32z': (0x8C, 4, 'I', 0x00000000),
+              'string': (0x07, 16, None, None)}
+
+FILE_ID = (0, [(0, 'enum'), (1, 'uint16'), (2, 'uint16'), (3, 'uint32z'),
+               (4, 'uint32')])
+RECORD = (20, [(253, 'uint32'), (0, 'sint32'), (1, 'sint32'), (2, 'uint16'),
+               (3, 'uint8'), (4, 'uint8'), (5, 'uint32'), (6, 'uint16')])
+LAP = (19, [(253, 'uint32'), (254, 'uint16'), (2, 'uint32'), (7, 'uint32'),
+            (8, 'uint32'), (9, 'uint32'), (11, 'uint16'), (13, 'uint16'),
+            (14, 'uint16'), (15, 'uint8'), (16, 'uint8'), (17, 'uint8'),
+            (18, 'uint8'), (23, 'enum'), (24, 'enum'), (25, 'enum')])
+SESSION = (18, [(253, 'uint32'), (2, 'uint32'), (5, 'enum'), (7, 'uint32'),
+                (8, 'uint32'), (9, 'uint32'), (26, 'uint16'),
+                (25, 'uint16')])
+DEVICE_INFO = (23, [(253, 'uint32'), (2, 'uint16'), (3, 'uint32z'),
+                    (4, 'uint16'), (19, 'string')])
+
+
+def crc16(data, crc=0):
+    """The FIT CRC of data (a bytearray)"""
+    table = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+             0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+    for byte in bytearray(data):
+        tmp = table[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ table[byte & 0xF]
+        tmp = table[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ table[(byte >> 4) & 0xF]
+    return crc
+
+
+def semicircles(degrees):
+    return int(round(degrees * 2 ** 31 / 180.0))
+
+
+class FitWriter(object):
+
+    """Writes FIT messages, with a local message type per global one"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.local = {}
+
+    def define(self, message):
+        number, fields = message
+        local = len(self.local)
+        self.local[number] = (local, fields)
+        self.data += struct.pack('<BBBHB', 0x40 | local, 0, 0, number,
+                                 len(fields))
+        for field, base_type in fields:
+            base, size = BASE_TYPES[base_type][:2]
+            self.data += struct.pack('BBB', field, size, base)
+
+    def write(self, message, values):
+        number, fields = message
+        if number not in self.local:
+            self.define(message)
+        local = self.local[number][0]
+        self.data += struct.pack('B', local)
+        for (field, base_type), value in zip(fields, values):
+            base, size, fmt, invalid = BASE_TYPES[base_type]
+            if fmt is None:
+                self.data += value.encode('ascii')[:size].ljust(size, b'\0')
+            else:
+                if value is None:
+                    value = invalid
+                self.data += struct.pack('<' + fmt, value)
+
+    def tobytes(self):
+        header = struct.pack('<BBHI4s', 14, 0x10, 2093, len(self.data),
+                             b'.FIT')
+        header += struct.pack('<H', crc16(header))
+        body = header + bytes(self.data)
+        return body + struct.pack('<H', crc16(body))
+
+
+def track(seconds, speed=3.0, noise=0.0, seed=1, lat=51.5, lon=-0.12):
+    """
+    Points along a curving track at about the given speed (m/s), one per
+    second, as lists of (true) positions, distances and speeds, with
+    normally distributed noise of the given standard deviation (in m)
+    added to the positions
+    """
+    rnd = random.Random(seed)
+    lats, lons, distances, speeds = [], [], [], []
+    distance = 0.0
+    for i in range(seconds + 1):
+        step = speed + 0.5 * math.sin(i / 60.0) if speed else 0.0
+        if i:
+            heading = i / 300.0
+            lat += step * math.cos(heading) / 111320.0
+            lon += step * math.sin(heading) / (
+                111320.0 * math.cos(math.radians(lat)))
+            distance += step
+        lats.append(lat + rnd.gauss(0.0, noise) / 111320.0)
+        lons.append(lon + rnd.gauss(0.0, noise) / (
+            111320.0 * math.cos(math.radians(lat))))
+        distances.append(distance)
+        speeds.append(step)
+    return lats, lons, distances, speeds
+
+
+def make_fit(path, seconds=1800, laps=5, sessions=1, sport=1, seed=1,
+             footpod_error=1.05, gaps=0, noise=0.0, start_time=START_TIME,
+             rate=1):
+    """
+    Write a FIT activity file of the given length (in seconds), starting
+    at start_time (in seconds since the FIT epoch), with laps of equal
+    length shared between sessions, a footpod distance that is
+    footpod_error times the true distance, and (if gaps is given) a record
+    without speed or position every gaps seconds. With a rate of more than
+    one, there are that many records in each second (all timestamped to
+    the second, as devices do), moving on between the positions of the
+    seconds, with heart rate, cadence and speed varying from one to the next
+    """
+    rnd = random.Random(seed)
+    lats, lons, distances, speeds = track(seconds, noise=noise, seed=seed)
+    records = []
+    for i in range(seconds + 1):
+        gap = gaps and i and i % gaps == 0
+        records.append((
+            start_time + i,
+            None if gap else semicircles(lats[i]),
+            None if gap else semicircles(lons[i]),
+            int((35 + 5 * math.sin(i / 200.0) + 500) * 5),
+            140 + int(10 * math.sin(i / 100.0)),
+            85 + rnd.randint(-2, 2),
+            int(distances[i] * footpod_error * 100),
+            None if gap else int(speeds[i] * footpod_error * 1000)))
+
+    per_lap = seconds // laps
+    lap_messages = []
+    for k in range(laps):
+        start = k * per_lap
+        end = seconds if k == laps - 1 else (k + 1) * per_lap
+        distance = (records[end][6] - records[start][6]) / 100.0
+        lap_messages.append((
+            start_time + end, k, start_time + start, (end - start) * 1000,
+            (end - start) * 1000, int(distance * 100), 50 + k,
+            int(distance / (end - start) * 1000),
+            max(r[7] or 0 for r in records[start:end + 1]),
+            145, 155, 85, 90, 0, 0, sport))
+
+    writer = FitWriter()
+    writer.write(FILE_ID, [4, 16, 255, 12345, start_time])
+    for i, record in enumerate(records):
+        writer.write(RECORD, record)
+        for m in range(1, rate if i < seconds else 1):
+            f = m / float(rate)
+            writer.write(RECORD, (
+                record[0],
+                semicircles(lats[i] + f * (lats[i + 1] - lats[i])),
+                semicircles(lons[i] + f * (lons[i + 1] - lons[i])),
+                record[3],
+                record[4] + m,
+                record[5] + m % 2,
+                int((distances[i] + f * (distances[i + 1] - distances[i])) *
+                    footpod_error * 100),
+                int(speeds[i] * footpod_error * 1000) + 10 * m))
+        if record[0] % 97 == 0:
+            # A heart rate only record in the same second, as from a strap
+            writer.write(RECORD, (record[0], None, None, None,
+                                  record[4] + 1, None, None, None))
+        for lap in lap_messages:
+            if lap[0] == record[0]:
+                writer.write(LAP, lap)
+    writer.write(DEVICE_INFO, [start_time, 16, 12345, 255, 'Run_Trainer_2.0'])
+    per_session = laps // sessions
+    for s in range(sessions):
+        first = s * per_session
+        last = laps - 1 if s == sessions - 1 else first + per_session - 1
+        start, end = lap_messages[first][2], lap_messages[last][0]
+        distance = sum(lap[5] for lap in lap_messages[first:last + 1])
+        writer.write(SESSION, [end, start, sport if sessions == 1 else
+                               (1, 2)[s % 2], (end - start) * 1000,
+                               (end - start) * 1000, distance,
+                               last - first + 1, first])
+    with open(path, 'wb') as f:
+        f.write(writer.tobytes())
+    return path
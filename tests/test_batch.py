@@ -0,0 +1,76 @@
+import json
+import os
+
+import fit2batch
+from fitfiles import make_fit
+
+OPTIONS = {'time_zone': "UTC"}
+
+
+def make_inputs(folder, count):
+    return [make_fit(str(folder.join('run%d.fit' % n)), seconds=300, laps=2,
+                     seed=n)
+            for n in range(count)]
+
+
+def journal_entries(path):
+    with open(path) as journal:
+        return [json.loads(line) for line in journal]
+
+
+def test_leftover_started_entries_count_as_crashes(tmpdir):
+    path = str(tmpdir.join('journal'))
+    with open(path, 'w') as journal:
+        for status in ("started", "failed", "started", "started"):
+            journal.write(json.dumps({'input': "a.fit", 'fingerprint': "1",
+                                      'status': status}) + "\n")
+        journal.write('{"input": "b.fit", "finger')   # cut short
+    journal = fit2batch.Journal(path)
+    journal.close()
+    assert journal.inputs == {'a.fit': {'fingerprint': "1",
+                                        'status': "crashed",
+                                        'failures': 1,
+                                        'crashes': 2}}
+    assert journal.state("a.fit", "2") is None
+
+    # Starting afresh ignores the journal
+    journal = fit2batch.Journal(path, resume=False)
+    journal.close()
+    assert journal.inputs == {} and os.path.getsize(path) == 0
+
+
+def test_resume_skips_done_and_quarantines_crashes(tmpdir):
+    filenames = make_inputs(tmpdir, 3)
+    output_folder = str(tmpdir.mkdir('out'))
+    path = os.path.join(output_folder, fit2batch.JOURNAL_FILENAME)
+    counts = fit2batch.batch_convert(filenames, output_folder, OPTIONS)
+    assert counts['done'] == 3
+    outputs = [os.path.join(output_folder, name)
+               for name in fit2batch.output_names(filenames)]
+    mtimes = [os.path.getmtime(output) for output in outputs]
+
+    # The last input then crashed the batch twice, and the second changed
+    crashed = filenames[2]
+    with open(path, 'a') as journal:
+        for _ in range(2):
+            journal.write(json.dumps({
+                'input': crashed,
+                'fingerprint': fit2batch.fingerprint(crashed, OPTIONS),
+                'status': "started"}) + "\n")
+    make_fit(filenames[1], seconds=360, laps=2, seed=1)
+
+    counts = fit2batch.batch_convert(filenames, output_folder, OPTIONS,
+                                   resume=True, max_crashes=2)
+    assert counts == {'done': 1, 'failed': 0, 'crashed': 0, 'skipped': 1,
+                      'quarantined': 1}
+    assert os.path.getmtime(outputs[0]) == mtimes[0]
+    assert [(entry['input'], entry['status'])
+            for entry in journal_entries(path)[-3:]] == [
+        (crashed, "quarantined"),
+        (filenames[1], "started"),
+        (filenames[1], "done")]
+
+    # A quarantined input stays quarantined
+    counts = fit2batch.batch_convert(filenames, output_folder, OPTIONS,
+                                   resume=True, max_crashes=2)
+    assert counts['skipped'] == 2 and counts['quarantined'] == 1
@@ -0,0 +1,95 @@
+import os
+
+import lxml.etree
+import pytest
+
+import fit2batch
+import fit2tcx
+from fitfiles import START_TIME, make_fit
+
+OPTIONS = {'time_zone': "UTC"}
+
+# Start days of the inputs, which aren't in order of their names
+START_DAYS = [3, 0, 4, 1, 2]
+
+
+def make_inputs(folder):
+    return [make_fit(str(folder.join('run%d.fit' % n)), seconds=300, laps=2,
+                     seed=n, start_time=START_TIME + day * 86400)
+            for n, day in enumerate(START_DAYS)]
+
+
+def bundle_ids(filename):
+    """The activity Ids of a bundle, checking it against the TCX schema"""
+    document = lxml.etree.parse(filename)
+    assert fit2tcx.schema_errors(document) == []
+    return [activity.findtext(fit2tcx.TCD + "Id")
+            for activity in document.iter(fit2tcx.TCD + "Activity")]
+
+
+def expected_ids(filenames):
+    return sorted(fit2tcx.convert(filename, **OPTIONS).getroot().findtext(
+        ".//" + fit2tcx.TCD + "Id") for filename in filenames)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_bundles_are_split_by_count(tmpdir, workers):
+    filenames = make_inputs(tmpdir)
+    prefix = str(tmpdir.join('bundle'))
+    files, num_activities, failed = fit2batch.bundle_convert(
+        filenames, prefix, OPTIONS, workers=workers, max_activities=2)
+    assert files == [prefix + "-%03d.tcx" % n for n in (1, 2, 3)]
+    assert num_activities == 5 and failed == []
+    ids = [bundle_ids(filename) for filename in files]
+    assert [len(bundle) for bundle in ids] == [2, 2, 1]
+    assert sum(ids, []) == expected_ids(filenames)
+
+
+def test_bundles_are_split_by_size(tmpdir):
+    filenames = make_inputs(tmpdir)
+    whole = fit2batch.bundle_convert(filenames, str(tmpdir.join('whole')),
+                                   OPTIONS)[0]
+    assert len(whole) == 1
+    # Room for two and a half activities
+    max_bytes = int(os.path.getsize(whole[0]) / 5.0 * 2.5)
+    files = fit2batch.bundle_convert(filenames, str(tmpdir.join('bundle')),
+                                   OPTIONS, max_bytes=max_bytes)[0]
+    assert all(os.path.getsize(filename) <= max_bytes for filename in files)
+    ids = [bundle_ids(filename) for filename in files]
+    assert [len(bundle) for bundle in ids] == [2, 2, 1]
+    assert sum(ids, []) == bundle_ids(whole[0]) == expected_ids(filenames)
+
+
+def test_unreadable_files_are_left_out(tmpdir):
+    filenames = make_inputs(tmpdir)
+    broken = str(tmpdir.join('broken.fit'))
+    with open(broken, 'wb') as f:
+        f.write(b'not a FIT file')
+    files, num_activities, failed = fit2batch.bundle_convert(
+        filenames[:2] + [broken], str(tmpdir.join('bundle')), OPTIONS)
+    assert num_activities == 2
+    assert [filename for filename, error in failed] == [broken]
+    assert bundle_ids(files[0]) == expected_ids(filenames[:2])
+
+
+def test_current_bundle_is_discarded_on_error(tmpdir, monkeypatch):
+    filenames = make_inputs(tmpdir)
+    convert = fit2batch._bundle_worker
+    converted = []
+
+    def interrupted(task):
+        if len(converted) == 3:
+            raise KeyboardInterrupt
+        converted.append(task[0])
+        return convert(task)
+
+    monkeypatch.setattr(fit2batch, '_bundle_worker', interrupted)
+    folder = tmpdir.mkdir('out')
+    prefix = str(folder.join('bundle'))
+    with pytest.raises(KeyboardInterrupt):
+        fit2batch.bundle_convert(filenames, prefix, OPTIONS, max_activities=2)
+
+    # The first bundle was complete, and the second (with one activity) is
+    # removed, leaving no temporary file
+    assert os.listdir(str(folder)) == ["bundle-001.tcx"]
+    assert bundle_ids(prefix + "-001.tcx") == expected_ids(filenames)[:2]
@@ -0,0 +1,29 @@
+import subprocess
+import sys
+
+import pytest
+
+import fit2tcx
+
+
+@pytest.mark.parametrize('mode', fit2tcx.DECIMATION_MODES)
+def test_decimated_count_is_what_was_written(fit_file, mode):
+    result = fit2tcx.convert(fit_file, time_zone="UTC", decimate=mode)
+    written = len(list(result.document.iter(fit2tcx.TCD + "Trackpoint")))
+    full = fit2tcx.convert(fit_file, time_zone="UTC")
+    total = len(list(full.document.iter(fit2tcx.TCD + "Trackpoint")))
+    assert result.decimated == (written, total)
+    assert total > full.num_trackpoints     # (lap boundaries are in two laps)
+
+
+@pytest.mark.parametrize('tolerance', ["0", "-5"])
+def test_tolerance_must_be_positive(fit_file, tmpdir, tolerance):
+    process = subprocess.Popen([sys.executable, fit2tcx.__file__,
+                                "-z", "UTC", "-e", "interval",
+                                "-t", tolerance, fit_file,
+                                str(tmpdir.join('run.tcx'))],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    assert process.returncode == 2
+    assert b"must be a positive number" in err
+    assert not tmpdir.join('run.tcx').exists()
@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+
+import fit2tcx
+
+# A 30 arc-second tile, N51W001.hgt, of heights that are linear in the
+# position, so bilinear interpolation gives them exactly
+SIDE = 121
+
+
+def height(lat, lon):
+    return 2 * (52 - lat) * (SIDE - 1) + (lon + 1) * (SIDE - 1)
+
+
+def write_tile(folder, name="N51W001.hgt", void_rows=0):
+    rows, cols = np.mgrid[0:SIDE, 0:SIDE]
+    heights = (2 * rows + cols).astype('>i2')
+    heights[:void_rows] = fit2tcx.DemTiles.VOID
+    heights.tofile(str(folder.join(name)))
+
+
+def test_elevations_are_interpolated(tmpdir):
+    write_tile(tmpdir)
+    tiles = fit2tcx.DemTiles(str(tmpdir))
+    lats = [51.55, 51.123, 51.0, 51.999]
+    lons = [-0.95, -0.456, -1.0, -0.001]
+    assert np.allclose(tiles.elevations(lats, lons),
+                       [height(lat, lon) for lat, lon in zip(lats, lons)])
+    # Outside the tiles in the folder
+    assert np.isnan(tiles.elevations([52.5, 51.5], [-0.5, 0.5])).all()
+    assert len(tiles.elevations([], [])) == 0
+
+
+def test_void_samples_are_skipped(tmpdir):
+    write_tile(tmpdir, void_rows=60)
+    tiles = fit2tcx.DemTiles(str(tmpdir))
+    # Between the last void row and the first with data, and just south
+    lats = [52 - 59.5 / 120, 52 - 60.5 / 120]
+    elevations = tiles.elevations(lats, [-0.5, -0.5])
+    assert math.isnan(elevations[0])
+    assert np.isclose(elevations[1], height(lats[1], -0.5))
+
+
+def test_tiles_are_evicted_least_recently_used(tmpdir):
+    for name in ("N51W001.hgt", "N51E000.hgt", "N52W001.hgt"):
+        write_tile(tmpdir, name)
+    tiles = fit2tcx.DemTiles(str(tmpdir), max_tiles=2)
+    first = tiles.tile(51, -1)
+    tiles.tile(51, 0)
+    assert tiles.tile(51, -1) is first          # still open
+    tiles.tile(52, -1)                          # evicts (51, 0)
+    assert list(tiles._tiles) == [(51, -1), (52, -1)]
+    assert tiles.tile(53, -1) is None           # missing tiles count too
+    assert list(tiles._tiles) == [(52, -1), (53, -1)]
+    assert tiles.tile(51, -1) is not first      # opened again
+
+
+def test_correct_elevation(tmpdir, fit_file):
+    write_tile(tmpdir, void_rows=60)
+    prepared = fit2tcx.PreparedActivity(fit_file, time_zone="UTC")
+    recorded = [tp['altitude'] for tp in prepared.trackpoints]
+    corrected = prepared.correct_elevation(fit2tcx.DemTiles(str(tmpdir)))
+    assert 0 < corrected < len(recorded)
+    changed = 0
+    for tp, altitude in zip(prepared.trackpoints, recorded):
+        y = (52 - tp['position_lat']) * (SIDE - 1)
+        if y >= 60:
+            expected = round(height(tp['position_lat'],
+                                    tp['position_long']), 1)
+            assert abs(tp['altitude'] - expected) < 1e-6
+            changed += 1
+        elif y < 59:
+            # Next to the void, so the recorded altitude is kept
+            assert tp['altitude'] == altitude
+    assert changed == corrected
+
+
+def test_convert_with_dem(tmpdir, fit_file):
+    write_tile(tmpdir)
+    result = fit2tcx.convert(fit_file, time_zone="UTC", dem=str(tmpdir))
+    trackpoints = list(result.getroot().iter(fit2tcx.TCD + "Trackpoint"))
+    assert trackpoints
+    for trackpoint in trackpoints:
+        lat = float(trackpoint.findtext(".//" + fit2tcx.TCD +
+                                        "LatitudeDegrees"))
+        lon = float(trackpoint.findtext(".//" + fit2tcx.TCD +
+                                        "LongitudeDegrees"))
+        altitude = float(trackpoint.findtext(fit2tcx.TCD + "AltitudeMeters"))
+        # (the position is written rounded)
+        assert abs(altitude - height(lat, lon)) < 0.1
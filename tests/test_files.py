@@ -0,0 +1,32 @@
+import os
+import stat
+
+import pytest
+
+import fit2tcx
+
+
+@pytest.mark.parametrize('umask', [0o022, 0o077])
+def test_atomic_file_is_created_as_open_would(tmpdir, umask):
+    previous = os.umask(umask)
+    try:
+        with open(str(tmpdir.join('plain')), 'wb') as f:
+            f.write(b'plain')
+        with fit2tcx.atomic_file(str(tmpdir.join('atomic'))) as f:
+            f.write(b'atomic')
+    finally:
+        os.umask(previous)
+    assert tmpdir.join('atomic').read_binary() == b'atomic'
+    assert (stat.S_IMODE(os.stat(str(tmpdir.join('atomic'))).st_mode) ==
+            stat.S_IMODE(os.stat(str(tmpdir.join('plain'))).st_mode) ==
+            0o666 & ~umask)
+
+
+def test_atomic_file_is_removed_if_writing_fails(tmpdir):
+    tmpdir.join('run.tcx').write_binary(b'old')
+    with pytest.raises(ValueError):
+        with fit2tcx.atomic_file(str(tmpdir.join('run.tcx'))) as f:
+            f.write(b'new')
+            raise ValueError("failed")
+    assert tmpdir.join('run.tcx').read_binary() == b'old'
+    assert tmpdir.listdir() == [tmpdir.join('run.tcx')]
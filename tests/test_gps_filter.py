@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import fit2tcx
+from fitfiles import make_fit, track
+
+
+def noisy_track(seconds, noise, speed=3.0):
+    lats, lons, distances, speeds = track(seconds, speed=speed, noise=noise)
+    return (np.arange(seconds + 1, dtype=float), np.array(lats),
+            np.array(lons), distances[-1], max(speeds))
+
+
+@pytest.mark.parametrize('mode', ["median", "kalman"])
+@pytest.mark.parametrize('seconds, noise', [(1800, 2.0), (14400, 4.0)])
+def test_noisy_track(mode, seconds, noise):
+    times, lat, lon, true_distance, max_speed = noisy_track(seconds, noise)
+    distance, speed = fit2tcx.filter_gps(times, lat, lon, mode,
+                                         fit2tcx.MAX_GPS_SPEED['Running'])
+    assert abs(np.nansum(distance) / true_distance - 1) < 0.015
+    assert np.nanmax(speed) < 1.5 * max_speed
+
+
+@pytest.mark.parametrize('shift', [slice(7200, None), slice(1000, 1003)])
+def test_median_filter_ignores_jumps(shift):
+    times, lat, lon, true_distance, max_speed = noisy_track(14400, 4.0,
+                                                            speed=10.0)
+    clean, _ = fit2tcx.filter_gps(times, lat, lon, "median",
+                                  fit2tcx.MAX_GPS_SPEED['Biking'])
+    lat[shift] += 200 / 111320.0
+    distance, speed = fit2tcx.filter_gps(times, lat, lon, "median",
+                                         fit2tcx.MAX_GPS_SPEED['Biking'])
+    assert abs(np.nansum(distance) / np.nansum(clean) - 1) < 0.001
+    assert np.nanmax(speed) < 1.5 * max_speed
+
+
+def test_associative_scan():
+    values = np.arange(1, 101, dtype=float)
+    for n in (1, 2, 3, 64, 100):
+        scanned, = fit2tcx.associative_scan(lambda a, b: (a[0] + b[0],),
+                                            (values[:n],))
+        assert (scanned == np.cumsum(values[:n])).all()
+
+
+def test_kalman_smooth_ignores_outliers():
+    times = np.arange(600, dtype=float)
+    x, y = 2.0 * times, -1.0 * times
+    valid = np.ones(len(times), dtype=bool)
+    valid[100:110] = False
+    x[300] += 500.0
+    sx, sy, vx, vy = fit2tcx.kalman_smooth(times, x, y, valid)
+    assert np.allclose(sx[20:], 2.0 * times[20:], atol=0.01)
+    assert np.allclose(sy[20:], -1.0 * times[20:], atol=0.01)
+    assert np.allclose(vx[20:], 2.0, atol=0.01)
+    assert np.allclose(vy[20:], -1.0, atol=0.01)
+
+
+def test_noisy_fit_file(tmpdir):
+    _, _, distances, _ = track(1800, noise=4.0)
+    filename = make_fit(str(tmpdir.join('run.fit')), noise=4.0)
+    result = fit2tcx.convert(filename, dist_recalc=True, time_zone="UTC")
+    assert abs(result.calculated_distance / distances[-1] - 1) < 0.015
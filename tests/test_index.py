@@ -0,0 +1,133 @@
+import os
+
+import fit2tcx
+import trt2index
+from fitfiles import START_TIME, make_fit
+
+
+def test_multisport_file_is_indexed_as_a_whole(tmpdir):
+    folder = str(tmpdir)
+    fit_path = os.path.join("2016", "FIT", "brick.fit")
+    os.makedirs(os.path.join(folder, "2016", "FIT"))
+    make_fit(os.path.join(folder, fit_path), laps=4, sessions=2)
+    result = fit2tcx.convert(os.path.join(folder, fit_path), time_zone="UTC")
+    assert len(result.sessions) == 2
+
+    activity, laps = trt2index.activity_rows(folder, fit_path, result, 100.0)
+    sessions = result.sessions
+    assert activity[5] == fit2tcx.iso_Z_format(sessions[0]['start_time'])
+    assert activity[6] == "Multisport"
+    assert activity[7] == 4
+    assert activity[8] == sum(session['total_time'] for session in sessions)
+    stored = sum(session['stored_distance'] for session in sessions)
+    calculated = sum(session['calculated_distance'] for session in sessions)
+    assert activity[9] == stored
+    assert activity[10] == calculated
+    assert abs(activity[11] - calculated / stored) < 1e-12
+    assert [lap[1] for lap in laps] == [1, 2, 3, 4]
+
+    db = trt2index.open_index(str(tmpdir.join('index.db')))
+    trt2index.store_activity(db, activity, laps)
+    assert db.execute("SELECT COUNT(*) FROM laps").fetchone()[0] == 4
+
+
+def make_archive(folder, activities):
+    """FIT files in a trt2import folder, from (name, day, sport, seconds)"""
+    paths = []
+    for name, day, sport, seconds in activities:
+        fit_path = os.path.join("2015", "FIT", name + ".fit")
+        if not os.path.exists(os.path.join(folder, "2015", "FIT")):
+            os.makedirs(os.path.join(folder, "2015", "FIT"))
+        make_fit(os.path.join(folder, fit_path), seconds=seconds, laps=2,
+                 sport=sport, start_time=START_TIME + day * 86400)
+        paths.append(fit_path)
+    return paths
+
+
+def indexed(db):
+    return dict((row['fit_path'], row) for row in trt2index.query(db))
+
+
+def test_rebuild_is_incremental(tmpdir):
+    folder = str(tmpdir.mkdir('archive'))
+    first, second, third = make_archive(folder, [("a", 0, 1, 300),
+                                                 ("b", 1, 1, 300),
+                                                 ("c", 2, 2, 300)])
+    db = trt2index.open_index(str(tmpdir.join('index.db')))
+    assert trt2index.rebuild(db, folder, "UTC") == (3, 0, 0, 0)
+    assert trt2index.rebuild(db, folder, "UTC") == (0, 3, 0, 0)
+
+    # Imported with a calibration factor, which is kept when reindexed
+    trt2index.index_activity(db, folder, os.path.join(folder, first),
+                             time_zone="UTC", calibration_factor=98.0)
+    rows = indexed(db)
+    assert rows[first]['calibration_factor'] == 98.0
+    assert (rows[first]['new_cal_factor'] ==
+            rows[first]['scaling_factor'] * 98.0)
+
+    # One changed, one removed, one added and one that can't be read
+    make_archive(folder, [("a", 0, 1, 360), ("d", 3, 1, 300)])
+    os.remove(os.path.join(folder, second))
+    with open(os.path.join(folder, "2015", "FIT", "e.fit"), 'wb') as f:
+        f.write(b'not a FIT file')
+    assert trt2index.rebuild(db, folder, "UTC") == (2, 1, 1, 1)
+    rows = indexed(db)
+    assert sorted(rows) == sorted([first, third,
+                                   os.path.join("2015", "FIT", "d.fit")])
+    assert rows[first]['total_time'] == 360
+    assert rows[first]['calibration_factor'] == 98.0
+    assert db.execute("SELECT COUNT(*) FROM laps WHERE fit_path = ?",
+                      (second,)).fetchone()[0] == 0
+
+    # A full rebuild reads them all again
+    assert trt2index.rebuild(db, folder, "UTC", full=True) == (3, 0, 0, 1)
+
+
+def test_parallel_rebuild_matches_sequential(tmpdir):
+    folder = str(tmpdir.mkdir('archive'))
+    make_archive(folder, [(name, day, 1 + day % 2, 300)
+                          for day, name in enumerate("abcde")])
+    results = []
+    for workers in (1, 3):
+        db = trt2index.open_index(str(tmpdir.join('index%d.db' % workers)))
+        assert trt2index.rebuild(db, folder, "UTC",
+                                 workers=workers) == (5, 0, 0, 0)
+        rows = trt2index.query(db)
+        for row in rows:
+            del row['indexed_at']
+        results.append((rows, trt2index.query(db, laps=True)))
+    assert results[0] == results[1]
+    assert len(results[0][0]) == 5 and len(results[0][1]) == 10
+
+
+def test_query_filters(tmpdir):
+    folder = str(tmpdir.mkdir('archive'))
+    make_archive(folder, [("run1", 0, 1, 300), ("ride", 1, 2, 600),
+                          ("run2", 2, 1, 900), ("run3", 3, 1, 300)])
+    db = trt2index.open_index(str(tmpdir.join('index.db')))
+    trt2index.rebuild(db, folder, "UTC")
+
+    def names(**filters):
+        return [os.path.basename(row['fit_path'])[:-4]
+                for row in trt2index.query(db, **filters)]
+
+    # Oldest first
+    assert names() == ["run1", "ride", "run2", "run3"]
+    assert names(sport="Running") == ["run1", "run2", "run3"]
+    assert names(sport="Biking") == ["ride"]
+    start = [row['start_time'] for row in trt2index.query(db)]
+    assert names(since=start[1]) == ["ride", "run2", "run3"]
+    assert names(until=start[2]) == ["run1", "ride"]
+    assert names(since=start[1], until=start[3], sport="Running") == ["run2"]
+    distances = dict(zip(names(), [row['stored_distance']
+                                   for row in trt2index.query(db)]))
+    assert names(min_distance=distances["run2"]) == ["run2"]
+    assert names(serial_number=12345) == names()
+    assert names(serial_number=1) == []
+
+    laps = trt2index.query(db, sport="Running", laps=True)
+    assert [(os.path.basename(lap['fit_path']), lap['lap_number'])
+            for lap in laps] == [(name + ".fit", number)
+                                 for name in ("run1", "run2", "run3")
+                                 for number in (1, 2)]
+    assert all(lap['sport'] == "Running" for lap in laps)
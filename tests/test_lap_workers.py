@@ -0,0 +1,55 @@
+import itertools
+
+import lxml.etree
+import pytest
+
+import fit2tcx
+from fitfiles import make_fit
+
+OPTIONS = list(itertools.product([False, True],             # dist_recalc
+                                 [False, True],             # speed_recalc
+                                 [False, True],             # calibrate
+                                 [False, True],             # per_lap_cal
+                                 [None, [1000.0, 500.0]]))  # manual laps
+
+
+@pytest.mark.parametrize('gaps', [0, 50])
+def test_parallel_laps_match_sequential(tmpdir, gaps):
+    filename = make_fit(str(tmpdir.join('run.fit')), seconds=600, gaps=gaps)
+    prepared = fit2tcx.PreparedActivity(filename, time_zone="UTC")
+    for options in OPTIONS:
+        for recompute_summary in (False, True):
+            sequential = prepared.render(*options,
+                                         recompute_summary=recompute_summary)
+            parallel = prepared.render(*options,
+                                       lap_workers=4,
+                                       recompute_summary=recompute_summary)
+            assert (lxml.etree.tostring(parallel) ==
+                    lxml.etree.tostring(sequential)), options
+
+
+def lap_values(lap):
+    """The totals and notes of a rendered Lap element"""
+    return {'distance': lap.findtext(fit2tcx.TCD + "DistanceMeters"),
+            'max_speed': lap.findtext(fit2tcx.TCD + "MaximumSpeed"),
+            'avg_speed': lap.findtext(".//" + fit2tcx.AX + "AvgSpeed"),
+            'notes': lap.findtext(fit2tcx.TCD + "Notes")}
+
+
+@pytest.mark.parametrize('gaps', [0, 50])
+def test_summary_matches_rendered_laps(tmpdir, gaps):
+    filename = make_fit(str(tmpdir.join('run.fit')), seconds=600, gaps=gaps)
+    prepared = fit2tcx.PreparedActivity(filename, time_zone="UTC")
+    for options in OPTIONS:
+        activity = prepared.render(*options).find(".//" + fit2tcx.TCD +
+                                                  "Activity")
+        summary = prepared.summary(*options)
+        rendered = [lap_values(lap)
+                    for lap in activity.iter(fit2tcx.TCD + "Lap")]
+        expected = [{'distance': "%d" % lap['lap_distance'],
+                     'max_speed': "%.3f" % lap['max_speed'],
+                     'avg_speed': "%.3f" % lap['avg_speed'],
+                     'notes': lap['notes']} for lap in summary['laps']]
+        assert rendered == expected, options
+        assert (activity.findtext(fit2tcx.TCD + "Notes") ==
+                summary['notes']), options
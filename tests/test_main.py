@@ -0,0 +1,36 @@
+import shutil
+
+import pytest
+
+import fit2batch
+import fit2tcx
+
+
+def test_subcommands_are_listed_in_the_help(capsys):
+    with pytest.raises(SystemExit):
+        fit2tcx.main(["-h"])
+    text = capsys.readouterr().out
+    for name, description in fit2tcx.SUBCOMMANDS:
+        assert "  %-13s %s\n" % (name, description) in text
+
+
+def test_subcommand_is_run(fit_file, capsys):
+    assert fit2tcx.main(["peek", "-z", "UTC", fit_file]) == 0
+    assert "Running" in capsys.readouterr().out
+
+
+def test_batch_subcommands_are_in_fit2batch():
+    assert fit2tcx.subcommand(["batch", "out"]) is fit2batch.batch_main
+    assert fit2tcx.subcommand(["tail", "run.fit"]) is fit2batch.tail_main
+    assert fit2tcx.subcommand(["peek", "run.fit"]) is fit2tcx.peek_main
+
+
+def test_fit_file_named_for_a_subcommand_converts(fit_file, tmpdir,
+                                                  monkeypatch, capsys):
+    monkeypatch.chdir(str(tmpdir))
+    shutil.copy(fit_file, 'batch')
+    assert fit2tcx.main(["batch", "run.tcx", "-z", "UTC"]) == 0
+    assert tmpdir.join('run.tcx').check(file=1)
+    # After --, even a FIT file that isn't there is taken as one
+    assert fit2tcx.main(["--", "peek", "run.tcx"]) == 1
+    assert "peek" in capsys.readouterr().err
@@ -0,0 +1,97 @@
+import io
+import json
+import re
+
+import fit2batch
+
+# A sample line of the Prometheus text format
+SAMPLE = re.compile(r'^(?P<name>[a-zA-Z0-9_:]+)(?:\{(?P<labels>.*)\})? (?P<value>\S+)$')
+
+
+def samples(path):
+    """The samples of a Prometheus text file, as {(name, labels): value}"""
+    values = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            match = SAMPLE.match(line.rstrip("\n"))
+            labels = tuple(re.findall(r'(\w+)="([^"]*)"',
+                                      match.group('labels') or ""))
+            values[match.group('name'), labels] = float(match.group('value'))
+    return values
+
+
+def buckets(values, name, labels=()):
+    """The cumulative buckets of a histogram, in order of their bounds"""
+    found = [(float(dict(key)['le']), value)
+             for (sample, key), value in values.items()
+             if sample == name + "_bucket" and key[:-1] == labels]
+    return [value for bound, value in sorted(found)]
+
+
+def test_events_and_metrics(tmpdir):
+    filename = str(tmpdir.join('run.fit'))
+    with open(filename, 'wb') as f:
+        f.write(b'\0' * 1000)
+    log_file = str(tmpdir.join('events.jsonl'))
+    metrics_file = str(tmpdir.join('metrics.prom'))
+    progress = io.StringIO()
+    metrics = fit2batch.RunMetrics("fit2tcx", total=3, log_file=log_file,
+                                 metrics_file=metrics_file,
+                                 progress=progress, overwrite=False)
+    metrics.activity(filename, "done", 0.3,
+                     stages={'decode': 0.2, 'render': 0.05},
+                     trackpoints=1800)
+    metrics.activity(filename, "failed", 1.5, stages={'decode': 1.5},
+                     error="bad file")
+    metrics.activity(filename, "skipped")
+    metrics.close()
+
+    with open(log_file) as f:
+        events = [json.loads(line) for line in f]
+    assert [event['event'] for event in events] == [
+        "run_started", "activity", "activity", "activity", "run_finished"]
+    assert events[0]['total'] == 3
+    done, failed, skipped = events[1:4]
+    assert (done['file'], done['outcome'], done['input_bytes'],
+            done['trackpoints'], done['seconds'], done['stages']) == (
+        filename, "done", 1000, 1800, 0.3, {'decode': 0.2, 'render': 0.05})
+    assert failed['outcome'] == "failed" and failed['error'] == "bad file"
+    assert skipped['outcome'] == "skipped" and skipped['seconds'] is None
+    assert events[-1]['outcomes'] == {'done': 1, 'failed': 1, 'skipped': 1}
+
+    values = samples(metrics_file)
+    for outcome in ("done", "failed", "skipped"):
+        assert values['fit2tcx_activities_total', (('outcome', outcome),)] == 1
+    # Skipped inputs aren't counted as input
+    assert values['fit2tcx_input_bytes_total', ()] == 2000
+    assert values['fit2tcx_trackpoints_total', ()] == 1800
+    assert values['fit2tcx_activities_expected', ()] == 3
+
+    # Histograms have cumulative buckets, ending with +Inf (the count)
+    activity = buckets(values, 'fit2tcx_activity_seconds')
+    assert len(activity) == len(fit2batch.METRICS_BUCKETS) + 1
+    assert activity == sorted(activity)
+    assert activity[fit2batch.METRICS_BUCKETS.index(0.25)] == 0
+    assert activity[fit2batch.METRICS_BUCKETS.index(0.5)] == 1
+    assert activity[-1] == values['fit2tcx_activity_seconds_count', ()] == 2
+    assert values['fit2tcx_activity_seconds_sum', ()] == 1.8
+    decode = (('stage', 'decode'),)
+    assert buckets(values, 'fit2tcx_stage_seconds', decode)[-1] == 2
+    assert values['fit2tcx_stage_seconds_sum', decode] == 1.7
+    assert values['fit2tcx_stage_seconds_count', (('stage', 'render'),)] == 1
+
+    with open(metrics_file) as f:
+        text = f.read()
+    assert "# TYPE fit2tcx_activity_seconds histogram\n" in text
+    assert "# TYPE fit2tcx_activities_total counter\n" in text
+    assert progress.getvalue().splitlines()[0].startswith("[1/3] 33%")
+
+
+def test_prometheus_sample():
+    assert fit2batch.prometheus_sample("up", (), 1) == "up 1"
+    assert fit2batch.prometheus_sample("t", (), 0.1) == "t 0.1"
+    assert (fit2batch.prometheus_sample(
+        "files_total", (("path", 'C:\\runs\\"new"\nfile'), ("le", 0.5)), 2) ==
+        'files_total{path="C:\\\\runs\\\\\\"new\\"\\nfile",le="0.5"} 2')
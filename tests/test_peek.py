@@ -0,0 +1,58 @@
+import pytest
+
+import fit2tcx
+from fitfiles import make_fit
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    """The names of the data messages decoded"""
+    names = []
+    parse = fit2tcx.FitFile._parse_data_message
+
+    def recording(self, header):
+        message = parse(self, header)
+        names.append(message.name)
+        return message
+
+    monkeypatch.setattr(fit2tcx.FitFile, '_parse_data_message', recording)
+    return names
+
+
+@pytest.mark.parametrize('time_zone', ["UTC", "America/New_York", "auto"])
+def test_peek_matches_convert(fit_file, time_zone):
+    info = fit2tcx.peek(fit_file, time_zone)
+    result = fit2tcx.convert(fit_file, time_zone=time_zone)
+    assert info['start_time'] == result.start_time
+    assert (fit2tcx.iso_Z_format(info['start_time']) ==
+            result.getroot().findtext(".//" + fit2tcx.TCD + "Id"))
+    assert info['timezone'] == ("Europe/London" if time_zone == "auto"
+                                else time_zone)
+    assert info['sport'] == result.sport == "Running"
+    assert info['total_distance'] == result.stored_distance
+    assert info['total_time'] == result.total_time
+    assert info['num_laps'] == result.num_laps == 5
+    assert ((info['manufacturer'], info['product_name'], info['product_id'],
+             info['serial_number']) ==
+            (result.manufacturer, result.product_name, result.product_id,
+             result.serial_number))
+    assert info['serial_number'] == 12345
+
+
+def test_records_are_skipped(fit_file, parsed):
+    fit2tcx.peek(fit_file, "UTC")
+    assert 'record' not in parsed
+    assert sorted(set(parsed)) == ['device_info', 'file_id', 'session']
+
+    # Only the first record with a position is needed for the timezone
+    del parsed[:]
+    fit2tcx.peek(fit_file, "auto")
+    assert parsed.count('record') == 1
+
+
+def test_decoding_stops_at_the_first_session(tmpdir, parsed):
+    filename = make_fit(str(tmpdir.join('brick.fit')), seconds=600, laps=4,
+                        sessions=2)
+    info = fit2tcx.peek(filename, "UTC")
+    assert parsed.count('session') == 1
+    assert info['sport'] == "Running" and info['num_laps'] == 2
@@ -0,0 +1,106 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+import fit2batch
+import fit2tcx
+from fitfiles import make_fit
+
+
+def make_inputs(folder, count):
+    names = []
+    for n in range(count):
+        name = "%s/run%d.fit" % ("ab"[n % 2], n)
+        path = os.path.join(folder, name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        make_fit(path, seconds=300, laps=2, seed=n)
+        names.append(name)
+    return names
+
+
+def test_lost_lease_is_left_to_the_new_holder(tmpdir):
+    input_folder = str(tmpdir.join('in'))
+    output_folder = str(tmpdir.join('out'))
+    name = make_inputs(input_folder, 1)[0]
+    first = fit2batch.WorkQueue(input_folder, output_folder, {}, "first",
+                              lease=1.0)
+    second = fit2batch.WorkQueue(input_folder, output_folder, {}, "second",
+                               lease=1.0)
+    assert first.claim(name) is False
+    assert second.claim(name) is None
+
+    # The first worker stalls past its lease, and the second reclaims it
+    lock = first._path(name, ".lock")
+    os.utime(lock, (time.time() - 10, time.time() - 10))
+    assert second.claim(name) is True
+    assert not first.heartbeat(name)
+    first.release(name)
+    assert os.path.exists(lock) and second.holds(name)
+    assert second.heartbeat(name)
+    second.release(name)
+    assert not os.path.exists(lock)
+
+
+def test_local_workers_share_a_folder(tmpdir, capsys):
+    input_folder = str(tmpdir.join('in'))
+    output_folder = str(tmpdir.join('out'))
+    names = make_inputs(input_folder, 6)
+
+    # A worker that died holding a lease on one of the files
+    queue = fit2batch.WorkQueue(input_folder, output_folder, {}, "dead",
+                              lease=0.5)
+    assert queue.claim(names[0]) is False
+    lock = queue._path(names[0], ".lock")
+    os.utime(lock, (time.time() - 10, time.time() - 10))
+
+    assert fit2batch.queue_main(["-z", "UTC", "-j", "2", "--lease", "0.5",
+                               input_folder, output_folder]) == 0
+    assert capsys.readouterr().out.startswith("6 converted, 0 failed")
+    for name in names:
+        assert os.path.exists(queue.output_file(name))
+        with open(queue._path(name, ".state")) as f:
+            state = json.load(f)
+        assert state['status'] == "done"
+        assert state['crashes'] == (1 if name == names[0] else 0)
+    assert not [path for path in os.listdir(queue.folder)
+                if path.endswith(".lock") or path.endswith(".stale")]
+
+
+def test_worker_stops_when_its_lease_is_lost(tmpdir, monkeypatch):
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the slow conversion is patched into forked workers")
+    input_folder = str(tmpdir.join('in'))
+    output_folder = str(tmpdir.join('out'))
+    name = make_inputs(input_folder, 1)[0]
+
+    def slow_convert(filename, **kwargs):
+        time.sleep(30)
+
+    monkeypatch.setattr(fit2tcx, 'convert', slow_convert)
+    queue = fit2batch.WorkQueue(input_folder, output_folder, {}, "first",
+                              lease=0.4)
+    other = fit2batch.WorkQueue(input_folder, output_folder, {}, "second",
+                              lease=0.4)
+
+    def reclaim():
+        # Stand in for the second worker reclaiming an expired lease
+        time.sleep(0.5)
+        lock = queue._path(name, ".lock")
+        os.remove(lock)
+        assert other.claim(name) is False
+
+    thread = threading.Thread(target=reclaim)
+    thread.start()
+    started = time.time()
+    assert queue.process(name) == "busy"
+    thread.join()
+    assert time.time() - started < 5
+    assert other.holds(name)
+    with open(queue._path(name, ".state")) as f:
+        assert json.load(f)['status'] == "started"
+    queue.worker.close()
@@ -0,0 +1,31 @@
+import pytest
+
+import fit2tcx
+
+
+def recalibrate(tcx_file, **kwargs):
+    fit2tcx.recalibrate_tcx(tcx_file, tcx_file, **kwargs)
+    with open(tcx_file, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(new_cal_factor=95.0),
+    dict(current_cal_factor=100.0, new_cal_factor=95.0),
+    dict(calibrate=True),
+    dict(calibrate=True, per_lap_cal=True),
+    dict(dist_recalc=True)])
+def test_recalibrating_again_changes_nothing(fit_file, tmpdir, kwargs):
+    tcx_file = str(tmpdir.join('run.tcx'))
+    fit2tcx.convert(fit_file, time_zone="UTC").write(tcx_file)
+    with open(tcx_file, 'rb') as f:
+        original = f.read().decode('utf-8')
+    fit_distance = original.split("Distance in FIT file: ")[1].split(";")[0]
+
+    once = recalibrate(tcx_file, **kwargs)
+    assert recalibrate(tcx_file, **kwargs) == once
+    notes = once.decode('utf-8')
+    assert notes.split("Distance in FIT file: ")[1].split(";")[0] == \
+        fit_distance
+    if 'new_cal_factor' in kwargs:
+        assert "setting: 95.0% (100.0% when recorded)" in notes
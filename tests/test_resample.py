@@ -0,0 +1,128 @@
+import math
+from datetime import timedelta
+
+import pytest
+
+import fit2tcx
+from fitfiles import make_fit
+
+# Fields reduced to their mean, the rest being the last value
+MEAN_FIELDS = ('heart_rate', 'cadence')
+
+
+@pytest.fixture(scope='module')
+def hz4_file(tmpdir_factory):
+    """Two minutes at 4 Hz (with some seconds of five records)"""
+    return make_fit(str(tmpdir_factory.mktemp('hz4').join('run.fit')),
+                    seconds=120, laps=2, rate=4, gaps=30)
+
+
+def raw_records(filename):
+    """The records, as (seconds since the FIT epoch, values) pairs"""
+    fit_file = fit2tcx.FitFile(filename,
+                               data_processor=fit2tcx.MyDataProcessor())
+    return [((record.get_value('timestamp') -
+              fit2tcx.FIT_EPOCH).total_seconds(),
+             dict((field, record.get_value(field))
+                  for field in fit2tcx.TRACKPOINT_FIELDS))
+            for record in fit_file.get_messages('record')]
+
+
+def expected_trackpoints(records, interval, subsecond, speed):
+    """Resample the records one by one, as resample_trackpoints() does"""
+    seconds = [t for t, values in records]
+    times = []
+    for i, t in enumerate(seconds):
+        first = seconds.index(t)
+        times.append(t + (float(i - first) / seconds.count(t)
+                          if subsecond else 0.0))
+    bins = [math.floor(t / interval + 1e-9) for t in times]
+    trackpoints = []
+    start = 0
+    while start < len(records):
+        end = start
+        while end < len(records) and bins[end] == bins[start]:
+            end += 1
+        in_bin = [values for t, values in records[start:end]]
+        # The last value may come from earlier in the same second
+        earlier = [values for t, values in
+                   records[seconds.index(seconds[start]):end]]
+        tp = {'timestamp': fit2tcx.FIT_EPOCH +
+              timedelta(seconds=times[start])}
+        for field in fit2tcx.TRACKPOINT_FIELDS:
+            valid = [values[field] for values in in_bin
+                     if values[field] is not None]
+            reduction = speed if field == 'speed' else (
+                "mean" if field in MEAN_FIELDS else "last")
+            if reduction == "mean":
+                mean = sum(valid) / float(len(valid)) if valid else None
+                if mean is not None and field in MEAN_FIELDS:
+                    mean = int(math.floor(mean + 0.5))
+                tp[field] = mean
+            elif reduction == "max":
+                tp[field] = max(valid) if valid else None
+            else:
+                valid = [values[field] for values in earlier
+                         if values[field] is not None]
+                tp[field] = valid[-1] if valid else None
+        trackpoints.append(tp)
+        start = end
+    return trackpoints
+
+
+def assert_same(trackpoints, expected):
+    assert len(trackpoints) == len(expected)
+    for tp, values in zip(trackpoints, expected):
+        assert tp['timestamp'] == values['timestamp']
+        for field in fit2tcx.TRACKPOINT_FIELDS:
+            if values[field] is None or tp[field] is None:
+                assert tp[field] == values[field], field
+            else:
+                assert abs(tp[field] - values[field]) < 1e-9, field
+        for field in MEAN_FIELDS:
+            assert tp[field] is None or type(tp[field]) is int
+
+
+@pytest.mark.parametrize('resample', [
+    dict(),
+    dict(speed="max"),
+    dict(speed="mean"),
+    dict(interval=2.0),
+    dict(interval=5.0, speed="mean"),
+    dict(interval=0.25, subsecond=True),
+    dict(interval=0.5, subsecond=True, speed="max")])
+def test_fields_are_reduced(hz4_file, resample):
+    records = raw_records(hz4_file)
+    activity, trackpoints, timings = fit2tcx.decode_activity(
+        hz4_file, "UTC", resample=dict(fit2tcx.RESAMPLE_DEFAULTS, **resample))
+    assert_same(list(trackpoints),
+                expected_trackpoints(records,
+                                     resample.get('interval', 1.0),
+                                     resample.get('subsecond', False),
+                                     resample.get('speed', "last")))
+
+
+def test_one_trackpoint_per_second(hz4_file):
+    records = raw_records(hz4_file)
+    trackpoints = fit2tcx.decode_activity(hz4_file, "UTC")[1]
+    assert len(records) > 4 * 120
+    assert len(trackpoints) == 121
+    # e.g. the heart rate is the mean over the second, and the distance
+    # and position the last
+    first = [values for t, values in records if t == records[0][0]]
+    assert len(first) == 4
+    assert trackpoints[0]['heart_rate'] == int(math.floor(
+        sum(values['heart_rate'] for values in first) / 4.0 + 0.5))
+    assert trackpoints[0]['distance'] == first[-1]['distance']
+    assert trackpoints[0]['position_lat'] == first[-1]['position_lat']
+    assert trackpoints[0]['speed'] == first[-1]['speed']
+
+
+def test_subsecond_conversion(hz4_file):
+    result = fit2tcx.convert(hz4_file, time_zone="UTC",
+                             resample=dict(interval=0.25, subsecond=True,
+                                           speed="last"))
+    times = [time.text for time in
+             result.getroot().iter(fit2tcx.TCD + "Time")]
+    assert any(".25" in text for text in times)
+    assert len(set(times)) > 4 * 120
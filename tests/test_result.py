@@ -0,0 +1,99 @@
+import re
+
+import pytest
+
+import fit2tcx
+
+# The values in the activity notes (see activity_notes())
+ACTIVITY_NOTES = re.compile(
+    r"(?P<laps>\d+) laps: (?P<used>[0-9.]+) km in .*\n"
+    r"Distance in FIT file: (?P<stored>[0-9.]+) km; "
+    r"calculated via GPS/footpod: (?P<calculated>[0-9.]+) km "
+    r"\(precision: (?P<precision>[0-9.]+)%\)\n"
+    r"Footpod calibration factor setting: (?P<setting>[0-9.]+)%; "
+    r"new factor based on recomputed distance: (?P<new>[0-9.]+)%$")
+
+# The new factor in the notes of a lap (see lap_notes())
+LAP_FACTOR = re.compile(r"new factor based on .* for this lap: ([0-9.]+)%$")
+
+MANUAL = [1000.0, 1250.0, 1100.0, 1200.0, 1150.0]
+
+
+@pytest.mark.parametrize('options', [
+    dict(),
+    dict(dist_recalc=True),
+    dict(dist_recalc=True, calibrate=True),
+    dict(dist_recalc=True, calibrate=True, per_lap_cal=True),
+    dict(calibrate=True, current_cal_factor=98.0),
+    dict(calibrate=True, manual_lap_distance=MANUAL)])
+def test_totals_match_the_document(fit_file, options):
+    result = fit2tcx.convert(fit_file, time_zone="UTC", **options)
+    dist_recalc, per_lap_cal = fit2tcx.calibration_options(
+        options.get('dist_recalc'), options.get('calibrate'),
+        options.get('per_lap_cal'), options.get('manual_lap_distance'))
+    activity = result.getroot().find(".//" + fit2tcx.TCD + "Activity")
+    notes = activity.findtext(fit2tcx.TCD + "Notes")
+    assert notes == result.notes
+    values = ACTIVITY_NOTES.search(notes).groupdict()
+    assert int(values['laps']) == result.num_laps == 5
+    assert values['stored'] == "%.3f" % (result.stored_distance / 1000)
+    assert values['calculated'] == "%.3f" % (result.calculated_distance / 1000)
+    assert values['used'] == "%.3f" % (result.distance_used / 1000)
+    assert values['precision'] == "%.1f" % result.precision
+    assert values['setting'] == "%.1f" % options.get('current_cal_factor',
+                                                     100.0)
+    assert values['new'] == "%.1f" % result.new_cal_factor
+
+    # The footpod reads 5% long, which GPS shows up
+    assert (result.scaling_factor ==
+            result.calculated_distance / result.stored_distance)
+    assert abs(result.scaling_factor * 1.05 - 1) < 0.01
+    assert (result.new_cal_factor ==
+            result.scaling_factor * options.get('current_cal_factor', 100.0))
+
+    # The lap totals
+    laps = list(activity.iter(fit2tcx.TCD + "Lap"))
+    assert len(laps) == len(result.laps) == 5
+    stored = 0.0
+    for element, lap in zip(laps, result.laps):
+        assert element.findtext(fit2tcx.TCD + "Notes") == lap['notes']
+        assert (LAP_FACTOR.search(lap['notes']).group(1) ==
+                "%.1f" % lap['new_cal_factor'])
+        assert (element.findtext(fit2tcx.TCD + "DistanceMeters") ==
+                "%d" % lap['lap_distance'])
+        reference = lap['calculated_distance']
+        if 'manual_lap_distance' in options:
+            reference = MANUAL[lap['lap_number'] - 1]
+            assert lap['lap_distance'] == reference
+        assert (lap['new_cal_factor'] ==
+                reference / lap['stored_distance'] *
+                options.get('current_cal_factor', 100.0))
+        if per_lap_cal:
+            assert lap['scaling_factor'] == reference / lap['stored_distance']
+        else:
+            assert lap['scaling_factor'] == result.scaling_factor
+        stored += lap['stored_distance']
+    assert abs(stored - result.stored_distance) < 1e-6
+    # A lap starts from the trackpoint before it (see sum_distance()), so
+    # the step into each boundary between laps is counted in both
+    overlap = (sum(lap['calculated_distance'] for lap in result.laps) -
+               result.calculated_distance)
+    assert 0 <= overlap < 4 * 5.0
+    assert result.lap_scaling_factors == [lap['scaling_factor']
+                                          for lap in result.laps]
+
+    # The trackpoint distances add up the lap distances (including the
+    # steps into the boundaries), which are the total used when calibrating
+    distances = [float(distance.text) for distance in activity.iter(
+        fit2tcx.TCD + "DistanceMeters") if distance.getparent().tag ==
+        fit2tcx.TCD + "Trackpoint"]
+    total = sum(lap['distance'] for lap in result.laps)
+    if dist_recalc:
+        assert result.distance_used == result.calculated_distance
+        assert abs(total - result.calculated_distance - overlap) < 1e-6
+    elif options.get('calibrate'):
+        assert result.distance_used == total
+    else:
+        assert result.distance_used == result.stored_distance
+    if dist_recalc or options.get('calibrate'):
+        assert abs(distances[-1] - total) < 0.05
@@ -0,0 +1,73 @@
+import lxml.etree
+
+import fit2tcx
+from fitfiles import make_fit
+
+
+def activities(result):
+    return list(result.getroot().iter(fit2tcx.TCD + "Activity"))
+
+
+def lap_starts(activity):
+    return [lap.get("StartTime")
+            for lap in activity.iter(fit2tcx.TCD + "Lap")]
+
+
+def test_each_session_is_an_activity(tmpdir):
+    filename = make_fit(str(tmpdir.join('brick.fit')), seconds=1200, laps=4,
+                        sessions=2)
+    result = fit2tcx.convert(filename, time_zone="UTC")
+    first, second = activities(result)
+    assert [first.get("Sport"), second.get("Sport")] == ["Running", "Biking"]
+    assert first.findtext(fit2tcx.TCD + "Id") < second.findtext(fit2tcx.TCD +
+                                                                "Id")
+
+    # The laps are assigned to the sessions by time
+    second_start = second.findtext(fit2tcx.TCD + "Id")
+    assert len(lap_starts(first)) == len(lap_starts(second)) == 2
+    assert all(start < second_start for start in lap_starts(first))
+    assert all(start >= second_start for start in lap_starts(second))
+    for activity in (first, second):
+        trackpoints = [time.text for time in
+                       activity.iter(fit2tcx.TCD + "Time")]
+        assert trackpoints == sorted(trackpoints)
+        assert trackpoints[0] >= activity.findtext(fit2tcx.TCD + "Id")
+    assert (list(second.iter(fit2tcx.TCD + "Time"))[0].text >
+            list(first.iter(fit2tcx.TCD + "Time"))[-1].text)
+
+    # Each activity has its session's notes, and the totals are combined
+    assert [activity.findtext(fit2tcx.TCD + "Notes")
+            for activity in (first, second)] == [session['notes'] for session
+                                                 in result.sessions]
+    assert result.notes == "\n\n".join(session['notes']
+                                       for session in result.sessions)
+    assert result.num_laps == 4
+    assert [lap['lap_number'] for lap in result.laps] == [1, 2, 3, 4]
+    assert result.total_time == sum(session['total_time']
+                                    for session in result.sessions)
+
+
+def test_sessions_built_in_parallel_are_in_order(tmpdir):
+    filename = make_fit(str(tmpdir.join('brick.fit')), seconds=1200, laps=6,
+                        sessions=3)
+    options = dict(time_zone="UTC", dist_recalc=True, calibrate=True)
+    sequential = fit2tcx.convert(filename, **options)
+    parallel = fit2tcx.convert(filename, lap_workers=3, **options)
+    assert len(activities(parallel)) == 3
+    assert (lxml.etree.tostring(parallel.getroot()) ==
+            lxml.etree.tostring(sequential.getroot()))
+
+
+def test_manual_lap_distances_follow_the_file(tmpdir):
+    filename = make_fit(str(tmpdir.join('brick.fit')), seconds=1200, laps=4,
+                        sessions=2)
+    distances = [1000.0, 1100.0, 1200.0, 1300.0]
+    for lap_workers in (1, 2):
+        result = fit2tcx.convert(filename, time_zone="UTC", calibrate=True,
+                                 manual_lap_distance=distances,
+                                 lap_workers=lap_workers)
+        assert [float(distance.text) for activity in activities(result)
+                for lap in activity.iter(fit2tcx.TCD + "Lap")
+                for distance in lap.findall(fit2tcx.TCD +
+                                            "DistanceMeters")] == distances
+        assert [lap['lap_distance'] for lap in result.laps] == distances
@@ -0,0 +1,54 @@
+import os
+
+import fit2tcx
+
+
+def test_cached_conversion_matches_decoded(fit_file):
+    expected = fit2tcx.convert(fit_file, time_zone="UTC").tostring()
+    assert fit2tcx.read_sidecar(fit_file, "UTC") is None
+    first = fit2tcx.convert(fit_file, time_zone="UTC", cache=True)
+    assert os.path.exists(fit2tcx.sidecar_filename(fit_file))
+    assert 'decode' in first.timings
+    cached = fit2tcx.convert(fit_file, time_zone="UTC", cache=True)
+    assert 'load' in cached.timings and 'decode' not in cached.timings
+    assert first.tostring() == cached.tostring() == expected
+
+
+def test_stale_sidecar_is_ignored(fit_file):
+    fit2tcx.convert(fit_file, time_zone="UTC", cache=True)
+    assert fit2tcx.read_sidecar(fit_file, "UTC") is not None
+    assert fit2tcx.read_sidecar(fit_file, "Europe/London") is None
+    with open(fit_file, 'ab') as f:
+        f.write(b'\0')
+    assert fit2tcx.read_sidecar(fit_file, "UTC") is None
+
+
+def test_unchanged_file_is_not_hashed(fit_file, monkeypatch):
+    activity, trackpoints, timings = fit2tcx.decode_activity(fit_file, "UTC",
+                                                             cache=True)
+
+    def hashed(filename):
+        raise AssertionError("hashed %s" % filename)
+    monkeypatch.setattr(fit2tcx, '_file_sha1', hashed)
+    cached = fit2tcx.read_sidecar(fit_file, "UTC")[1]
+    assert isinstance(cached, fit2tcx.Trackpoints)
+    assert list(cached) == list(trackpoints)
+
+
+def test_modified_file_is_hashed(fit_file):
+    fit2tcx.convert(fit_file, time_zone="UTC", cache=True)
+    stat = os.stat(fit_file)
+
+    # Touched (or copied), but the same: the sidecar is still used
+    os.utime(fit_file, (stat.st_atime, stat.st_mtime + 10))
+    assert fit2tcx.read_sidecar(fit_file, "UTC") is not None
+
+    # The same size, but changed
+    with open(fit_file, 'rb') as f:
+        data = bytearray(f.read())
+    data[20] ^= 0xff
+    with open(fit_file, 'wb') as f:
+        f.write(data)
+    os.utime(fit_file, (stat.st_atime, stat.st_mtime + 20))
+    assert os.path.getsize(fit_file) == stat.st_size
+    assert fit2tcx.read_sidecar(fit_file, "UTC") is None
@@ -0,0 +1,40 @@
+import pytest
+
+import fit2tcx
+from fitfiles import make_fit
+
+
+@pytest.mark.parametrize('options', [
+    dict(),
+    dict(dist_recalc=True),
+    dict(speed_recalc=True),
+    dict(dist_recalc=True, calibrate=True),
+    dict(dist_recalc=True, calibrate=True, per_lap_cal=True),
+    dict(calibrate=True, manual_lap_distance=[900.0, 950.0, 875.0])])
+def test_summary_only_matches_the_document(tmpdir, options):
+    filename = make_fit(str(tmpdir.join('run.fit')), seconds=900, laps=3,
+                        gaps=50)
+    full = fit2tcx.convert(filename, time_zone="UTC", **options)
+    summary = fit2tcx.convert(filename, time_zone="UTC", summary_only=True,
+                              **options)
+    assert summary.document is None
+    assert summary.as_dict() == full.as_dict()
+
+    activity = full.getroot().find(".//" + fit2tcx.TCD + "Activity")
+    assert activity.findtext(fit2tcx.TCD + "Notes") == summary.notes
+    laps = list(activity.iter(fit2tcx.TCD + "Lap"))
+    assert len(laps) == len(summary.laps) == 3
+    for element, lap in zip(laps, summary.laps):
+        assert element.findtext(fit2tcx.TCD + "Notes") == lap['notes']
+        assert (element.findtext(fit2tcx.TCD + "DistanceMeters") ==
+                "%d" % lap['lap_distance'])
+        assert (element.findtext(fit2tcx.TCD + "MaximumSpeed") ==
+                "%.3f" % lap['max_speed'])
+        assert (element.findtext(".//" + fit2tcx.AX + "AvgSpeed") ==
+                "%.3f" % lap['avg_speed'])
+
+
+def test_benchmark_summary(fit_file):
+    times = fit2tcx.benchmark_summary(fit_file, 1, time_zone="UTC")
+    assert sorted(times) == ['convert', 'summary']
+    assert "times faster" in fit2tcx.summary_benchmark_text(times)
@@ -0,0 +1,48 @@
+import struct
+
+import pytest
+
+import fit2batch
+import fit2tcx
+from fitfiles import make_fit
+
+
+def grow(path, data, chunk_size):
+    """
+    Write data as a device would while recording: with no data size in
+    the header, in chunks, then the CRC, and the header patched last
+    """
+    unpatched = data[:4] + struct.pack('<I', 0) + data[8:14]
+    yield unpatched
+    for end in range(14 + chunk_size, len(data) - 2, chunk_size):
+        yield unpatched + data[14:end]
+    yield unpatched + data[14:-2]
+    yield unpatched + data[14:]
+    yield data
+
+
+def message_names(path):
+    fit_file = fit2tcx.FitFile(path, data_processor=fit2tcx.MyDataProcessor())
+    return [message.name for message in fit_file.get_messages()]
+
+
+@pytest.mark.parametrize('seed', range(1, 9))
+def test_growing_file_is_read_to_the_end(tmpdir, seed):
+    source = make_fit(str(tmpdir.join('run.fit')), seconds=600, laps=2,
+                      seed=seed)
+    with open(source, 'rb') as f:
+        data = f.read()
+    path = str(tmpdir.join('growing.fit'))
+    names = []
+    fit_file = None
+    for contents in grow(path, data, 3000):
+        with open(path, 'wb') as f:
+            f.write(contents)
+        if fit_file is None:
+            fit_file = fit2batch.TailFitFile(
+                path, data_processor=fit2tcx.MyDataProcessor())
+        assert not fit_file.complete
+        names.extend(message.name for message in fit_file.read())
+    assert fit_file.complete
+    fit_file.close()
+    assert names == message_names(source)
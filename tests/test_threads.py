@@ -0,0 +1,57 @@
+import sys
+import threading
+
+import fit2tcx
+from fitfiles import make_fit
+
+
+def test_load_timezones_leaves_stdout_alone(monkeypatch):
+    seen = []
+
+    class Timezones(object):
+        def __init__(self):
+            seen.append(sys.stdout)
+
+    monkeypatch.setattr(fit2tcx.tzwhere, 'tzwhere', Timezones)
+    monkeypatch.setattr(fit2tcx, '_tzwhere', None)
+    stdout = sys.stdout
+    fit2tcx.load_timezones()
+    assert seen == [stdout]
+    assert sys.stdout is stdout
+    assert 'print' not in vars(fit2tcx.tzwhere)
+
+
+def test_concurrent_conversions_match_sequential(tmpdir, monkeypatch):
+    files = [make_fit(str(tmpdir.join('run%d.fit' % seed)), seconds=600,
+                      laps=3, seed=seed, gaps=seed * 20)
+             for seed in range(4)]
+    options = [dict(), dict(dist_recalc=True, calibrate=True),
+               dict(speed_recalc=True, decimate="douglas-peucker")]
+    tasks = [(filename, kwargs) for filename in files for kwargs in options]
+    expected = [fit2tcx.convert(filename, **kwargs).tostring()
+                for filename, kwargs in tasks]
+
+    results = dict((i, []) for i in range(len(tasks)))
+    errors = []
+
+    def worker(n):
+        # Each thread converts every file, starting from a different one
+        try:
+            for k in range(len(tasks)):
+                i = (n + k) % len(tasks)
+                filename, kwargs = tasks[i]
+                results[i].append(
+                    fit2tcx.convert(filename, **kwargs).tostring())
+        except Exception as e:
+            errors.append(e)
+
+    # The threads load the timezone data between them
+    monkeypatch.setattr(fit2tcx, '_tzwhere', None)
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    for i, outputs in results.items():
+        assert outputs == [expected[i]] * len(threads)
@@ -0,0 +1,89 @@
+import random
+import threading
+
+try:
+    from _thread import interrupt_main
+except ImportError:
+    from thread import interrupt_main
+
+import pytest
+
+import trt2upload
+
+
+@pytest.fixture
+def server():
+    server = trt2upload.MockUploadServer(("127.0.0.1", 0), latency=0.01)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def upload_queue(journal, server, **kwargs):
+    url = "http://127.0.0.1:{port:d}/".format(port=server.server_address[1])
+    pool = trt2upload.ClientPool(lambda: trt2upload.MockUploadGarmin(url),
+                                 size=kwargs.get('workers', 2))
+    return trt2upload.UploadQueue(journal, pool, **kwargs)
+
+
+def queue_files(tmpdir, count):
+    journal = trt2upload.UploadJournal(str(tmpdir))
+    for n in range(count):
+        path = tmpdir.join("activity%02d.tcx" % n)
+        path.write("activity %d" % n)
+        assert journal.add(str(path))
+    return journal
+
+
+def test_uploads_survive_failures_and_lost_responses(tmpdir, server):
+    random.seed(1)
+    server.failure_rate = 0.3
+    server.lost_rate = 0.2
+    journal = queue_files(tmpdir, 30)
+    results = upload_queue(journal, server, workers=4, retries=30,
+                           backoff=0.01, max_backoff=0.05).run()
+
+    assert len(results) == 30
+    assert set(status for _, status, _ in results) <= set(("uploaded",
+                                                           "exists"))
+    # Each activity is stored once, even when a lost response is retried
+    assert len(server.activities) == 30
+    assert server.requests > 30
+    assert sorted(message for _, _, message in results) == list(range(1, 31))
+    assert journal.pending() == []
+    journal.close()
+
+    # Nothing is left to upload when the journal is opened again
+    assert trt2upload.UploadJournal(str(tmpdir)).pending() == []
+
+
+def test_failing_uploads_are_left_pending(tmpdir, server):
+    server.failure_rate = 1.0
+    journal = queue_files(tmpdir, 3)
+    results = upload_queue(journal, server, retries=2, backoff=0.01).run()
+    assert [status for _, status, _ in results] == ["pending"] * 3
+    assert server.requests == 6
+    journal.close()
+    journal = trt2upload.UploadJournal(str(tmpdir))
+    assert len(journal.pending()) == 3
+    assert all(journal.uploads[path]['attempts'] == 2
+               for path in journal.pending())
+
+
+def test_interrupted_uploads_finish_before_the_journal_closes(tmpdir,
+                                                              server):
+    server.latency = 0.2
+    journal = queue_files(tmpdir, 20)
+    queue = upload_queue(journal, server, workers=2)
+    timer = threading.Timer(0.3, interrupt_main)
+    timer.start()
+    with pytest.raises(KeyboardInterrupt):
+        queue.run()
+    assert queue.running == 0
+    journal.close()
+    done = len(server.activities)
+    assert 0 < done < 20
+    assert len(trt2upload.UploadJournal(str(tmpdir)).pending()) == 20 - done
@@ -0,0 +1,110 @@
+import glob
+import os
+import threading
+import time
+
+import trt2watch
+from fitfiles import make_fit
+
+
+class RecordingImporter(trt2watch.Importer):
+
+    """An Importer that records the files it is asked to import, and their size"""
+
+    def __init__(self, *args, **kwargs):
+        trt2watch.Importer.__init__(self, *args, **kwargs)
+        self.calls = []
+
+    def import_file(self, fit_file, arrived=None):
+        self.calls.append((os.path.basename(fit_file),
+                           os.path.getsize(fit_file)))
+        return trt2watch.Importer.import_file(self, fit_file, arrived)
+
+
+def fit_data(tmpdir, name='source.fit'):
+    path = make_fit(str(tmpdir.join(name)), seconds=300, laps=2)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_later(steps):
+    """Write files in the background, as (delay, path, data) steps"""
+    def run():
+        for delay, path, data in steps:
+            time.sleep(delay)
+            with open(path, 'ab') as f:
+                f.write(data)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def watch(importer, inbox, run_for, settle):
+    try:
+        trt2watch.watch([inbox], importer, poll=True, interval=0.05,
+                        settle=settle, run_for=run_for)
+    finally:
+        importer.close()
+
+
+def imported(folder):
+    return sorted(os.path.basename(path)
+                  for path in glob.glob(os.path.join(folder, "*", "FIT",
+                                                     "*.fit")))
+
+
+def test_file_is_imported_once_it_has_settled(tmpdir):
+    data = fit_data(tmpdir)
+    inbox = str(tmpdir.mkdir('inbox'))
+    archive = str(tmpdir.join('archive'))
+    importer = RecordingImporter(archive, convert_to_tcx=True,
+                                 time_zone="UTC")
+    path = os.path.join(inbox, 'run.fit')
+    half = len(data) // 2
+    # The rest is written before the first part has settled
+    writer = write_later([(0.2, path, data[:half]), (0.2, path, data[half:])])
+    watch(importer, inbox, run_for=2.0, settle=0.5)
+    writer.join()
+    assert importer.calls == [('run.fit', len(data))]
+    assert len(importer.latencies) == 1 and importer.latencies[0] >= 0.5
+    assert len(imported(archive)) == 1
+    assert len(glob.glob(os.path.join(archive, "*", "TCX", "*.tcx"))) == 1
+
+
+def test_failed_imports_are_retried(tmpdir):
+    data = fit_data(tmpdir)
+    inbox = str(tmpdir.mkdir('inbox'))
+    archive = str(tmpdir.join('archive'))
+    importer = RecordingImporter(archive, time_zone="UTC")
+    path = os.path.join(inbox, 'run.fit')
+    junk = os.path.join(inbox, 'junk.fit')
+    half = len(data) // 2
+    # The first part settles (and fails to import) before the rest arrives
+    writer = write_later([(0.1, junk, b'not a FIT file'),
+                          (0.0, path, data[:half]),
+                          (1.1, path, data[half:])])
+    watch(importer, inbox, run_for=2.5, settle=0.3)
+    writer.join()
+
+    calls = [size for name, size in importer.calls if name == 'run.fit']
+    assert len(calls) >= 2 and calls[-1] == len(data)
+    assert all(size == half for size in calls[:-1])
+    assert len(imported(archive)) == 1
+
+    # A file that never imports is given up on
+    assert ([name for name, size in importer.calls].count('junk.fit') ==
+            trt2watch.MAX_RETRIES + 1)
+
+
+def test_files_in_the_archive_are_skipped(tmpdir):
+    data = fit_data(tmpdir)
+    inbox = tmpdir.mkdir('inbox')
+    # The archive is inside the watched folder, with an earlier import
+    archive = inbox.mkdir('archive')
+    archive.mkdir('2015').mkdir('FIT').join('old.fit').write(data, 'wb')
+    inbox.join('run.fit').write(data, 'wb')
+    importer = RecordingImporter(str(archive), time_zone="UTC")
+    watch(importer, str(inbox), run_for=1.0, settle=0.2)
+    # The new copy in the archive isn't imported again either
+    assert importer.calls == [('run.fit', len(data))]
+    assert len(imported(str(archive))) == 2
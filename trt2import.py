@@ -26,21 +26,36 @@ from __future__ import print_function, division
 import sys
 import os
 import argparse
+import logging
 import string
 import glob
 import shutil
 import struct
 import time
-import lxml.etree
 import subprocess
 import fit2tcx
-import UploadGarmin
+import fit2batch
+import trt2index
+import trt2upload
 
 __prog__ = "trt2import"
 __desc__ = "Timex Run Trainer 2.0 FIT file importer"
 __version__ = "4.2"
 
 
+def discard_fit(dstFit, error):
+    """
+    Remove a corrupt copy of a FIT file, so that it is copied again next
+    time (rather than skipped as previously imported)
+    """
+    print("Error: the copied FIT file is corrupt, discarding it. ({err!s})".format(
+        err=error))
+    try:
+        os.remove(dstFit)
+    except OSError:
+        pass
+
+
 def main():
     try:
         parser = argparse.ArgumentParser(prog=__prog__)
@@ -79,6 +94,9 @@ def main():
         parser.add_argument(
             "-p", "--per-lap-calibration",
             action="store_true", default=False, help="Apply footpod calibration on a per lap basis for TCX and GPX (default: apply calibration per activity)")
+        parser.add_argument(
+            "-r", "--recompute-summary",
+            action="store_true", default=False, help="Recompute lap heart rate and cadence from the trackpoints for TCX and GPX")
         parser.add_argument(
             "-f", "--calibration-factor",
             action="store", default=-1, type=float,
@@ -87,24 +105,76 @@ def main():
             "-z", "--timezone",
             action="store", default="auto", type=str,
             help="Override timezone detection (default: lookup timezone from GPS data)")
+        parser.add_argument(
+            "-x", "--no-index",
+            action="store_true", default=False, help="Don't add imported activities to the index in the folder")
+        parser.add_argument(
+            "--decimate",
+            action="store", choices=fit2tcx.DECIMATION_MODES,
+            help="Only include some of the trackpoints in TCX files, to make them smaller (e.g. for upload)")
+        parser.add_argument(
+            "--tolerance",
+            action="store", type=float,
+            help="Tolerance for decimation, in seconds for interval and in metres for the others (default: 5, 10, 3 and 3)")
+        parser.add_argument(
+            "--verify",
+            action="store_true", default=True,
+            help="Check the CRCs of the FIT files copied from the watch, and discard corrupt copies (default)")
+        parser.add_argument(
+            "--no-verify",
+            action="store_false", dest="verify",
+            help="Don't check the CRCs of the FIT files")
+        parser.add_argument(
+            "--validate",
+            action="store_true",
+            help="Validate the converted TCX files against the TCX schema, and don't save (or upload) invalid ones")
+        parser.add_argument(
+            "--cache",
+            action="store_true",
+            help="Write the decoded records of each FIT file to a sidecar file next to it (FILE.FIT.streams), so that converting it again is faster (with -t)")
+        parser.add_argument(
+            "--dem",
+            action="store", metavar="FOLDER",
+            help="Correct the altitude of trackpoints with positions in TCX and GPX files from the DEM tiles (SRTM .hgt files) in FOLDER, offline")
+        parser.add_argument(
+            "--bundle",
+            action="store", metavar="PREFIX",
+            help="Also write the converted activities into TCX files with many activities each, named PREFIX-001.tcx, etc. (implies -t)")
+        parser.add_argument(
+            "--bundle-max-activities",
+            action="store", type=int,
+            help="Maximum number of activities in each bundle (default: no limit)")
+        parser.add_argument(
+            "--bundle-max-size",
+            action="store", type=float,
+            help="Maximum size of each bundle, in MB (default: no limit)")
+        trt2upload.add_upload_arguments(parser)
+        fit2batch.add_metrics_arguments(parser)
         args = parser.parse_args()
 
+        # Warnings from fit2tcx are printed as before
+        logging.basicConfig(format="%(message)s")
+
         if (args.calibrate_footpod and
             not args.recalculate_distance):
             parser.error("-c (--calibrate-footpod) requires -d (--recalculate-distance)")
             return 1
 
-        # GPX conversion requires TCX, so make sure it's set if applicable:
-        if args.convert_to_gpx:
+        if args.tolerance is not None and not args.tolerance > 0:
+            parser.error("--tolerance must be a positive number")
+            return 1
+
+        # GPX conversion and bundles require TCX, so make sure it's set if applicable:
+        if args.convert_to_gpx or args.bundle:
             args.convert_to_tcx = True
 
         # Garmin Connect dependencies:
         if args.upload_to_gc:
             args.convert_to_tcx = True
-            if args.username is None:
+            if args.username is None and not args.mock_server:
                 parser.error("-u (--upload-to-gc) was requested, but a username was not specified with -n (--username)")
                 return 1
-            if args.password is None:
+            if args.password is None and not args.mock_server:
                 parser.error("-u (--upload-to-gc) was requested, but a password was not specified with -w (--password)")
                 return 1
 
@@ -121,6 +191,8 @@ def main():
             return 1
 
         fitFiles = glob.glob(os.path.join(activity_folder, "*", "*.FIT"))
+        sortedFiles, unreadable = fit2batch.chronological(fitFiles, args.timezone)
+        fitFiles = sortedFiles + sorted(filename for filename, _ in unreadable)
         numFitFiles = len(fitFiles)
         if not numFitFiles >= 1:
             print("No activities found")
@@ -149,132 +221,264 @@ def main():
                 watch_cal_factor = 100.0
 
         if args.upload_to_gc:
-            # Create GC upload object
-            gc = UploadGarmin.UploadGarmin()
+            # Open the upload queue in the destination folder; uploads left
+            # pending by a previous run are resumed along with the new ones
+            try:
+                if not os.path.exists(args.folder):
+                    os.makedirs(args.folder)
+                uploads = trt2upload.UploadJournal(args.folder)
+            except Exception as e:
+                print("Error: unable to open the upload queue in {path!s}. ({err!s})".format(
+                    path=args.folder, err=e))
+                return 1
+            upload_queue = trt2upload.upload_queue(uploads, args)
 
-            # LOGIN
-            if not gc.login(args.username, args.password):
-              print("Garmin Connect login failed - please verify your login credentials")
+            # LOGIN (the client is kept in the pool for the uploads)
+            try:
+                upload_queue.pool.put(upload_queue.pool.get())
+            except Exception as e:
+              print(e)
               return 1
             else:
-              print("Garmin Connect login successful for user {user!s}".format(user=args.username))
+              if not args.mock_server:
+                print("Garmin Connect login successful for user {user!s}".format(user=args.username))
+
+        if args.bundle:
+            bundle = fit2batch.BundleWriter(
+                args.bundle,
+                args.bundle_max_activities,
+                int(args.bundle_max_size * 1024 * 1024) if args.bundle_max_size else None)
+
+        if not args.no_index:
+            # Open the activity index in the destination folder
+            try:
+                if not os.path.exists(args.folder):
+                    os.makedirs(args.folder)
+                index_file = os.path.join(args.folder, trt2index.INDEX_FILENAME)
+                index = trt2index.open_index(index_file)
+                tracks = trt2index.TrackIndex(trt2index.tracks_folder(index_file))
+            except Exception as e:
+                print("Error: unable to open activity index. ({err!s})".format(err=e))
+                return 1
 
         numImported = 0
         overallReturnCode = 0
 
-        # Process FIT files on watch
-        for srcFit in fitFiles:
-
-            print()
-            print("Processing activity '{file!s}'...".format(
-                file=os.path.basename(srcFit)))
-
-            (path, filename) = os.path.split(srcFit)
-            date = os.path.basename(os.path.normpath(path))
-            year    = date[0:4]
-            month   = date[4:6]
-            day     = date[6:8]
-            hourmin = filename[0:4]
-            basename = "-".join([year, month, day]) + "_" + hourmin
-
-            dstYearFolder = os.path.join(args.folder, year)
-            dstFitFolder = os.path.join(dstYearFolder, "FIT")
-            dstTcxFolder = os.path.join(dstYearFolder, "TCX")
-            dstGpxFolder = os.path.join(dstYearFolder, "GPX")
-
-            # Create destination folders if needed:
-            if not os.path.exists(dstFitFolder):
-                os.makedirs(dstFitFolder)
-            if not os.path.exists(dstTcxFolder) and args.convert_to_tcx:
-                os.makedirs(dstTcxFolder)
-            if not os.path.exists(dstGpxFolder) and args.convert_to_gpx:
-                os.makedirs(dstGpxFolder)
-
-            dstFit  = os.path.join(dstFitFolder, basename + ".fit")
-            dstTcx  = os.path.join(dstTcxFolder, basename + ".tcx")
-            dstGpx  = os.path.join(dstGpxFolder, basename + ".gpx")
-
-            if os.path.exists(dstFit) and not args.overwrite:
-                print("This activity has previously been imported, skipping")
+        # Structured log, metrics and progress (if requested); the progress
+        # is shown a line at a time, among the messages for each activity
+        metrics = fit2batch.run_metrics(args, "trt2import", numFitFiles,
+                                      overwrite=False)
 
-            else:
-                # Copy the FIT file
-                try:
-                    shutil.copy2(srcFit, dstFit)
-                    numImported += 1
-                    print("FIT file copied to {path!s}".format(
-                        path=dstFit))
-                except IOError as e:
-                    print("Error: unable to copy FIT file. ({err!s})".format(
-                        err=e))
-                    overallReturnCode = 2
-                    continue
+        # Process FIT files on watch, in order of their start time (files
+        # that can't be read are left to the end, where the error is reported)
+        try:
+            for srcFit in fitFiles:
+
+                print()
+                print("Processing activity '{file!s}'...".format(
+                    file=os.path.basename(srcFit)))
+
+                result = None
+                started = time.time()
+                stages = {}
+                (path, filename) = os.path.split(srcFit)
+                date = os.path.basename(os.path.normpath(path))
+                year    = date[0:4]
+                month   = date[4:6]
+                day     = date[6:8]
+                hourmin = filename[0:4]
+                basename = "-".join([year, month, day]) + "_" + hourmin
+
+                dstYearFolder = os.path.join(args.folder, year)
+                dstFitFolder = os.path.join(dstYearFolder, "FIT")
+                dstTcxFolder = os.path.join(dstYearFolder, "TCX")
+                dstGpxFolder = os.path.join(dstYearFolder, "GPX")
+
+                # Create destination folders if needed:
+                if not os.path.exists(dstFitFolder):
+                    os.makedirs(dstFitFolder)
+                if not os.path.exists(dstTcxFolder) and args.convert_to_tcx:
+                    os.makedirs(dstTcxFolder)
+                if not os.path.exists(dstGpxFolder) and args.convert_to_gpx:
+                    os.makedirs(dstGpxFolder)
 
-                # Convert to TCX
-                if args.convert_to_tcx:
+                dstFit  = os.path.join(dstFitFolder, basename + ".fit")
+                dstTcx  = os.path.join(dstTcxFolder, basename + ".tcx")
+                dstGpx  = os.path.join(dstGpxFolder, basename + ".gpx")
+
+                if os.path.exists(dstFit) and not args.overwrite:
+                    print("This activity has previously been imported, skipping")
+                    metrics.activity(srcFit, "skipped", output=dstFit)
+
+                else:
+                    # Copy the FIT file
                     try:
-                        document = fit2tcx.convert(srcFit,
-                                                   time_zone=args.timezone,
-                                                   dist_recalc=args.recalculate_distance,
-                                                   speed_recalc=args.recalculate_speed,
-                                                   calibrate=args.calibrate_footpod,
-                                                   per_lap_cal=args.per_lap_calibration,
-                                                   manual_lap_distance=None,
-                                                   current_cal_factor=watch_cal_factor)
-                        tcxFile = open(dstTcx, 'wb')
-                        tcxFile.write(lxml.etree.tostring(
-                            document.getroot(),
-                            pretty_print=True,
-                            xml_declaration=True,
-                            encoding="UTF-8")
-                        )
-                        tcxFile.close()
-                        print("Converted TCX file saved to {path!s}".format(path=dstTcx))
-                    except Exception as e:
-                        print("Error: unable to convert FIT file to TCX. ({err!s})".format(
+                        shutil.copy2(srcFit, dstFit)
+                        numImported += 1
+                        print("FIT file copied to {path!s}".format(
+                            path=dstFit))
+                    except IOError as e:
+                        print("Error: unable to copy FIT file. ({err!s})".format(
                             err=e))
                         overallReturnCode = 2
+                        metrics.activity(srcFit, "failed", time.time() - started,
+                                         error=str(e), output=dstFit)
                         continue
+                    stages['copy'] = time.time() - started
+
+                    # Check the copy isn't corrupt (if converting, the CRCs are
+                    # checked as it is decoded, below)
+                    if args.verify and not args.convert_to_tcx:
+                        stage_started = time.time()
+                        try:
+                            fit2tcx.check_fit_file(dstFit)
+                        except fit2tcx.ConversionError as e:
+                            discard_fit(dstFit, e)
+                            numImported -= 1
+                            overallReturnCode = 2
+                            metrics.activity(srcFit, "corrupt", time.time() - started,
+                                             stages, error=str(e), output=dstFit)
+                            continue
+                        stages['verify'] = time.time() - stage_started
+
+                    # Convert to TCX
+                    if args.convert_to_tcx:
+                        try:
+                            result = fit2tcx.convert(dstFit,
+                                                     time_zone=args.timezone,
+                                                     dist_recalc=args.recalculate_distance,
+                                                     speed_recalc=args.recalculate_speed,
+                                                     calibrate=args.calibrate_footpod,
+                                                     per_lap_cal=args.per_lap_calibration,
+                                                     manual_lap_distance=None,
+                                                     current_cal_factor=watch_cal_factor,
+                                                     recompute_summary=args.recompute_summary,
+                                                     decimate=args.decimate,
+                                                     tolerance=args.tolerance,
+                                                     verify=args.verify,
+                                                     validate=args.validate,
+                                                     cache=args.cache,
+                                                     dem=args.dem)
+                            result.write(dstTcx)
+                            print("Converted TCX file saved to {path!s}".format(path=dstTcx))
+                            if result.decimated is not None:
+                                print(fit2tcx.decimation_text(result))
+                            if args.bundle:
+                                bundle.add(fit2batch.activity_xml(result))
+                            stages.update(result.timings)
+                        except fit2tcx.ChecksumError as e:
+                            discard_fit(dstFit, e)
+                            numImported -= 1
+                            overallReturnCode = 2
+                            metrics.activity(srcFit, "corrupt", time.time() - started,
+                                             stages, error=str(e), output=dstFit)
+                            continue
+                        except fit2tcx.ValidationError as e:
+                            print("Error: converted TCX file is not valid. ({err!s})".format(
+                                err=e))
+                            overallReturnCode = 2
+                            metrics.activity(srcFit, "invalid", time.time() - started,
+                                             stages, error=str(e), output=dstFit)
+                            continue
+                        except Exception as e:
+                            print("Error: unable to convert FIT file to TCX. ({err!s})".format(
+                                err=e))
+                            overallReturnCode = 2
+                            metrics.activity(srcFit, "failed", time.time() - started,
+                                             stages, error=str(e), output=dstFit)
+                            continue
                         
 
-                # Convert to GPX (via external call to GPSBabel)
-                if args.convert_to_gpx and os.path.exists(dstTcx):
-                    try:
-                        subprocess.call(["gpsbabel",
-                                         "-i", "gtrnctr",
-                                         "-f", dstTcx,
-                                         "-o", "gpx,gpxver=1.1,garminextensions=1",
-                                         "-F", dstGpx],
-                                         shell=True)
-                        print("Converted GPX file saved to {path!s}".format(path=dstGpx))
-                    except Exception as e:
-                        print("Error: unable to convert TCX file to GPX. ({err!s})".format(err=e))
-                        overallReturnCode = 2
+                    # Convert to GPX (via external call to GPSBabel)
+                    if args.convert_to_gpx and os.path.exists(dstTcx):
+                        stage_started = time.time()
+                        try:
+                            subprocess.call(["gpsbabel",
+                                             "-i", "gtrnctr",
+                                             "-f", dstTcx,
+                                             "-o", "gpx,gpxver=1.1,garminextensions=1",
+                                             "-F", dstGpx],
+                                             shell=True)
+                            print("Converted GPX file saved to {path!s}".format(path=dstGpx))
+                        except Exception as e:
+                            print("Error: unable to convert TCX file to GPX. ({err!s})".format(err=e))
+                            overallReturnCode = 2
+                        stages['gpx'] = time.time() - stage_started
 
-                # Upload to Garmin Connect
-                # N.B. Uploads seem to work, but cause an internal server error (status code 500),
-                # so we don't get confirmation. Also, the uploaded activities don't sync to other
-                # platforms (e.g. Strava), not sure if this is related to the 500 error or not.
-                # Uploading the file manually to GC works without error and triggers the sync.
-                if args.upload_to_gc and os.path.exists(dstTcx):
-                    try:
-                        status, id_msg = gc.upload_file(dstTcx)
-                        if status == 'SUCCESS':
-                            print("TCX file successfully uploaded to Garmin Connect. (http://connect.garmin.com/modern/activity/{id!s})".format(id=id_msg))
-                        elif status == 'EXISTS':
-                            print("TCX file not uploaded to Garmin Connect, a matching activity already exists. (http://connect.garmin.com/modern/activity/{id!s})".format(id=id_msg))
-                        elif status == 'FAIL':
-                            raise Exception(id_msg)
-                    except Exception as e:
-                        print("Error: unable to upload TCX file to Garmin Connect. ({err!s})".format(err=e))
-                        overallReturnCode = 2
+                    # Queue the TCX file for upload to Garmin Connect (below)
+                    # N.B. Uploads seem to work, but cause an internal server error (status code 500),
+                    # so we don't get confirmation. Also, the uploaded activities don't sync to other
+                    # platforms (e.g. Strava), not sure if this is related to the 500 error or not.
+                    # Uploading the file manually to GC works without error and triggers the sync.
+                    # Failed uploads are retried, and a retry of an upload that did work is
+                    # answered with EXISTS, which counts as done.
+                    if args.upload_to_gc and os.path.exists(dstTcx):
+                        try:
+                            uploads.add(dstTcx)
+                        except Exception as e:
+                            print("Error: unable to queue TCX file for upload to Garmin Connect. ({err!s})".format(err=e))
+                            overallReturnCode = 2
+
+                    # If we converted to TCX with fit2tcx (above), then we can
+                    # print some information about the activity.
+                    if args.convert_to_tcx and os.path.exists(dstTcx):
+                        print("{notes!s}".format(notes=result.notes))
+
+                    # Add the activity to the index
+                    if not args.no_index:
+                        stage_started = time.time()
+                        try:
+                            trt2index.index_activity(index,
+                                                     args.folder,
+                                                     dstFit,
+                                                     result,
+                                                     time_zone=args.timezone,
+                                                     calibration_factor=watch_cal_factor,
+                                                     tracks=tracks)
+                        except Exception as e:
+                            print("Error: unable to add activity to the index. ({err!s})".format(err=e))
+                            overallReturnCode = 2
+                        stages['index'] = time.time() - stage_started
+
+                    metrics.activity(srcFit, "imported", time.time() - started, stages,
+                                     result.num_trackpoints if result is not None else None,
+                                     output=dstFit)
+        except BaseException as e:
+            # Discard the unfinished bundle, rather than leave a temporary file
+            if args.bundle:
+                bundle.close(e)
+            raise
+
+        if not args.no_index:
+            # Write the tracks of the imported activities to the index at once
+            try:
+                tracks.flush()
+            except Exception as e:
+                print("Error: unable to add tracks to the index. ({err!s})".format(err=e))
+                overallReturnCode = 2
+            index.close()
+
+        if args.bundle:
+            bundle.close()
+            for filename in bundle.files:
+                print("Activities bundled in {path!s}".format(path=filename))
+
+        # Upload the queued TCX files to Garmin Connect, a few at a time
+        if args.upload_to_gc:
+            if uploads.pending():
+                print("\nUploading {num:d} TCX files to Garmin Connect ...".format(num=len(uploads.pending())))
+                try:
+                    results = upload_queue.run()
+                except KeyboardInterrupt:
+                    print("Interrupted, the remaining uploads will be resumed next time")
+                    results = [(None, "pending", None)]
+                if any(status == "pending" for _, status, _ in results):
+                    overallReturnCode = 2
+                for _, status, _ in results:
+                    metrics.count("uploads_total", status=status)
+            uploads.close()
 
-                # If we converted to TCX with fit2tcx (above), then we can grab
-                # the notes and print some information about the activity.
-                if args.convert_to_tcx and os.path.exists(dstTcx):
-                    activity_notes = document.getroot().findtext(".//{*}Activity/{*}Notes")
-                    if activity_notes is not None:
-                        print("{notes!s}".format(notes=activity_notes))
+        metrics.close()
 
         if numImported == 1:
             noun = "activity"
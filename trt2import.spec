@@ -6,7 +6,8 @@ block_cipher = None
 a = Analysis(['trt2import.py'],
              pathex=['.'],
              binaries=None,
-             datas=[(r'C:\Anaconda3\Lib\site-packages\tzwhere\tz_world_compact.json', 'tzwhere')],
+             datas=[(r'C:\Anaconda3\Lib\site-packages\tzwhere\tz_world_compact.json', 'tzwhere'),
+                    (r'schemas\*.xsd', 'schemas')],
              hiddenimports=[],
              hookspath=None,
              runtime_hooks=None,
@@ -0,0 +1,693 @@
+#!/usr/bin/env python
+#
+# trt2index - SQLite index of activities imported by trt2import
+#
+# Copyright (c) 2014-2016, Ian Grant <ian@iangrant.me> [https://github.com/imgrant/fit2tcx]
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, division
+import sys
+import os
+import glob
+import json
+import time
+import sqlite3
+import argparse
+import logging
+import math
+import multiprocessing
+from datetime import datetime, timedelta
+import numpy as np
+import fit2tcx
+
+__prog__ = "trt2index"
+__desc__ = "Index of FIT files imported by trt2import"
+__version__ = "1.0"
+
+
+"""
+Default name of the index database, in the root of the trt2import folder
+"""
+INDEX_FILENAME = "index.sqlite"
+
+
+"""
+Track positions are rounded to this resolution (in degrees, about 10 m)
+and repeated positions dropped, to simplify the tracks in the track index
+"""
+TRACK_RESOLUTION = 1e-4
+
+
+"""
+Size of the cells (tiles) of the track index, in degrees (about 1 km)
+"""
+CELL_SIZE = 0.01
+CELLS_PER_ROW = int(round(360 / CELL_SIZE))
+
+
+"""
+Mean radius of the earth, in metres
+"""
+EARTH_RADIUS = 6371008.8
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    fit_path            TEXT PRIMARY KEY,
+    tcx_path            TEXT,
+    gpx_path            TEXT,
+    file_size           INTEGER,
+    file_mtime          REAL,
+    start_time          TEXT,
+    sport               TEXT,
+    num_laps            INTEGER,
+    total_time          REAL,
+    stored_distance     REAL,
+    calculated_distance REAL,
+    scaling_factor      REAL,
+    calibration_factor  REAL,
+    new_cal_factor      REAL,
+    manufacturer        TEXT,
+    product_name        TEXT,
+    product_id          INTEGER,
+    serial_number       INTEGER,
+    indexed_at          TEXT
+);
+CREATE INDEX IF NOT EXISTS activities_start_time ON activities (start_time);
+CREATE INDEX IF NOT EXISTS activities_sport ON activities (sport);
+CREATE INDEX IF NOT EXISTS activities_serial_number ON activities (serial_number);
+CREATE TABLE IF NOT EXISTS laps (
+    fit_path            TEXT NOT NULL
+                        REFERENCES activities (fit_path) ON DELETE CASCADE,
+    lap_number          INTEGER NOT NULL,
+    stored_distance     REAL,
+    calculated_distance REAL,
+    PRIMARY KEY (fit_path, lap_number)
+);
+"""
+
+
+def open_index(filename):
+    """Open (creating it if need be) an index database"""
+    db = sqlite3.connect(filename)
+    db.execute("PRAGMA foreign_keys = ON")
+    db.executescript(SCHEMA)
+    return db
+
+
+def archive_paths(folder, fit_path):
+    """
+    Paths of the TCX and GPX files converted from a FIT file in a trt2import
+    folder (<folder>/<year>/FIT/<name>.fit), relative to the folder, or None
+    for files that don't exist
+    """
+    year_folder = os.path.dirname(os.path.dirname(fit_path))
+    basename = os.path.splitext(os.path.basename(fit_path))[0]
+    paths = []
+    for subfolder, ext in (("TCX", ".tcx"), ("GPX", ".gpx")):
+        path = os.path.join(year_folder, subfolder, basename + ext)
+        if os.path.exists(os.path.join(folder, path)):
+            paths.append(path)
+        else:
+            paths.append(None)
+    return paths
+
+
+def activity_rows(folder, fit_path, result, calibration_factor=None):
+    """
+    Build the activity and lap rows for a FIT file (with the path relative
+    to the folder) from its fit2tcx.ConversionResult; a FIT file with
+    several sessions is one activity, with the totals over all of them
+    """
+    stat = os.stat(os.path.join(folder, fit_path))
+    tcx_path, gpx_path = archive_paths(folder, fit_path)
+    if calibration_factor is not None:
+        new_cal_factor = result.scaling_factor * calibration_factor
+    else:
+        new_cal_factor = None
+    activity = (fit_path,
+                tcx_path,
+                gpx_path,
+                stat.st_size,
+                stat.st_mtime,
+                fit2tcx.iso_Z_format(result.start_time),
+                result.sport,
+                result.num_laps,
+                result.total_time,
+                result.stored_distance,
+                result.calculated_distance,
+                result.scaling_factor,
+                calibration_factor,
+                new_cal_factor,
+                result.manufacturer,
+                result.product_name,
+                result.product_id,
+                result.serial_number,
+                datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"))
+    laps = [(fit_path,
+             lap['lap_number'],
+             lap['stored_distance'],
+             lap['calculated_distance']) for lap in result.laps]
+    return activity, laps
+
+
+def store_activity(db, activity, laps):
+    """Add or replace an activity, and its laps, in the index"""
+    with db:
+        db.execute("DELETE FROM laps WHERE fit_path = ?", (activity[0],))
+        db.execute("INSERT OR REPLACE INTO activities VALUES "
+                   "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   activity)
+        db.executemany("INSERT INTO laps VALUES (?, ?, ?, ?)", laps)
+
+
+def simplify_track(positions, resolution=TRACK_RESOLUTION):
+    """
+    Simplify a track, given as an array of (latitude, longitude) rows in
+    degrees, by rounding the positions and dropping consecutive repeats
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    rounded = np.round(positions / resolution) * resolution
+    keep = np.ones(len(rounded), dtype=bool)
+    keep[1:] = np.any(rounded[1:] != rounded[:-1], axis=1)
+    return rounded[keep].astype(np.float32)
+
+
+def cell_rows_cols(latitudes, longitudes):
+    """Row and column numbers of the track index cells containing positions"""
+    rows = np.floor((np.asarray(latitudes, dtype=float) + 90) / CELL_SIZE)
+    cols = np.floor((np.asarray(longitudes, dtype=float) + 180) / CELL_SIZE)
+    return (rows.astype(np.int64),
+            np.clip(cols.astype(np.int64), 0, CELLS_PER_ROW - 1))
+
+
+def haversine(lat, lon, latitudes, longitudes):
+    """Distances (in metres) from a position to an array of positions"""
+    lat, lon = math.radians(lat), math.radians(lon)
+    latitudes = np.radians(np.asarray(latitudes, dtype=float))
+    longitudes = np.radians(np.asarray(longitudes, dtype=float))
+    a = (np.sin((latitudes - lat) / 2) ** 2 +
+         math.cos(lat) * np.cos(latitudes) *
+         np.sin((longitudes - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class TrackIndex(object):
+
+    """
+    Spatial index of simplified activity tracks, stored as numpy arrays in
+    a folder and memory-mapped when loaded:
+
+    paths.json      FIT file path of each activity (row)
+    offsets.npy     points[offsets[i]:offsets[i + 1]] is the track of row i
+    points.npy      (latitude, longitude) of the track points, in degrees
+    bboxes.npy      (min lat, min lon, max lat, max lon) of each row's track
+    cell_keys.npy   sorted keys of the cells that the tracks pass through
+    cell_rows.npy   the row passing through each of those cells
+
+    Bounding box and radius queries look up the cells covering the area with
+    a binary search, filter the rows by bounding box, then check the points
+    of the remaining tracks. Tracks added one at a time (see add()) are kept
+    until flush(), so that the arrays are rewritten once for a batch.
+    """
+
+    ARRAYS = ('offsets', 'points', 'bboxes', 'cell_keys', 'cell_rows')
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.pending = {}
+        self.load()
+
+    def load(self):
+        """(Re)load the index from its folder, if it exists"""
+        paths_file = os.path.join(self.folder, "paths.json")
+        if os.path.exists(paths_file):
+            with open(paths_file) as f:
+                self.paths = json.load(f)
+            for name in self.ARRAYS:
+                setattr(self, name,
+                        np.load(os.path.join(self.folder, name + ".npy"),
+                                mmap_mode='r'))
+        else:
+            self.paths = []
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.points = np.empty((0, 2), dtype=np.float32)
+            self.bboxes = np.empty((0, 4), dtype=np.float32)
+            self.cell_keys = np.empty(0, dtype=np.int64)
+            self.cell_rows = np.empty(0, dtype=np.int32)
+        self.rows = dict((path, row) for row, path in enumerate(self.paths))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.rows or path in self.pending
+
+    def track(self, row):
+        """The simplified track of a row"""
+        return self.points[self.offsets[row]:self.offsets[row + 1]]
+
+    def add(self, path, positions):
+        """
+        Add or replace the track of an activity (an array of positions) when
+        the index is next flushed
+        """
+        self.pending[path] = positions
+
+    def flush(self):
+        """Rewrite the index with the tracks added since the last flush"""
+        if self.pending:
+            self.update(self.pending)
+            self.pending = {}
+
+    def update(self, tracks, removed=()):
+        """
+        Add or replace the tracks of activities, given as a dict of FIT file
+        path to an array of positions, remove the given paths, and rewrite
+        the index
+        """
+        changed = set(tracks) | set(removed)
+        keep = np.array([path not in changed for path in self.paths],
+                        dtype=bool)
+        num_kept = int(keep.sum())
+        old_lengths = np.diff(self.offsets)
+        new_tracks = [simplify_track(tracks[path]) for path in sorted(tracks)]
+        paths = ([path for path in self.paths if path not in changed] +
+                 sorted(tracks))
+        new_lengths = np.array([len(track) for track in new_tracks],
+                               dtype=np.int64)
+        lengths = np.concatenate((old_lengths[keep], new_lengths))
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        new_points = np.concatenate([np.empty((0, 2), dtype=np.float32)] +
+                                    new_tracks)
+        points = np.concatenate((self.points[np.repeat(keep, old_lengths)],
+                                 new_points))
+
+        # Bounding boxes of the new tracks, reducing over those with points
+        new_bboxes = np.full((len(new_tracks), 4), np.nan, dtype=np.float32)
+        nonempty = new_lengths > 0
+        if nonempty.any():
+            starts = np.concatenate(([0], np.cumsum(new_lengths)))[:-1]
+            new_bboxes[nonempty, 0:2] = np.minimum.reduceat(
+                new_points, starts[nonempty])
+            new_bboxes[nonempty, 2:4] = np.maximum.reduceat(
+                new_points, starts[nonempty])
+        bboxes = np.concatenate((self.bboxes[keep], new_bboxes))
+
+        # Distinct (cell, row) pairs, sorted by cell then row: the kept pairs
+        # stay in order when their rows are renumbered, so the pairs for the
+        # new tracks are merged in by binary search rather than re-sorting
+        stride = max(len(paths), 1)
+        renumbered = np.cumsum(keep) - 1
+        kept = keep[self.cell_rows]
+        old_pairs = (self.cell_keys[kept] * stride +
+                     renumbered[self.cell_rows[kept]])
+        rows, cols = cell_rows_cols(new_points[:, 0], new_points[:, 1])
+        point_rows = np.repeat(np.arange(num_kept, len(paths),
+                                         dtype=np.int64), new_lengths)
+        new_pairs = np.unique((rows * CELLS_PER_ROW + cols) * stride +
+                              point_rows)
+        pairs = np.insert(old_pairs,
+                          np.searchsorted(old_pairs, new_pairs),
+                          new_pairs)
+        cell_keys = pairs // stride
+        cell_rows = (pairs % stride).astype(np.int32)
+
+        # Release the memory-mapped arrays before replacing their files
+        self.paths = []
+        for name in self.ARRAYS:
+            setattr(self, name, None)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        arrays = {'offsets': offsets,
+                  'points': points,
+                  'bboxes': bboxes,
+                  'cell_keys': cell_keys,
+                  'cell_rows': cell_rows}
+        for name in self.ARRAYS:
+            with fit2tcx.atomic_file(os.path.join(self.folder,
+                                                  name + ".npy")) as f:
+                np.save(f, arrays[name])
+        with fit2tcx.atomic_file(os.path.join(self.folder, "paths.json"),
+                                 'w') as f:
+            json.dump(paths, f)
+        self.load()
+
+    def candidates(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Rows whose tracks pass through the cells covering a bounding box,
+        and whose own bounding boxes overlap it
+        """
+        # Widen the range by a cell, for positions rounded into a neighbour
+        (row0, row1), (col0, col1) = cell_rows_cols((min_lat, max_lat),
+                                                    (min_lon, max_lon))
+        cell_rows = np.arange(row0 - 1, row1 + 2, dtype=np.int64)
+        first = np.searchsorted(self.cell_keys,
+                                cell_rows * CELLS_PER_ROW + max(col0 - 1, 0))
+        last = np.searchsorted(self.cell_keys,
+                               cell_rows * CELLS_PER_ROW + col1 + 1,
+                               side='right')
+        found = [self.cell_rows[i:j] for i, j in zip(first, last) if j > i]
+        if not found:
+            return np.empty(0, dtype=np.int32)
+        candidates = np.unique(np.concatenate(found))
+        bboxes = self.bboxes[candidates]
+        overlap = ((bboxes[:, 0] <= max_lat) & (bboxes[:, 2] >= min_lat) &
+                   (bboxes[:, 1] <= max_lon) & (bboxes[:, 3] >= min_lon))
+        return candidates[overlap]
+
+    def within(self, min_lat, min_lon, max_lat, max_lon):
+        """Paths of the activities with track points inside a bounding box"""
+        paths = []
+        for row in self.candidates(min_lat, min_lon, max_lat, max_lon):
+            bbox = self.bboxes[row]
+            if (bbox[0] >= min_lat and bbox[2] <= max_lat and
+                    bbox[1] >= min_lon and bbox[3] <= max_lon):
+                paths.append(self.paths[row])   # entirely inside the box
+                continue
+            track = self.track(row)
+            inside = ((track[:, 0] >= min_lat) & (track[:, 0] <= max_lat) &
+                      (track[:, 1] >= min_lon) & (track[:, 1] <= max_lon))
+            if inside.any():
+                paths.append(self.paths[row])
+        return paths
+
+    def near(self, lat, lon, radius):
+        """
+        Paths of the activities that pass within a radius (in metres) of a
+        position, with the closest distance, as a list of (path, distance)
+        sorted by distance
+        """
+        dlat = math.degrees(radius / EARTH_RADIUS)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        found = []
+        for row in self.candidates(lat - dlat, lon - dlon,
+                                   lat + dlat, lon + dlon):
+            track = self.track(row)
+            distance = haversine(lat, lon, track[:, 0], track[:, 1]).min()
+            if distance <= radius:
+                found.append((self.paths[row], float(distance)))
+        return sorted(found, key=lambda item: item[1])
+
+
+def tracks_folder(index_file):
+    """Folder of the track index that goes with an index database"""
+    return os.path.splitext(index_file)[0] + "-tracks"
+
+
+def index_activity(db, folder, fit_path, result=None, time_zone="auto",
+                   calibration_factor=None, tracks=None):
+    """
+    Add a FIT file in a trt2import folder to the index (and its track to
+    the TrackIndex, if given, when it is next flushed), using the result of
+    converting it if one is given (only the option-independent values are
+    stored), otherwise reading the summary from the file
+    """
+    fit_path = os.path.relpath(fit_path, folder)
+    if result is None:
+        result = fit2tcx.convert(os.path.join(folder, fit_path),
+                                 time_zone=time_zone,
+                                 summary_only=True)
+    activity, laps = activity_rows(folder, fit_path, result,
+                                   calibration_factor)
+    store_activity(db, activity, laps)
+    if tracks is not None:
+        tracks.add(fit_path, result.positions)
+
+
+def summarize(task):
+    """
+    Read the summary and simplified track of a FIT file for the index, in
+    a worker process, returning (activity, laps, track, None), or (None,
+    None, None, error message)
+    """
+    folder, fit_path, time_zone, calibration_factor = task
+    try:
+        result = fit2tcx.convert(os.path.join(folder, fit_path),
+                                 time_zone=time_zone,
+                                 summary_only=True)
+        activity, laps = activity_rows(folder, fit_path, result,
+                                       calibration_factor)
+        return activity, laps, simplify_track(result.positions), None
+    except (fit2tcx.ConversionError, OSError, IOError) as e:
+        return None, None, None, str(e)
+
+
+def rebuild(db, folder, time_zone="auto", workers=1, full=False,
+            tracks=None):
+    """
+    Bring the index (and the TrackIndex, if given) up to date with the FIT
+    files in a trt2import folder, reading the summaries of new or changed
+    files in parallel worker processes. Entries for files that no longer
+    exist are removed. Returns the number of files (indexed, unchanged,
+    removed, failed).
+    """
+    fit_paths = sorted(os.path.relpath(path, folder) for path in
+                       glob.glob(os.path.join(folder, "*", "FIT", "*.fit")))
+
+    indexed = {}
+    for fit_path, size, mtime, cal_factor in db.execute(
+            "SELECT fit_path, file_size, file_mtime, calibration_factor "
+            "FROM activities"):
+        indexed[fit_path] = (size, mtime, cal_factor)
+
+    # Only files that are new, or changed since they were indexed
+    tasks = []
+    for fit_path in fit_paths:
+        stat = os.stat(os.path.join(folder, fit_path))
+        previous = indexed.get(fit_path)
+        if (not full and previous is not None and
+                previous[:2] == (stat.st_size, stat.st_mtime) and
+                (tracks is None or fit_path in tracks)):
+            continue
+        # Keep the calibration factor recorded when the file was imported
+        cal_factor = previous[2] if previous is not None else None
+        tasks.append((folder, fit_path, time_zone, cal_factor))
+
+    existing = set(fit_paths)
+    removed = [(fit_path,) for fit_path in indexed
+               if fit_path not in existing]
+    with db:
+        db.executemany("DELETE FROM activities WHERE fit_path = ?", removed)
+
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.imap(summarize, tasks)
+            num_indexed, num_failed, new_tracks = store_results(db, tasks,
+                                                                results)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        num_indexed, num_failed, new_tracks = store_results(db, tasks,
+                                                            (summarize(task)
+                                                             for task in tasks))
+
+    if tracks is not None:
+        removed_tracks = [fit_path for fit_path in tracks.paths
+                          if fit_path not in existing]
+        if new_tracks or removed_tracks:
+            tracks.update(new_tracks, removed_tracks)
+
+    return (num_indexed,
+            len(fit_paths) - len(tasks),
+            len(removed),
+            num_failed)
+
+
+def store_results(db, tasks, results):
+    """
+    Store the summaries read by rebuild(), as they arrive, and collect the
+    tracks (as a dict of FIT file path to track)
+    """
+    num_indexed = 0
+    num_failed = 0
+    tracks = {}
+    for task, (activity, laps, track, error) in zip(tasks, results):
+        if error is not None:
+            print("Unable to index {path!s}: {err!s}".format(path=task[1],
+                                                            err=error))
+            num_failed += 1
+            continue
+        store_activity(db, activity, laps)
+        tracks[task[1]] = track
+        num_indexed += 1
+    return num_indexed, num_failed, tracks
+
+
+def query(db, sport=None, since=None, until=None, min_distance=None,
+          serial_number=None, laps=False):
+    """
+    Query the index for activities (or their laps), oldest first, as a list
+    of dicts. Times are ISO 8601 strings in UTC and distances are in metres.
+    """
+    conditions = []
+    params = []
+    if sport is not None:
+        conditions.append("a.sport = ?")
+        params.append(sport)
+    if since is not None:
+        conditions.append("a.start_time >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("a.start_time < ?")
+        params.append(until)
+    if min_distance is not None:
+        conditions.append("a.stored_distance >= ?")
+        params.append(min_distance)
+    if serial_number is not None:
+        conditions.append("a.serial_number = ?")
+        params.append(serial_number)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+
+    if laps:
+        sql = ("SELECT a.start_time, a.sport, l.* FROM laps l "
+               "JOIN activities a ON a.fit_path = l.fit_path" + where +
+               " ORDER BY a.start_time, l.lap_number")
+    else:
+        sql = "SELECT * FROM activities a" + where + " ORDER BY a.start_time"
+    cursor = db.execute(sql, params)
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+def format_row(row):
+    """One line of text for an activity or lap in the query output"""
+    if 'lap_number' in row:
+        return "{start} {sport:<8} lap {lap:>2} {dist:8.3f} km (GPS {gps:8.3f} km)".format(
+            start=row['start_time'],
+            sport=row['sport'],
+            lap=row['lap_number'],
+            dist=(row['stored_distance'] or 0) / 1000,
+            gps=(row['calculated_distance'] or 0) / 1000)
+    return "{start} {sport:<8} {dist:8.3f} km (GPS {gps:8.3f} km) {time!s:>8} {device!s} {path!s}".format(
+        start=row['start_time'],
+        sport=row['sport'],
+        dist=(row['stored_distance'] or 0) / 1000,
+        gps=(row['calculated_distance'] or 0) / 1000,
+        time=timedelta(seconds=int(row['total_time'] or 0)),
+        device=row['product_name'],
+        path=row['fit_path'])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=__prog__, description=__desc__)
+    parser.add_argument(
+        "-v", "--version", action='version',
+        version='%(prog)s {version}'.format(version=__version__))
+    subparsers = parser.add_subparsers(dest="command")
+
+    rebuild_parser = subparsers.add_parser(
+        "rebuild", help="Add new or changed FIT files in a trt2import folder to the index")
+    rebuild_parser.add_argument("folder", help="Root folder of copied/converted files")
+    rebuild_parser.add_argument(
+        "-j", "--workers",
+        action="store", default=1, type=int,
+        help="Number of worker processes for reading FIT files (default: 1)")
+    rebuild_parser.add_argument(
+        "-a", "--all",
+        action="store_true", default=False, help="Re-index all FIT files, not just new or changed ones")
+    rebuild_parser.add_argument(
+        "-z", "--timezone",
+        action="store", default="auto", type=str,
+        help="Override timezone detection (default: lookup timezone from GPS data)")
+
+    query_parser = subparsers.add_parser(
+        "query", help="List indexed activities")
+    query_parser.add_argument("folder", help="Root folder of copied/converted files")
+    query_parser.add_argument("--sport", help="Only activities of this sport (e.g. Running)")
+    query_parser.add_argument("--since", help="Only activities starting on or after this UTC date/time (e.g. 2016-01-01)")
+    query_parser.add_argument("--until", help="Only activities starting before this UTC date/time")
+    query_parser.add_argument("--min-distance", type=float, help="Only activities of at least this distance (km)")
+    query_parser.add_argument("--serial-number", type=int, help="Only activities recorded by this device")
+    query_parser.add_argument(
+        "--near", nargs=3, type=float, metavar=("LAT", "LON", "KM"),
+        help="Only activities passing within KM km of a position (in decimal degrees)")
+    query_parser.add_argument(
+        "--within", nargs=4, type=float, metavar=("MIN_LAT", "MIN_LON", "MAX_LAT", "MAX_LON"),
+        help="Only activities passing through a bounding box (in decimal degrees)")
+    query_parser.add_argument("--laps", action="store_true", help="List laps rather than activities")
+    query_parser.add_argument("--json", action="store_true", help="Output JSON")
+
+    for subparser in (rebuild_parser, query_parser):
+        subparser.add_argument(
+            "-i", "--index",
+            action="store",
+            help="Index database (default: {name} in the folder)".format(name=INDEX_FILENAME))
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("a command (rebuild or query) is required")
+
+    logging.basicConfig(format="%(message)s")
+
+    index_file = args.index or os.path.join(args.folder, INDEX_FILENAME)
+    try:
+        db = open_index(index_file)
+        tracks = TrackIndex(tracks_folder(index_file))
+    except (sqlite3.Error, IOError, OSError, ValueError) as e:
+        print("Error: unable to open index {path!s}. ({err!s})".format(
+            path=index_file, err=e))
+        return 1
+
+    try:
+        if args.command == "rebuild":
+            start = time.time()
+            num_indexed, num_unchanged, num_removed, num_failed = rebuild(
+                db, args.folder, args.timezone, args.workers, args.all, tracks)
+            print("{n} indexed, {u} unchanged, {r} removed, {f} failed "
+                  "({t:.1f} s)".format(n=num_indexed, u=num_unchanged,
+                                       r=num_removed, f=num_failed,
+                                       t=time.time() - start))
+            return 2 if num_failed else 0
+
+        rows = query(db,
+                     sport=args.sport,
+                     since=args.since,
+                     until=args.until,
+                     min_distance=(args.min_distance * 1000
+                                   if args.min_distance is not None else None),
+                     serial_number=args.serial_number,
+                     laps=args.laps)
+
+        # Spatial filters, from the track index
+        if args.near is not None:
+            lat, lon, km = args.near
+            distances = dict(tracks.near(lat, lon, km * 1000))
+            rows = [row for row in rows if row['fit_path'] in distances]
+            for row in rows:
+                row['distance_to_point'] = distances[row['fit_path']]
+        if args.within is not None:
+            found = set(tracks.within(*args.within))
+            rows = [row for row in rows if row['fit_path'] in found]
+
+        if args.json:
+            print(json.dumps(rows, indent=2))
+        else:
+            for row in rows:
+                print(format_row(row))
+        return 0
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+#
+# trt2upload - upload TCX files to Garmin Connect from a persistent queue
+#
+# Copyright (c) 2014-2016, Ian Grant <ian@iangrant.me> [https://github.com/imgrant/fit2tcx]
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, division
+import sys
+import os
+import json
+import time
+import heapq
+import random
+import hashlib
+import argparse
+import logging
+import threading
+from datetime import datetime
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import http.client as httplib
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit
+except ImportError:
+    import httplib
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit
+import fit2tcx
+
+__prog__ = "trt2upload"
+__desc__ = "Upload TCX files to Garmin Connect from a persistent queue"
+__version__ = "1.0"
+
+UPLOADS_FILENAME = "uploads.jsonl"
+# Statuses of an upload that are final; anything else is still pending
+DONE = ("uploaded", "exists", "missing")
+
+
+logger = logging.getLogger("trt2upload")
+
+
+def file_digest(filename):
+    """SHA-1 digest of the contents of a file"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadJournal(object):
+
+    """
+    Append-only journal of the upload queue in a trt2import folder, with a
+    JSON line each time a TCX file is queued, uploaded, found to exist
+    already, or fails an attempt. Files are identified by their path
+    relative to the folder and the digest of their contents, so a file is
+    only uploaded once, unless it is converted again with different results.
+    The state of each file is replayed from the journal when it is opened,
+    so that pending uploads are resumed on the next run.
+    """
+
+    def __init__(self, folder, filename=UPLOADS_FILENAME):
+        self.folder = folder
+        self.filename = os.path.join(folder, filename)
+        self.uploads = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.filename):
+            with open(self.filename) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue    # line cut short by a crash
+                    self._apply(entry)
+        self.file = open(self.filename, 'a')
+
+    def _apply(self, entry):
+        state = self.uploads.get(entry['path'])
+        if state is None or state['digest'] != entry['digest']:
+            state = {'digest': entry['digest'],
+                     'status': None,
+                     'attempts': 0,
+                     'id': None}
+            self.uploads[entry['path']] = state
+        if entry['status'] in ("uploaded", "exists", "failed"):
+            state['attempts'] += 1
+        if entry.get('id') is not None:
+            state['id'] = entry['id']
+        state['status'] = entry['status']
+
+    def path(self, filename):
+        """Path of a file relative to the folder, as used in the journal"""
+        return os.path.relpath(os.path.abspath(filename),
+                               os.path.abspath(self.folder)).replace(os.sep, "/")
+
+    def filename_of(self, path):
+        return os.path.join(self.folder, *path.split("/"))
+
+    def record(self, path, digest, status, **details):
+        """Append an entry to the journal, flushed to disk"""
+        entry = dict(details,
+                     path=path,
+                     digest=digest,
+                     status=status,
+                     time=fit2tcx.iso_Z_format(datetime.now(fit2tcx.utc)))
+        with self.lock:
+            self.file.write(json.dumps(entry, sort_keys=True) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self._apply(entry)
+
+    def add(self, filename):
+        """
+        Queue a TCX file for upload, unless the same contents have already
+        been uploaded (or queued); returns True if the file was queued
+        """
+        path = self.path(filename)
+        digest = file_digest(filename)
+        state = self.uploads.get(path)
+        if state is not None and state['digest'] == digest:
+            return False
+        self.record(path, digest, "queued")
+        return True
+
+    def pending(self):
+        """Paths of queued files that haven't been uploaded yet"""
+        return sorted(path for path, state in self.uploads.items()
+                      if state['status'] not in DONE)
+
+    def close(self):
+        self.file.close()
+
+
+class ClientPool(object):
+
+    """
+    Pool of logged in upload clients (UploadGarmin objects, or anything else
+    with the same upload_file() method), created by calling factory() as
+    they are needed, up to size clients, so that the login and connection
+    of each client is reused for many uploads
+    """
+
+    def __init__(self, factory, size=2):
+        self.factory = factory
+        self.size = size
+        self.created = 0
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.idle.empty() and self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self.factory()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        return self.idle.get()
+
+    def put(self, client):
+        self.idle.put(client)
+
+    def discard(self, client):
+        """Drop a client that has failed, so that a new one is created"""
+        with self.lock:
+            self.created -= 1
+
+
+def garmin_client(username, password):
+    """Factory for UploadGarmin clients logged in to Garmin Connect"""
+    def create():
+        import UploadGarmin
+        client = UploadGarmin.UploadGarmin()
+        if not client.login(username, password):
+            raise Exception("Garmin Connect login failed - please verify your login credentials")
+        return client
+    return create
+
+
+class UploadQueue(object):
+
+    """
+    Upload the pending files in an upload journal, with up to `workers`
+    uploads at a time, each using a client from the pool. A failed upload
+    is retried after an exponential backoff (with jitter), while the other
+    uploads carry on, up to `retries` attempts per file in a run; files
+    that still fail are left pending for the next run. Garmin Connect may
+    report an error for an upload that did succeed, so an EXISTS status on
+    a retry is taken as the upload having been done.
+    """
+
+    def __init__(self, journal, pool, workers=2, retries=5, backoff=2.0,
+                 max_backoff=300.0, callback=None):
+        self.journal = journal
+        self.pool = pool
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.callback = callback
+        self.condition = threading.Condition()
+        self.waiting = []   # heap of (time when ready, sequence, path, digest, attempt)
+        self.active = 0
+        self.results = []
+        self.sequence = 0
+        self.stopped = False
+        self.running = 0
+
+    def delay(self, attempt):
+        """Backoff before the given (second or later) attempt"""
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 2))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _schedule(self, path, digest, attempt, ready):
+        self.sequence += 1
+        heapq.heappush(self.waiting, (ready, self.sequence, path, digest, attempt))
+        self.condition.notify()
+
+    def _next(self):
+        """
+        Wait for the next upload that is ready, or None if all are done
+        (or the queue has been stopped)
+        """
+        with self.condition:
+            while True:
+                if self.stopped:
+                    return None
+                if not self.waiting:
+                    if self.active == 0:
+                        self.condition.notify_all()
+                        return None
+                    self.condition.wait()
+                    continue
+                ready = self.waiting[0][0]
+                now = time.time()
+                if ready <= now:
+                    self.active += 1
+                    return heapq.heappop(self.waiting)
+                self.condition.wait(ready - now)
+
+    def _finish(self, path, status, message):
+        self.results.append((path, status, message))
+        if self.callback is not None:
+            self.callback(self.journal.filename_of(path), status, message)
+
+    def _upload(self, path, digest, attempt):
+        filename = self.journal.filename_of(path)
+        if not os.path.exists(filename):
+            self.journal.record(path, digest, "missing")
+            return "missing", "file not found"
+        try:
+            client = self.pool.get()
+        except Exception as e:
+            status, message = "FAIL", str(e)
+        else:
+            try:
+                status, message = client.upload_file(filename)
+            except Exception as e:
+                self.pool.discard(client)
+                status, message = "FAIL", str(e)
+            else:
+                self.pool.put(client)
+        if status == 'SUCCESS':
+            self.journal.record(path, digest, "uploaded", id=message)
+            return "uploaded", message
+        elif status == 'EXISTS':
+            self.journal.record(path, digest, "exists", id=message)
+            return "exists", message
+        self.journal.record(path, digest, "failed", attempt=attempt, error=str(message))
+        logger.info("Upload of %s failed (attempt %d): %s", path, attempt, message)
+        return None, message
+
+    def _work(self):
+        try:
+            self._work_loop()
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+    def _work_loop(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            _, _, path, digest, attempt = item
+            try:
+                status, message = self._upload(path, digest, attempt)
+            except Exception as e:
+                status, message = None, str(e)
+            with self.condition:
+                self.active -= 1
+                if status is not None:
+                    self._finish(path, status, message)
+                elif attempt < self.retries:
+                    self._schedule(path, digest, attempt + 1,
+                                   time.time() + self.delay(attempt + 1))
+                else:
+                    self._finish(path, "pending", message)
+                self.condition.notify_all()
+
+    def stop(self):
+        """Stop the workers once their current uploads are done"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def run(self):
+        """
+        Upload all pending files, and return a list of (path, status,
+        id or error message) for each, where status is uploaded, exists,
+        missing or pending (still failing after all the retries).
+        If interrupted, the uploads in progress are finished (and recorded
+        in the journal) before KeyboardInterrupt is raised again, so that
+        the journal can then be closed.
+        """
+        self.results = []
+        with self.condition:
+            self.stopped = False
+            for path in self.journal.pending():
+                self._schedule(path, self.journal.uploads[path]['digest'], 1, 0)
+        threads = [threading.Thread(target=self._work)
+                   for _ in range(max(1, min(self.workers, len(self.waiting))))]
+        self.running = len(threads)
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)    # (join without a timeout blocks Ctrl-C)
+        except BaseException:
+            # (an interrupted join can leave a thread looking finished, so
+            # wait for the workers themselves to report that they are done)
+            self.stop()
+            with self.condition:
+                while self.running:
+                    self.condition.wait()
+            raise
+        return self.results
+
+
+def activity_url(activity_id):
+    return "http://connect.garmin.com/modern/activity/{id!s}".format(id=activity_id)
+
+
+class MockUploadGarmin(object):
+
+    """
+    Upload client for the mock upload server, with the same upload_file()
+    method as UploadGarmin, over a persistent (keep-alive) connection
+    """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path.rstrip("/") + "/upload"
+        self.connection = None
+
+    def upload_file(self, filename):
+        with open(filename, 'rb') as f:
+            body = f.read()
+        if self.connection is None:
+            self.connection = httplib.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            self.connection.request(
+                "POST", self.path, body,
+                {'Content-Type': "application/octet-stream",
+                 'X-Filename': os.path.basename(filename)})
+            response = self.connection.getresponse()
+            data = response.read()
+        except Exception:
+            self.connection.close()
+            self.connection = None
+            raise
+        if response.status != 200:
+            return 'FAIL', "HTTP status {status:d}".format(status=response.status)
+        result = json.loads(data.decode("utf-8"))
+        return result['status'], result['id']
+
+
+class MockUploadServer(ThreadingMixIn, HTTPServer):
+
+    """
+    Local stand-in for the Garmin Connect upload service, for testing
+    uploads offline. Each upload takes `latency` seconds; a fraction of
+    them fail with an HTTP 500 error (before the activity is stored), and
+    another fraction are stored but still answered with an HTTP 500 error,
+    as Garmin Connect does. An upload of an activity that has already been
+    stored returns EXISTS with the same id.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.1, failure_rate=0.0, lost_rate=0.0):
+        HTTPServer.__init__(self, address, MockUploadHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lost_rate = lost_rate
+        self.activities = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+class MockUploadHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        server = self.server
+        time.sleep(server.latency)
+        digest = hashlib.sha1(body).hexdigest()
+        with server.lock:
+            server.requests += 1
+            roll = random.random()
+            if roll < server.failure_rate:
+                self.respond(500, {'error': "internal server error"})
+                return
+            activity_id = server.activities.get(digest)
+            if activity_id is not None:
+                status = 'EXISTS'
+            else:
+                activity_id = len(server.activities) + 1
+                server.activities[digest] = activity_id
+                status = 'SUCCESS'
+        if status == 'SUCCESS' and roll < server.failure_rate + server.lost_rate:
+            self.respond(500, {'error': "internal server error"})
+            return
+        self.respond(200, {'status': status, 'id': activity_id})
+
+    def respond(self, code, content):
+        data = json.dumps(content).encode("utf-8")
+        self.send_response(code)
+        self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def print_result(filename, status, message):
+    if status == "uploaded":
+        print("{path!s} uploaded to Garmin Connect. ({url!s})".format(
+            path=filename, url=activity_url(message)))
+    elif status == "exists":
+        print("{path!s} not uploaded to Garmin Connect, a matching activity already exists. ({url!s})".format(
+            path=filename, url=activity_url(message)))
+    elif status == "missing":
+        print("{path!s} has been removed, dropped from the upload queue".format(path=filename))
+    else:
+        print("Error: unable to upload {path!s} to Garmin Connect, "
+              "it will be retried next time. ({err!s})".format(path=filename, err=message))
+
+
+def add_upload_arguments(parser):
+    """Add the upload queue options to a parser"""
+    parser.add_argument(
+        "--upload-workers",
+        action="store", default=2, type=int,
+        help="Number of uploads to Garmin Connect at a time (default: 2)")
+    parser.add_argument(
+        "--upload-retries",
+        action="store", default=5, type=int,
+        help="Number of attempts per upload before leaving it for the next run (default: 5)")
+    parser.add_argument(
+        "--upload-backoff",
+        action="store", default=2.0, type=float,
+        help="Seconds to wait before retrying a failed upload, doubled for each attempt (default: 2)")
+    parser.add_argument(
+        "--mock-server",
+        action="store", metavar="URL",
+        help="Upload to a mock upload server (see trt2upload serve) rather than Garmin Connect")
+
+
+def upload_queue(journal, args, callback=print_result):
+    """The upload queue for a journal, with the options from the parser"""
+    if args.mock_server:
+        factory = lambda: MockUploadGarmin(args.mock_server)
+    else:
+        factory = garmin_client(args.username, args.password)
+    pool = ClientPool(factory, size=args.upload_workers)
+    return UploadQueue(journal, pool,
+                       workers=args.upload_workers,
+                       retries=args.upload_retries,
+                       backoff=args.upload_backoff,
+                       callback=callback)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=__prog__, description=__desc__)
+    parser.add_argument(
+        "-v", "--version", action='version',
+        version='%(prog)s {version}'.format(version=__version__))
+    subparsers = parser.add_subparsers(dest="command")
+
+    upload_parser = subparsers.add_parser(
+        "upload", help="Queue TCX files for upload, and upload all pending files")
+    upload_parser.add_argument("folder", help="Root folder of copied/converted files (where the queue is kept)")
+    upload_parser.add_argument("tcx", nargs="*", help="TCX files to add to the queue")
+    upload_parser.add_argument(
+        "-n", "--username",
+        action="store", help="Username for Garmin Connect")
+    upload_parser.add_argument(
+        "-w", "--password",
+        action="store", help="Password for Garmin Connect")
+    upload_parser.add_argument(
+        "-l", "--list",
+        action="store_true", default=False, help="List the pending uploads, rather than uploading them")
+    add_upload_arguments(upload_parser)
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="Run a mock upload server for testing")
+    serve_parser.add_argument(
+        "--port", action="store", default=8089, type=int,
+        help="Port to listen on (default: 8089)")
+    serve_parser.add_argument(
+        "--latency", action="store", default=0.1, type=float,
+        help="Seconds taken by each upload (default: 0.1)")
+    serve_parser.add_argument(
+        "--failure-rate", action="store", default=0.0, type=float,
+        help="Fraction of uploads that fail (default: 0)")
+    serve_parser.add_argument(
+        "--lost-rate", action="store", default=0.0, type=float,
+        help="Fraction of uploads that are stored, but answered with an error (default: 0)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s")
+
+    if args.command == "serve":
+        server = MockUploadServer(("127.0.0.1", args.port),
+                                  latency=args.latency,
+                                  failure_rate=args.failure_rate,
+                                  lost_rate=args.lost_rate)
+        print("Mock upload server listening on http://127.0.0.1:{port:d}/ (Ctrl-C to stop)".format(
+            port=server.server_address[1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        print("{requests:d} requests, {activities:d} activities stored".format(
+            requests=server.requests, activities=len(server.activities)))
+        return 0
+
+    if args.command != "upload":
+        parser.print_usage()
+        return 1
+    if not args.list and not args.mock_server and (args.username is None or args.password is None):
+        parser.error("a username and password for Garmin Connect are required (-n and -w)")
+
+    try:
+        journal = UploadJournal(args.folder)
+    except Exception as e:
+        print("Error: unable to open the upload queue in {path!s}. ({err!s})".format(
+            path=args.folder, err=e))
+        return 1
+
+    try:
+        for tcx in args.tcx:
+            if not journal.add(tcx):
+                print("{path!s} has already been queued or uploaded".format(path=tcx))
+
+        pending = journal.pending()
+        if args.list:
+            for path in pending:
+                state = journal.uploads[path]
+                print("{path!s}\t{status!s}\t{attempts:d} attempts".format(
+                    path=path, status=state['status'], attempts=state['attempts']))
+            return 0
+        if not pending:
+            print("No pending uploads")
+            return 0
+
+        start = time.time()
+        results = upload_queue(journal, args).run()
+    except KeyboardInterrupt:
+        print("Interrupted, the remaining uploads will be resumed next time")
+        return 2
+    finally:
+        journal.close()
+
+    elapsed = time.time() - start
+    done = sum(1 for _, status, _ in results if status in ("uploaded", "exists"))
+    print("{done:d} of {total:d} uploads done in {elapsed:.1f} s ({rate:.1f} per second)".format(
+        done=done, total=len(results), elapsed=elapsed,
+        rate=len(results) / elapsed if elapsed else 0))
+    if done < len(results):
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
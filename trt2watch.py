@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+#
+# trt2watch - watch folders for new FIT files, and import them as trt2import does
+#
+# Copyright (c) 2014-2016, Ian Grant <ian@iangrant.me> [https://github.com/imgrant/fit2tcx]
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, division
+import sys
+import os
+import json
+import time
+import select
+import shutil
+import struct
+import argparse
+import logging
+import ctypes
+import ctypes.util
+from pytz import timezone
+import fit2tcx
+import trt2index
+
+__prog__ = "trt2watch"
+__desc__ = "Watch folders for new FIT files and import them"
+__version__ = "1.0"
+
+
+logger = logging.getLogger("trt2watch")
+
+# Number of times a file that fails to import is retried (once it has
+# settled again), in case it was still being written
+MAX_RETRIES = 3
+
+
+class PollingWatcher(object):
+
+    """
+    Watch folders (and their subfolders) for changed files by scanning
+    them for changes in size or modification time
+    """
+
+    def __init__(self, folders, interval=1.0):
+        self.folders = folders
+        self.interval = interval
+        self.seen = self.scan()
+        self.last_scan = time.time()
+
+    def scan(self):
+        files = {}
+        for top in self.folders:
+            for folder, subfolders, filenames in os.walk(top):
+                for filename in filenames:
+                    path = os.path.join(folder, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files[path] = (stat.st_size, stat.st_mtime)
+        return files
+
+    def changes(self, timeout):
+        """Paths of files that have been added or changed"""
+        time.sleep(max(min(timeout,
+                           self.last_scan + self.interval - time.time()),
+                       0))
+        self.last_scan = time.time()
+        files = self.scan()
+        changed = [path for path, stat in files.items()
+                   if self.seen.get(path) != stat]
+        self.seen = files
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+
+    """
+    Watch folders (and their subfolders) for changed files with the Linux
+    inotify API (through ctypes, so there is no extra dependency)
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, folders):
+        library = ctypes.util.find_library("c")
+        if library is None:
+            raise OSError("inotify is not available")
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self.libc, "inotify_init"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.folders = folders
+        self.watches = {}
+        self.overflowed = []
+        for top in folders:
+            self.add_tree(top)
+
+    def add_watch(self, folder):
+        mask = (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO |
+                self.IN_CREATE)
+        wd = self.libc.inotify_add_watch(self.fd,
+                                         os.fsencode(folder)
+                                         if hasattr(os, "fsencode")
+                                         else folder,
+                                         mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),
+                          "inotify_add_watch failed for " + folder)
+        self.watches[wd] = folder
+
+    def add_tree(self, top):
+        """Watch a folder and its subfolders, returning the files in them"""
+        found = []
+        for folder, subfolders, filenames in os.walk(top):
+            self.add_watch(folder)
+            found.extend(os.path.join(folder, name) for name in filenames)
+        return found
+
+    def changes(self, timeout):
+        """Paths of files that have been added or changed"""
+        if self.overflowed:
+            # Events were lost, so report everything
+            found, self.overflowed = self.overflowed, []
+            return found
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        changed = []
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                for top in self.folders:
+                    for folder, subfolders, filenames in os.walk(top):
+                        self.overflowed.extend(os.path.join(folder, f)
+                                               for f in filenames)
+                continue
+            if wd not in self.watches or not name:
+                continue
+            path = os.path.join(self.watches[wd],
+                                name.decode(sys.getfilesystemencoding()))
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # Files may already be in a new folder before it is watched
+                    changed.extend(self.add_tree(path))
+            else:
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(folders, poll=False, interval=1.0):
+    """An inotify watcher, if available (and not polling), else a poller"""
+    if not poll:
+        try:
+            return InotifyWatcher(folders)
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify unavailable (%s), polling instead", e)
+    return PollingWatcher(folders, interval)
+
+
+class Importer(object):
+
+    """
+    Import FIT files into a trt2import folder: copy the FIT file, convert it
+    to TCX (optionally) and add it to the index, keeping the timezone lookup
+    and index loaded between files. The files are named by the local start
+    time of the activity: <folder>/<year>/FIT/<yyyy-mm-dd_hhmm>.fit
+    """
+
+    def __init__(self,
+                 folder,
+                 convert_to_tcx=False,
+                 options=None,
+                 time_zone="auto",
+                 overwrite=False,
+                 index=True):
+        self.folder = folder
+        self.convert_to_tcx = convert_to_tcx
+        self.options = options or {}
+        self.time_zone = time_zone
+        self.overwrite = overwrite
+        self.latencies = []
+        fit2tcx.makedirs(folder)
+        if time_zone == "auto":
+            fit2tcx.load_timezones()
+        self.db = None
+        self.tracks = None
+        if index:
+            index_file = os.path.join(folder, trt2index.INDEX_FILENAME)
+            self.db = trt2index.open_index(index_file)
+            self.tracks = trt2index.TrackIndex(
+                trt2index.tracks_folder(index_file))
+
+    def destination(self, fit_file):
+        """The year and base name for a FIT file in the folder"""
+        info = fit2tcx.peek(fit_file, self.time_zone)
+        start = info['start_time'].astimezone(timezone(info['timezone']))
+        return start.strftime("%Y"), start.strftime("%Y-%m-%d_%H%M")
+
+    def import_file(self, fit_file, arrived=None):
+        """
+        Import a FIT file, returning the path of the copied FIT file, or None
+        if it had already been imported. The time from arrival (by default,
+        now) to output is logged and kept in latencies. If the file can't be
+        converted, the copy is removed again, so that it isn't skipped as
+        previously imported when it is retried.
+        """
+        if arrived is None:
+            arrived = time.time()
+        year, basename = self.destination(fit_file)
+        dst_fit = os.path.join(self.folder, year, "FIT", basename + ".fit")
+        dst_tcx = os.path.join(self.folder, year, "TCX", basename + ".tcx")
+        if os.path.exists(dst_fit) and not self.overwrite:
+            logger.info("%s: previously imported as %s, skipping",
+                        fit_file, dst_fit)
+            return None
+
+        fit2tcx.makedirs(os.path.dirname(dst_fit))
+        with open(fit_file, 'rb') as src:
+            with fit2tcx.atomic_file(dst_fit) as dst:
+                shutil.copyfileobj(src, dst)
+        shutil.copystat(fit_file, dst_fit)
+
+        result = None
+        if self.convert_to_tcx:
+            try:
+                result = fit2tcx.convert(dst_fit, time_zone=self.time_zone,
+                                         **self.options)
+                fit2tcx.makedirs(os.path.dirname(dst_tcx))
+                result.write(dst_tcx)
+            except BaseException:
+                try:
+                    os.remove(dst_fit)
+                except OSError:
+                    pass
+                raise
+        if self.db is not None:
+            trt2index.index_activity(self.db,
+                                     self.folder,
+                                     dst_fit,
+                                     result,
+                                     time_zone=self.time_zone,
+                                     calibration_factor=self.options.get(
+                                         'current_cal_factor'),
+                                     tracks=self.tracks)
+
+        latency = time.time() - arrived
+        self.latencies.append(latency)
+        logger.info("%s: imported as %s%s (%.2f s from arrival to output)",
+                    fit_file, dst_fit,
+                    " and " + dst_tcx if self.convert_to_tcx else "",
+                    latency)
+        return dst_fit
+
+    def metrics(self):
+        """Arrival-to-output latency statistics, in seconds"""
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {'imported': 0}
+        return {'imported': len(latencies),
+                'latency_mean': sum(latencies) / len(latencies),
+                'latency_median': latencies[len(latencies) // 2],
+                'latency_max': latencies[-1],
+                'latency_last': self.latencies[-1]}
+
+    def flush(self):
+        """Write the tracks of the activities imported since the last flush"""
+        if self.tracks is not None:
+            self.tracks.flush()
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+
+
+def watch(folders, importer, poll=False, interval=1.0, settle=2.0,
+          existing=True, metrics_file=None, run_for=None):
+    """
+    Watch folders for FIT files, and import each one once it has settled
+    (its size and modification time haven't changed for settle seconds).
+    Files already in the folders are imported too, if existing is set.
+    Files that fail to import are retried up to MAX_RETRIES times.
+    Runs until interrupted (or for run_for seconds).
+    """
+    watcher = create_watcher(folders, poll, interval)
+    pending = {}    # path -> [arrived, last changed, (size, mtime)]
+    failures = {}   # path -> number of failed imports
+    started = time.time()
+
+    archive = os.path.join(os.path.abspath(importer.folder), "")
+
+    def arrive(path, now):
+        if not path.lower().endswith(".fit"):
+            return
+        if os.path.abspath(path).startswith(archive):
+            return      # a file imported into a watched folder
+        try:
+            stat = os.stat(path)
+            stat = (stat.st_size, stat.st_mtime)
+        except OSError:
+            stat = None
+        failures.pop(path, None)    # changed since it last failed
+        if path in pending:
+            pending[path][1:] = [now, stat]
+        else:
+            pending[path] = [now, now, stat]
+
+    try:
+        if existing:
+            for top in folders:
+                for folder, subfolders, filenames in os.walk(top):
+                    for filename in filenames:
+                        arrive(os.path.join(folder, filename), time.time())
+        while run_for is None or time.time() - started < run_for:
+            for path in watcher.changes(min(settle, interval)):
+                arrive(path, time.time())
+
+            now = time.time()
+            for path in sorted(pending):
+                arrived, changed, last_stat = pending[path]
+                if now - changed < settle:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    del pending[path]   # removed before it settled
+                    continue
+                if (stat.st_size, stat.st_mtime) != last_stat:
+                    # Still being written
+                    pending[path][1:] = [now, (stat.st_size, stat.st_mtime)]
+                    continue
+                del pending[path]
+                failed = False
+                try:
+                    importer.import_file(path, arrived)
+                except fit2tcx.ConversionError as e:
+                    logger.error("%s: %s", path, e)
+                    failed = True
+                except (IOError, OSError) as e:
+                    logger.error("%s: unable to import (%s)", path, e)
+                    failed = True
+                if failed:
+                    failures[path] = failures.get(path, 0) + 1
+                    if failures[path] <= MAX_RETRIES:
+                        # Try again once it has settled (again)
+                        pending[path] = [arrived, now, last_stat]
+                    else:
+                        logger.error("%s: not retried after %d failures",
+                                     path, failures[path])
+                if metrics_file is not None:
+                    with fit2tcx.atomic_file(metrics_file, 'w') as f:
+                        json.dump(importer.metrics(), f, indent=2)
+            # Add the tracks of the files that settled together at once
+            try:
+                importer.flush()
+            except (IOError, OSError, ValueError) as e:
+                logger.error("Unable to add tracks to the index (%s)", e)
+    finally:
+        watcher.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=__prog__, description=__desc__)
+    parser.add_argument("folder", help="Root folder for storing copied/converted files")
+    parser.add_argument("inbox", nargs="+", help="Folder(s) to watch for FIT files")
+    parser.add_argument(
+        "-v", "--version", action='version',
+        version='%(prog)s {version}'.format(version=__version__))
+    parser.add_argument(
+        "-o", "--overwrite",
+        action="store_true", default=False, help="Force overwriting existing files (default: don't overwrite)")
+    parser.add_argument(
+        "-t", "--convert-to-tcx",
+        action="store_true", default=False, help="Also convert to TCX")
+    parser.add_argument(
+        "-d", "--recalculate-distance",
+        action="store_true", default=False, help="Recalculate distance from GPS for TCX")
+    parser.add_argument(
+        "-s", "--recalculate-speed",
+        action="store_true", default=False, help="Recalculate speed from GPS for TCX")
+    parser.add_argument(
+        "-c", "--calibrate-footpod",
+        action="store_true", default=False, help="Use GPS-measured distance to calibrate footpod data for TCX")
+    parser.add_argument(
+        "-p", "--per-lap-calibration",
+        action="store_true", default=False, help="Apply footpod calibration on a per lap basis for TCX (default: apply calibration per activity)")
+    parser.add_argument(
+        "-r", "--recompute-summary",
+        action="store_true", default=False, help="Recompute lap heart rate and cadence from the trackpoints for TCX")
+    parser.add_argument(
+        "-f", "--calibration-factor",
+        action="store", default=100.0, type=float,
+        help="Calibration factor that the activities were recorded with (default: 100.0)")
+    parser.add_argument(
+        "-z", "--timezone",
+        action="store", default="auto", type=str,
+        help="Override timezone detection (default: lookup timezone from GPS data)")
+    parser.add_argument(
+        "-x", "--no-index",
+        action="store_true", default=False, help="Don't add imported activities to the index in the folder")
+    parser.add_argument(
+        "--poll",
+        action="store_true", default=False, help="Poll the folders for changes rather than using inotify")
+    parser.add_argument(
+        "--interval",
+        action="store", default=1.0, type=float,
+        help="Polling interval, in seconds (default: 1)")
+    parser.add_argument(
+        "--settle",
+        action="store", default=2.0, type=float,
+        help="Time a file must be unchanged before it is imported, in seconds (default: 2)")
+    parser.add_argument(
+        "--new-only",
+        action="store_true", default=False, help="Ignore files already in the folders when starting")
+    parser.add_argument(
+        "--metrics",
+        action="store",
+        help="Write arrival-to-output latency statistics (JSON) to this file after each import")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+    if args.calibrate_footpod and not args.recalculate_distance:
+        parser.error("-c (--calibrate-footpod) requires -d (--recalculate-distance)")
+
+    try:
+        importer = Importer(args.folder,
+                            convert_to_tcx=args.convert_to_tcx,
+                            options={'dist_recalc': args.recalculate_distance,
+                                     'speed_recalc': args.recalculate_speed,
+                                     'calibrate': args.calibrate_footpod,
+                                     'per_lap_cal': args.per_lap_calibration,
+                                     'current_cal_factor': args.calibration_factor,
+                                     'recompute_summary': args.recompute_summary},
+                            time_zone=args.timezone,
+                            overwrite=args.overwrite,
+                            index=not args.no_index)
+    except Exception as e:
+        print("Error: unable to open folder {path!s}. ({err!s})".format(
+            path=args.folder, err=e))
+        return 1
+
+    print("Watching {folders!s} for FIT files (Ctrl-C to stop)".format(
+        folders=", ".join(args.inbox)))
+    try:
+        watch(args.inbox,
+              importer,
+              poll=args.poll,
+              interval=args.interval,
+              settle=args.settle,
+              existing=not args.new_only,
+              metrics_file=args.metrics)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        importer.close()
+    metrics = importer.metrics()
+    if metrics['imported']:
+        print("{imported} activities imported, {mean:.2f} s mean and "
+              "{max:.2f} s maximum from arrival to output".format(
+                  imported=metrics['imported'],
+                  mean=metrics['latency_mean'],
+                  max=metrics['latency_max']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())